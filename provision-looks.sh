@@ -90,108 +90,77 @@ CHECKPOINTS_DIR="/workspace/ComfyUI/models/checkpoints"
 
 mkdir -p "$MODELS_DIR" "$LORAS_DIR" "$CHECKPOINTS_DIR"
 
-# --- FLUX Klein 9B base model (GATED — necesita HF_TOKEN + huggingface-cli) ---
-# No sabemos el nombre exacto del .safetensors, huggingface-cli lo descubre
+# --- FLUX Klein base-9B en formato diffusers (GATED — necesita HF_TOKEN) ---
+# Solo el repo base (no el destilado FLUX.2-klein-9B): es la base de las LoRAs.
+# El worker lo carga offline desde KLEIN_PIPELINE_DIR, transformer incluido
 ${VENV_PIP} install -q huggingface_hub 2>/dev/null
 
-KLEIN_FOUND="$(find "$MODELS_DIR" -maxdepth 1 -type f -iname "*klein*" | head -1 || true)"
-if [ -z "$KLEIN_FOUND" ]; then
-  if [ -n "${HF_TOKEN:-}" ]; then
-    echo "   Descargando FLUX Klein 9B base con huggingface-cli..."
-    echo "   (modelo gated, usando HF_TOKEN para autenticación)"
-    
-    # Descargar TODO el repo Klein — huggingface-cli sabe qué archivos hay
-    ${VENV_PY} -c "
-import os, glob, shutil
-from huggingface_hub import hf_hub_download, list_repo_files
-
-token = os.environ.get('HF_TOKEN')
-models_dir = '$MODELS_DIR'
-
-# Probar ambos repos posibles
-repos = ['black-forest-labs/FLUX.2-klein-9B', 'black-forest-labs/FLUX.2-klein-base-9B']
-
-for repo in repos:
-    try:
-        print(f'Probando repo: {repo}')
-        files = list_repo_files(repo, token=token)
-        safetensors = [f for f in files if f.endswith('.safetensors')]
-        print(f'  Archivos safetensors: {safetensors}')
-        
-        # Buscar el archivo principal del transformer/unet
-        # Prioridad: archivo raíz > transformer/ > unet/
-        target = None
-        for f in safetensors:
-            if '/' not in f:  # archivo en raíz
-                target = f
-                break
-        if not target:
-            for f in safetensors:
-                if 'transformer' in f or 'unet' in f or 'diffusion' in f:
-                    target = f
-                    break
-        if not target and safetensors:
-            target = safetensors[0]
-        
-        if target:
-            print(f'  Descargando: {target}')
-            path = hf_hub_download(repo, target, local_dir='/tmp/klein_download', token=token)
-            # Copiar al directorio de modelos con nombre genérico
-            dest = os.path.join(models_dir, 'flux2-klein-9b.safetensors')
-            shutil.copy2(path, dest)
-            print(f'  ✓ Guardado en: {dest}')
-            print(f'  ✓ Tamaño: {os.path.getsize(dest) / 1e9:.1f}GB')
-            break
-        else:
-            print(f'  No safetensors en {repo}')
-    except Exception as e:
-        print(f'  Error con {repo}: {e}')
-        continue
-" 2>&1
-    
-    # Limpiar descarga temporal
-    rm -rf /tmp/klein_download 2>/dev/null
-    
-    # Verificar si descargó y limpiar modelo viejo
-    KLEIN_FOUND="$(find "$MODELS_DIR" -maxdepth 1 -type f -iname "*klein*" | head -1 || true)"
-    if [ ! -z "$KLEIN_FOUND" ]; then
-      echo "   🗑️ Klein descargado OK. Eliminando flux2_dev_fp8mixed (ahorra 12GB)..."
-      rm -f "$MODELS_DIR/flux2_dev_fp8mixed.safetensors" 2>/dev/null || true
-    else
-      echo "⚠️ Klein 9B no se pudo descargar. Usando FLUX dev como fallback."
-    fi
+KLEIN_PIPELINE_DIR="${KLEIN_PIPELINE_DIR:-/workspace/models/flux2-klein-base-9b}"
+KLEIN_LORAS_DIR="$KLEIN_PIPELINE_DIR/loras"
+mkdir -p "$KLEIN_LORAS_DIR"
+
+klein_complete() {
+  [ -f "$KLEIN_PIPELINE_DIR/model_index.json" ] && \
+    find "$KLEIN_PIPELINE_DIR/transformer" -maxdepth 1 -name "*.safetensors" 2>/dev/null | grep -q .
+}
+
+KLEIN_FOUND=""
+if klein_complete; then
+  KLEIN_FOUND="$KLEIN_PIPELINE_DIR"
+  echo "   ✓ Klein base-9B ya existe: $KLEIN_FOUND"
+elif [ -n "${HF_TOKEN:-}" ]; then
+  echo "   Descargando FLUX.2-klein-base-9B (diffusers) en $KLEIN_PIPELINE_DIR..."
+  echo "   (modelo gated, usando HF_TOKEN para autenticación)"
+  ${VENV_PY} -c "
+import os
+from huggingface_hub import snapshot_download
+
+snapshot_download(
+    'black-forest-labs/FLUX.2-klein-base-9B',
+    local_dir='$KLEIN_PIPELINE_DIR',
+    allow_patterns=['model_index.json', 'scheduler/*', 'tokenizer/*', 'text_encoder/*', 'vae/*', 'transformer/*'],
+    token=os.environ.get('HF_TOKEN'),
+)
+" 2>&1 | tail -n 5 || true
+  
+  if klein_complete; then
+    KLEIN_FOUND="$KLEIN_PIPELINE_DIR"
+    echo "   🗑️ Klein descargado OK. Eliminando flux2_dev_fp8mixed (ahorra 12GB)..."
+    rm -f "$MODELS_DIR/flux2_dev_fp8mixed.safetensors" 2>/dev/null || true
   else
-    echo "⚠️ HF_TOKEN no configurado — Klein 9B requiere autenticación"
-    echo "   Usando FLUX dev del template como fallback (sin LoRA try-on)"
+    echo "⚠️ Klein base-9B no se pudo descargar. Usando FLUX dev como fallback."
   fi
 else
-  echo "   ✓ Klein 9B ya existe: $KLEIN_FOUND"
+  echo "⚠️ HF_TOKEN no configurado — Klein 9B requiere autenticación"
+  echo "   Usando FLUX dev del template como fallback (sin LoRA try-on)"
 fi
 
-# --- Try-On LoRA (público, no necesita token) ---
-TRYON_LORA="flux-klein-tryon-comfy.safetensors"
-if [ ! -f "$LORAS_DIR/$TRYON_LORA" ]; then
-  echo "   Descargando Try-On LoRA..."
-  cd "$LORAS_DIR"
-  wget --progress=bar:force:noscroll \
-    "https://huggingface.co/fal/flux-klein-9b-virtual-tryon-lora/resolve/main/flux-klein-tryon-comfy.safetensors" \
-    -O "$TRYON_LORA" 2>&1 | tail -n 5 || echo "⚠️ Try-On LoRA no disponible"
-  cd /workspace
-else
-  echo "   ✓ Try-On LoRA ya existe"
-fi
+# --- LoRAs en formato diffusers (públicas) ---
+# Las variantes *_comfy.safetensors son para ComfyUI: diffusers no carga sus claves.
+# Se busca en el repo el .safetensors que no es la variante comfy
+download_klein_lora() {
+  local repo="$1" dest="$2" desc="$3"
+  if [ -f "$KLEIN_LORAS_DIR/$dest" ]; then
+    echo "   ✓ $desc ya existe"
+    return
+  fi
+  echo "   Descargando $desc ($repo)..."
+  ${VENV_PY} -c "
+import os, shutil
+from huggingface_hub import hf_hub_download, list_repo_files
 
-# --- Try-Off LoRA (público) ---
-TRYOFF_LORA="virtual-tryoff-lora_comfy.safetensors"
-if [ ! -f "$LORAS_DIR/$TRYOFF_LORA" ]; then
-  echo "   Descargando Try-Off LoRA..."
-  cd "$LORAS_DIR"
-  wget --progress=bar:force:noscroll \
-    "https://huggingface.co/fal/virtual-tryoff-lora/resolve/main/virtual-tryoff-lora_comfy.safetensors" \
-    -O "$TRYOFF_LORA" 2>&1 | tail -n 5 || echo "⚠️ Try-Off LoRA no disponible"
-  cd /workspace
-else
-  echo "   ✓ Try-Off LoRA ya existe"
+files = [f for f in list_repo_files('$repo') if f.endswith('.safetensors') and 'comfy' not in f.lower()]
+if not files:
+    raise SystemExit('sin LoRA diffusers en $repo')
+path = hf_hub_download('$repo', files[0], token=os.environ.get('HF_TOKEN'))
+shutil.copy2(path, os.path.join('$KLEIN_LORAS_DIR', '$dest'))
+print(f'  ✓ {files[0]} → $dest')
+" 2>&1 | tail -n 3 || echo "⚠️ $desc no disponible"
+}
+
+if [ -n "$KLEIN_FOUND" ]; then
+  download_klein_lora "fal/flux-klein-9b-virtual-tryon-lora" "flux-klein-tryon.safetensors" "Try-On LoRA"
+  download_klein_lora "fal/virtual-tryoff-lora" "virtual-tryoff-lora.safetensors" "Try-Off LoRA"
 fi
 
 # --- T5-XXL text encoder (Klein 9B usa T5, no Mistral) ---
@@ -0,0 +1,152 @@
+import os
+import re
+import sys
+import threading
+import types
+
+import pytest
+
+# worker_vast crea el cliente de Supabase al importarse: basta con una URL/clave con formato válido
+os.environ.setdefault("SUPABASE_URL", "http://127.0.0.1:54321")
+os.environ.setdefault("SUPABASE_KEY", "eyJhbGciOiJIUzI1NiJ9.e30.test")
+os.environ.setdefault("WORKER_ID", "vast-worker-test")
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+@pytest.fixture(scope="session")
+def worker():
+    import worker_vast
+    return worker_vast
+
+
+class FakeQuery:
+    """Builder PostgREST mínimo: select/update con eq, in_, lt, or_, order, limit y maybe_single"""
+
+    def __init__(self, server, table):
+        self.server = server
+        self.table = table
+        self.values = None
+        self.filters = []
+        self.orders = []
+        self.max_rows = None
+        self.columns = None
+        self.single = False
+
+    def select(self, columns='*'):
+        if columns.strip() != '*':
+            self.columns = [column.strip() for column in columns.split(',')]
+        return self
+
+    def maybe_single(self):
+        self.single = True
+        return self
+
+    def update(self, values):
+        self.values = values
+        return self
+
+    def eq(self, column, value):
+        self.filters.append(lambda row: row.get(column) == value)
+        return self
+
+    def in_(self, column, values):
+        self.filters.append(lambda row: row.get(column) in values)
+        return self
+
+    def lt(self, column, value):
+        self.filters.append(lambda row: row.get(column) is not None and row[column] < value)
+        return self
+
+    def or_(self, expr):
+        terms = [self._term(t) for t in re.split(r',(?![^(]*\))', expr)]
+        self.filters.append(lambda row: any(term(row) for term in terms))
+        return self
+
+    @staticmethod
+    def _term(term):
+        column, op, value = term.split('.', 2)
+        if op == 'is' and value == 'null':
+            return lambda row: row.get(column) is None
+        if op == 'not' and value.startswith('in.('):
+            excluded = value[4:-1].split(',')
+            return lambda row: row.get(column) is not None and row[column] not in excluded
+        raise AssertionError(f"filtro or_ no soportado por el stand-in: {term}")
+
+    def order(self, column, desc=False):
+        self.orders.append((column, desc))
+        return self
+
+    def limit(self, count):
+        self.max_rows = count
+        return self
+
+    def execute(self):
+        with self.server.lock:
+            rows = [row for row in self.server.tables.setdefault(self.table, {}).values()
+                    if all(f(row) for f in self.filters)]
+            if self.values is not None:
+                # Filtros y escritura bajo el mismo lock: como el UPDATE ... WHERE de Postgres
+                for row in rows:
+                    row.update(self.values)
+                self.server.updates.append((self.table, dict(self.values), [row['id'] for row in rows]))
+                return types.SimpleNamespace(data=[dict(row) for row in rows])
+            for column, desc in reversed(self.orders):
+                rows.sort(key=lambda row: row.get(column) or 0, reverse=desc)
+            rows = [
+                {column: row.get(column) for column in self.columns} if self.columns else dict(row)
+                for row in rows[:self.max_rows]
+            ]
+        self.server.select_count += 1
+        self.server.after_select()
+        if self.single:
+            # supabase-py devuelve None (no una respuesta vacía) si no hay fila
+            return types.SimpleNamespace(data=rows[0]) if rows else None
+        return types.SimpleNamespace(data=rows)
+
+
+class FakeRpc:
+    def __init__(self, server, name, params):
+        self.server, self.name, self.params = server, name, params
+
+    def execute(self):
+        self.server.rpc_calls.append((self.name, dict(self.params)))
+        return types.SimpleNamespace(data=self.server.rpc_handler(self.name, self.params))
+
+
+class FakeSupabase:
+    """
+    Stand-in de supabase-py sobre tablas en memoria. `rpc_handler(name, params)`
+    decide qué devuelve (o lanza) cada RPC; `after_select` permite intercalar workers.
+    """
+
+    def __init__(self):
+        self.tables = {}
+        self.lock = threading.Lock()
+        self.updates = []
+        self.rpc_calls = []
+        self.select_count = 0
+        self.rpc_handler = None
+        self.after_select = lambda: None
+
+    def insert(self, table, row):
+        with self.lock:
+            self.tables.setdefault(table, {})[row['id']] = dict(row)
+
+    def rows(self, table='ai_generation_jobs'):
+        return self.tables.get(table, {})
+
+    def table(self, name):
+        return FakeQuery(self, name)
+
+    def rpc(self, name, params):
+        return FakeRpc(self, name, params)
+
+
+@pytest.fixture
+def fake_supabase(worker, monkeypatch):
+    server = FakeSupabase()
+    monkeypatch.setattr(worker, "supabase", server)
+    monkeypatch.setattr(worker, "CLAIM_RPC_AVAILABLE", None)
+    monkeypatch.setattr(worker, "CLAIM_RPC_EXCLUDE_AVAILABLE", None)
+    return server
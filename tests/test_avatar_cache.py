@@ -0,0 +1,97 @@
+"""Cache de análisis de avatar: TTL, LRU, caché negativa y precarga del batch con una consulta"""
+
+import types
+from collections import OrderedDict
+
+import pytest
+
+TABLE = 'virtual_avatars'
+
+
+@pytest.fixture
+def avatars(worker, fake_supabase, monkeypatch):
+    clock = types.SimpleNamespace(now=1000.0)
+    monkeypatch.setattr(worker, "time", types.SimpleNamespace(time=lambda: clock.now))
+    monkeypatch.setattr(worker, "_avatar_cache", OrderedDict())
+    monkeypatch.setitem(worker.WORKER_CONFIG, 'AVATAR_CACHE_TTL_SECONDS', 300)
+    monkeypatch.setitem(worker.WORKER_CONFIG, 'AVATAR_CACHE_MAX_USERS', 1000)
+    for user_id in ('u1', 'u2', 'u3'):
+        fake_supabase.insert(TABLE, {
+            'id': f"avatar-{user_id}", 'user_id': user_id,
+            'grok_facial_features': {'eyes': user_id}, 'grok_body_analysis': {'build': user_id},
+        })
+    fake_supabase.clock = clock
+    return fake_supabase
+
+
+def test_repeated_lookups_hit_the_cache(worker, avatars):
+    first = worker.get_avatar_analysis('u1')
+    assert worker.get_avatar_analysis('u1') == first
+    assert first == {'grok_facial_features': {'eyes': 'u1'}, 'grok_body_analysis': {'build': 'u1'}}
+    assert avatars.select_count == 1
+
+
+def test_user_without_avatar_is_cached_as_none(worker, avatars):
+    assert worker.get_avatar_analysis('sin-avatar') is None
+    assert worker.get_avatar_analysis('sin-avatar') is None
+    assert avatars.select_count == 1
+
+
+def test_entries_expire_after_ttl(worker, avatars):
+    worker.get_avatar_analysis('u1')
+    avatars.clock.now += 299
+    worker.get_avatar_analysis('u1')
+    assert avatars.select_count == 1
+
+    avatars.clock.now += 2
+    worker.get_avatar_analysis('u1')
+    assert avatars.select_count == 2
+
+
+def test_least_recently_used_user_is_evicted(worker, avatars, monkeypatch):
+    monkeypatch.setitem(worker.WORKER_CONFIG, 'AVATAR_CACHE_MAX_USERS', 2)
+    worker.get_avatar_analysis('u1')
+    worker.get_avatar_analysis('u2')
+    worker.get_avatar_analysis('u1')  # u1 pasa a ser el más reciente
+    worker.get_avatar_analysis('u3')
+
+    assert list(worker._avatar_cache) == ['u1', 'u3']
+
+
+def test_failed_lookup_is_not_cached(worker, avatars, monkeypatch):
+    real_table = avatars.table
+
+    def broken_table(name):
+        raise ConnectionError("PostgREST caído")
+
+    monkeypatch.setattr(avatars, "table", broken_table)
+    assert worker.get_avatar_analysis('u1') is None
+    monkeypatch.setattr(avatars, "table", real_table)
+
+    assert worker.get_avatar_analysis('u1')['grok_facial_features'] == {'eyes': 'u1'}
+
+
+def test_batch_prefetch_uses_one_query(worker, avatars):
+    worker.get_avatar_analysis('u1')
+    jobs = [
+        {'id': 'j1', 'user_id': 'u1'},                          # ya en cache
+        {'id': 'j2', 'user_id': 'u2', 'job_type': 'tryon'},
+        {'id': 'j3', 'user_id': 'u3', 'job_type': 'tryoff'},    # no usa el análisis
+        {'id': 'j4', 'user_id': 'sin-avatar'},
+    ]
+
+    worker.prefetch_avatar_analysis(jobs)
+    assert avatars.select_count == 2
+    assert set(worker._avatar_cache) == {'u1', 'u2', 'sin-avatar'}
+
+    assert worker.get_avatar_analysis('u2') == {'grok_facial_features': {'eyes': 'u2'}, 'grok_body_analysis': {'build': 'u2'}}
+    assert worker.get_avatar_analysis('sin-avatar') is None
+    assert avatars.select_count == 2
+
+
+def test_invalidate_forces_a_fresh_read(worker, avatars):
+    worker.get_avatar_analysis('u1')
+    avatars.rows(TABLE)['avatar-u1']['grok_body_analysis'] = {'build': 'nuevo'}
+    worker.invalidate_avatar_analysis('u1')
+
+    assert worker.get_avatar_analysis('u1')['grok_body_analysis'] == {'build': 'nuevo'}
@@ -0,0 +1,242 @@
+"""ComfyEventClient contra un /ws de ComfyUI falso: reparto por prompt_id, huérfanos y fallbacks"""
+
+import json
+import queue
+import threading
+import time
+import types
+import uuid
+
+import pytest
+
+websockets_server = pytest.importorskip("websockets.sync.server")
+pytest.importorskip("websocket")
+
+DROP = object()
+
+
+class FakeComfyWS:
+    """
+    Stand-in del /ws de ComfyUI: la conexión de `client_id` recibe lo que se ponga
+    en `outbox` (dicts como JSON, bytes como preview binario); DROP cierra el socket.
+    Clientes de otros tests que reconectan a un puerto reutilizado se rechazan.
+    """
+
+    def __init__(self):
+        self.client_id = f"vast-worker-test-{uuid.uuid4().hex[:8]}"
+        self.outbox = queue.Queue()
+        self.paths = []
+        self._stopped = threading.Event()
+        self._server = websockets_server.serve(self._handler, "127.0.0.1", 0)
+        self.port = self._server.socket.getsockname()[1]
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+
+    def _handler(self, connection):
+        if not connection.request.path.endswith(f"clientId={self.client_id}"):
+            return
+        self.paths.append(connection.request.path)
+        while not self._stopped.is_set():
+            try:
+                message = self.outbox.get(timeout=0.05)
+            except queue.Empty:
+                continue
+            if message is DROP:
+                return
+            connection.send(message if isinstance(message, bytes) else json.dumps(message))
+
+    def send(self, event_type, **data):
+        self.outbox.put({'type': event_type, 'data': data})
+
+    def drop(self):
+        self.outbox.put(DROP)
+
+    def close(self):
+        self._stopped.set()
+        self._server.shutdown()
+
+
+class FakeClock:
+    """time del worker con saltos de `step` segundos por lectura (sleep real)"""
+
+    def __init__(self, step):
+        self.now = time.time()
+        self.step = step
+
+    def time(self):
+        self.now += self.step
+        return self.now
+
+    @staticmethod
+    def sleep(seconds):
+        time.sleep(seconds)
+
+
+def wait_until(predicate, timeout=5):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if predicate():
+            return True
+        time.sleep(0.02)
+    return False
+
+
+@pytest.fixture
+def comfy_ws():
+    server = FakeComfyWS()
+    yield server
+    server.close()
+
+
+@pytest.fixture
+def client(worker, comfy_ws):
+    events = worker.ComfyEventClient(f"http://127.0.0.1:{comfy_ws.port}", comfy_ws.client_id)
+    events.start()
+    assert events.connected.wait(5), "el cliente no conectó al /ws falso"
+    return events
+
+
+def endpoint_for(events):
+    return types.SimpleNamespace(url="http://127.0.0.1", events=events, http=None)
+
+
+def test_connects_with_client_id(client, comfy_ws):
+    assert wait_until(lambda: comfy_ws.paths == [f"/ws?clientId={comfy_ws.client_id}"])
+
+
+def test_subscriber_receives_only_its_prompt(client, comfy_ws):
+    mine = client.subscribe("p-1")
+    other = client.subscribe("p-2")
+    comfy_ws.send('progress', prompt_id="p-1", value=3, max=8)
+    comfy_ws.send('executing', prompt_id="p-2", node="7")
+
+    assert mine.get(timeout=2) == ('progress', {'prompt_id': "p-1", 'value': 3, 'max': 8})
+    assert other.get(timeout=2) == ('executing', {'prompt_id': "p-2", 'node': "7"})
+    assert mine.empty()
+
+
+def test_unsubscribed_events_go_to_orphan_buffer(client, comfy_ws):
+    events = client.subscribe("p-1")
+    client.unsubscribe("p-1")
+    comfy_ws.send('executing', prompt_id="p-1", node="3")
+
+    assert wait_until(lambda: "p-1" in client._orphans)
+    assert events.empty()
+
+
+def test_subscribe_replays_orphans_in_order(client, comfy_ws):
+    comfy_ws.send('execution_start', prompt_id="p-9")
+    comfy_ws.send(b"\x00\x00\x00\x01preview")  # previews binarios se ignoran
+    comfy_ws.send('progress', prompt_id="p-9", value=1, max=8)
+    assert wait_until(lambda: len(client._orphans.get("p-9", [])) == 2)
+
+    events = client.subscribe("p-9")
+    assert events.get_nowait()[0] == 'execution_start'
+    assert events.get_nowait()[0] == 'progress'
+    assert "p-9" not in client._orphans
+
+    comfy_ws.send('execution_success', prompt_id="p-9")
+    assert events.get(timeout=2)[0] == 'execution_success'
+
+
+def test_orphan_buffer_is_bounded(client):
+    for i in range(300):
+        client._dispatch({'type': 'executing', 'data': {'prompt_id': f"p-{i}", 'node': "1"}})
+    assert len(client._orphans) == 256
+    assert "p-0" not in client._orphans and "p-299" in client._orphans
+
+
+def test_status_updates_queue_remaining(client, comfy_ws):
+    comfy_ws.send('status', status={'exec_info': {'queue_remaining': 5}})
+    assert wait_until(lambda: client.queue_remaining == 5)
+
+
+def test_history_safety_check_every_10s_when_events_are_lost(worker, client, monkeypatch):
+    clock = FakeClock(step=5)
+    checks = []
+
+    def fake_history(job_id, endpoint, prompt_id, output_node_id):
+        checks.append(clock.now)
+        return b"png" if len(checks) == 2 else None
+
+    monkeypatch.setattr(worker, "time", clock)
+    monkeypatch.setattr(worker, "_check_comfy_history", fake_history)
+
+    # El WS sigue conectado pero nunca llega execution_success para el prompt
+    result = worker.wait_for_comfy_result("job-1", endpoint_for(client), "p-lost", "9", max_wait=300)
+
+    assert result == b"png"
+    assert len(checks) == 2
+    assert checks[1] - checks[0] > 10
+    assert "p-lost" not in client._subscribers
+
+
+def test_success_event_checks_history_immediately(worker, client, comfy_ws, monkeypatch):
+    checks = []
+    monkeypatch.setattr(
+        worker, "_check_comfy_history", lambda *args: checks.append(args) or b"png"
+    )
+    comfy_ws.send('execution_start', prompt_id="p-ok")
+    comfy_ws.send('execution_success', prompt_id="p-ok")
+
+    started = time.time()
+    assert worker.wait_for_comfy_result("job-1", endpoint_for(client), "p-ok", "9") == b"png"
+    assert time.time() - started < 2
+    assert len(checks) == 1
+
+
+def test_on_start_is_called_once_when_execution_starts(worker, client, comfy_ws, monkeypatch):
+    checks, starts = [], []
+    monkeypatch.setattr(
+        worker, "_check_comfy_history", lambda *args: checks.append(args) or b"png"
+    )
+    comfy_ws.send('execution_start', prompt_id="p-ok")
+    comfy_ws.send('executing', prompt_id="p-ok", node="5")
+    comfy_ws.send('progress', prompt_id="p-ok", value=1, max=2)
+    comfy_ws.send('execution_success', prompt_id="p-ok")
+
+    result = worker.wait_for_comfy_result(
+        "job-1", endpoint_for(client), "p-ok", "9", on_start=lambda: starts.append(len(checks))
+    )
+
+    assert result == b"png"
+    assert starts == [0]  # antes de leer el resultado, una sola vez
+
+
+def test_falls_back_to_polling_when_socket_is_down(worker, client, comfy_ws, monkeypatch):
+    comfy_ws.close()
+    comfy_ws.drop()
+    assert wait_until(lambda: not client.connected.is_set())
+
+    polled = []
+    monkeypatch.setattr(
+        worker, "_wait_for_comfy_result_polling", lambda *args: polled.append(args) or b"polled"
+    )
+    assert worker.wait_for_comfy_result("job-1", endpoint_for(client), "p-1", "9", max_wait=60) == b"polled"
+    assert polled[0][2] == "p-1" and polled[0][4] == 60
+
+
+def test_socket_drop_mid_wait_checks_history_every_loop(worker, client, comfy_ws, monkeypatch):
+    checks = []
+
+    def fake_history(*args):
+        checks.append(time.time())
+        return b"png" if not client.connected.is_set() else None
+
+    monkeypatch.setattr(worker, "_check_comfy_history", fake_history)
+    threading.Timer(0.3, lambda: (comfy_ws.close(), comfy_ws.drop())).start()
+
+    started = time.time()
+    assert worker.wait_for_comfy_result("job-1", endpoint_for(client), "p-1", "9") == b"png"
+    # Sin WS no se espera a la comprobación de 10s
+    assert time.time() - started < 5
+
+
+def test_reconnect_calls_on_connect(client, comfy_ws):
+    reconnects = []
+    client.on_connect = lambda: reconnects.append(time.time())
+    comfy_ws.drop()
+    assert wait_until(lambda: not client.connected.is_set())
+    reconnects.clear()  # la conexión inicial pudo llamar ya al callback
+
+    assert wait_until(lambda: reconnects)
+    assert client.connected.is_set()
@@ -0,0 +1,150 @@
+"""Pre-encolado en ComfyUI: sin esperas en el hilo de envío, slots y cancelación"""
+
+import threading
+import types
+from concurrent.futures import Future
+
+import pytest
+
+
+@pytest.fixture
+def pipeline(worker, monkeypatch):
+    """ComfyUI falso: cada POST /prompt devuelve p-<job_id>; un solo slot comfy_image"""
+    posted = []
+    monkeypatch.setattr(worker, "RESOURCE_SEMAPHORES", {'comfy_image': threading.BoundedSemaphore(1)})
+    monkeypatch.setattr(worker, "_comfy_submissions", {})
+    monkeypatch.setattr(worker, "_prefetch_futures", {})
+    monkeypatch.setattr(worker, "is_comfy_job", lambda job: True)
+    monkeypatch.setattr(
+        worker, "acquire_comfy_endpoint", lambda: types.SimpleNamespace(url="fake", events=None, is_local=True)
+    )
+    monkeypatch.setattr(worker, "release_comfy_endpoint", lambda endpoint: None)
+    monkeypatch.setattr(worker, "cancel_comfy_prompt", lambda endpoint, prompt_id: None)
+    monkeypatch.setattr(worker, "build_comfy_job", lambda job, endpoint: {
+        'workflow': {}, 'output_node': '9', 'max_wait': 180, 'total_steps': 20,
+    })
+
+    def fake_post(job_id, endpoint, workflow, timeout=None):
+        posted.append(job_id)
+        return f"p-{job_id}"
+
+    monkeypatch.setattr(worker, "submit_comfy_prompt", fake_post)
+    return posted
+
+
+def prefetched(worker, job_id, ready=True):
+    future = Future()
+    if ready:
+        future.set_result({})
+    worker._prefetch_futures[job_id] = future
+    return {'id': job_id}
+
+
+def test_presubmit_skips_jobs_still_downloading(worker, pipeline):
+    slow = prefetched(worker, 'slow', ready=False)
+    fast = prefetched(worker, 'fast')
+
+    worker.presubmit_comfy_jobs([slow, fast])  # no se bloquea en los inputs de 'slow'
+
+    assert worker._comfy_submissions['fast'].result(timeout=5)['prompt_id'] == "p-fast"
+    assert 'slow' not in worker._comfy_submissions
+    assert pipeline == ['fast']
+
+
+def test_presubmit_without_free_slot_retries_later(worker, pipeline):
+    first, second = prefetched(worker, 'a'), prefetched(worker, 'b')
+
+    worker.presubmit_comfy_jobs([first, second])
+    assert list(worker._comfy_submissions) == ['a']
+
+    worker.discard_comfy_submissions(['a'])  # libera el slot
+    worker.presubmit_comfy_jobs([second])
+    assert worker._comfy_submissions['b'].result(timeout=5)['prompt_id'] == "p-b"
+
+
+def test_job_thread_waits_for_its_own_inputs(worker, pipeline):
+    inputs = Future()
+    worker._prefetch_futures['own'] = inputs
+    result = {}
+    thread = threading.Thread(target=lambda: result.setdefault('future', worker._comfy_submission({'id': 'own'})))
+    thread.start()
+    thread.join(0.2)
+    assert thread.is_alive()  # espera en su hilo...
+
+    # ...mientras otro job con inputs listos se envía sin esperarle
+    worker.presubmit_comfy_jobs([{'id': 'own'}, prefetched(worker, 'other')])
+    assert worker._comfy_submissions['other'].result(timeout=5)['prompt_id'] == "p-other"
+
+    worker.discard_comfy_submissions(['other'])
+    inputs.set_result({})
+    thread.join(5)
+    assert result['future'].result()['prompt_id'] == "p-own"
+
+
+def test_cancelled_presubmit_returns_its_slot(worker, pipeline, monkeypatch):
+    monkeypatch.setattr(worker, "COMFY_SUBMIT_EXECUTOR", types.SimpleNamespace(
+        submit=lambda fn, *args: Future(),  # nunca llega a ejecutarse
+    ))
+    worker.presubmit_comfy_jobs([prefetched(worker, 'queued')])
+    assert not worker.RESOURCE_SEMAPHORES['comfy_image'].acquire(blocking=False)
+
+    worker.discard_comfy_submissions(['queued'])
+    assert worker.RESOURCE_SEMAPHORES['comfy_image'].acquire(blocking=False)
+
+
+def test_submitted_prompt_is_taken_only_once(worker, pipeline):
+    worker.presubmit_comfy_jobs([prefetched(worker, 'a')])
+    comfy_job = worker._comfy_submissions['a'].result(timeout=5)
+    barrier = threading.Barrier(8)
+    wins = []
+
+    def take():
+        barrier.wait()
+        wins.append(worker._take_comfy_prompt(comfy_job))
+
+    threads = [threading.Thread(target=take) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(5)
+
+    # El job que espera y el discard no pueden liberar los dos el slot
+    assert wins.count(True) == 1
+
+
+def test_discarded_prompt_is_not_awaited(worker, pipeline, monkeypatch):
+    job = prefetched(worker, 'a')
+    worker.presubmit_comfy_jobs([job])
+    future = worker._comfy_submissions['a']
+    future.result(timeout=5)
+    monkeypatch.setattr(worker, "_comfy_submission", lambda job: future)
+
+    worker.discard_comfy_submissions(['a'])
+
+    with pytest.raises(Exception, match="ya se canceló"):
+        worker.run_comfy_job(job, "Generando...")
+    # Un solo release: el slot sigue disponible exactamente una vez
+    semaphore = worker.RESOURCE_SEMAPHORES['comfy_image']
+    assert semaphore.acquire(blocking=False) and not semaphore.acquire(blocking=False)
+
+
+def test_vram_is_reserved_only_while_comfy_executes(worker, pipeline, monkeypatch):
+    arbiter = worker.VramArbiter({'klein': 10, 'comfy_image': 30, 'comfy_video': 45}, 2, 5)
+    arbiter.enabled = True
+    monkeypatch.setattr(worker, "VRAM_ARBITER", arbiter)
+    monkeypatch.setattr(worker, "update_job_progress", lambda *args: None)
+    active = []
+
+    def fake_wait(job_id, endpoint, prompt_id, output_node_id, max_wait, total_steps, on_start):
+        active.append(sum(arbiter._active.values(), []))  # en la cola de ComfyUI
+        on_start()
+        active.append(sum(arbiter._active.values(), []))  # ejecutando
+        return b"png"
+
+    monkeypatch.setattr(worker, "wait_for_comfy_result", fake_wait)
+    job = prefetched(worker, 'a')
+    worker.presubmit_comfy_jobs([job])
+
+    assert worker.run_comfy_job(job, "Generando...") == b"png"
+    assert active == [[], [1]]
+    assert arbiter._active == {'comfy_image': []}
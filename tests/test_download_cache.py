@@ -0,0 +1,162 @@
+"""DownloadCache contra un origen falso: frescura, revalidación con ETag (304) y expulsión LRU"""
+
+import hashlib
+
+import pytest
+import requests
+
+
+class FakeResponse:
+    def __init__(self, status_code, body=b"", headers=None):
+        self.status_code = status_code
+        self.body = body
+        self.headers = headers or {}
+        self.closed = False
+        self.buffered = False
+
+    @property
+    def content(self):
+        self.buffered = True
+        return self.body
+
+    def iter_content(self, chunk_size=1):
+        for start in range(0, len(self.body), chunk_size):
+            yield self.body[start:start + chunk_size]
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise requests.exceptions.HTTPError(f"{self.status_code}")
+
+    def close(self):
+        self.closed = True
+
+
+class FakeOrigin:
+    """Storage / CDN falso: url -> (body, etag); responde 304 si el If-None-Match coincide"""
+
+    def __init__(self):
+        self.files = {}
+        self.requests = []
+        self.responses = []
+        self.down = False
+
+    def get(self, url, headers=None, timeout=None, stream=False):
+        headers = headers or {}
+        self.requests.append((url, headers))
+        if self.down:
+            raise requests.exceptions.ConnectionError("origen caído")
+        if url not in self.files:
+            return FakeResponse(404)
+        body, etag = self.files[url]
+        if headers.get('If-None-Match') == etag:
+            return FakeResponse(304, headers={'ETag': etag})
+        self.responses.append(FakeResponse(200, body, {'ETag': etag}))
+        return self.responses[-1]
+
+
+@pytest.fixture
+def origin(worker, monkeypatch):
+    server = FakeOrigin()
+    monkeypatch.setattr(worker, "DOWNLOAD_HTTP", server)
+    return server
+
+
+@pytest.fixture
+def make_cache(worker, tmp_path):
+    def make(max_bytes=1024, fresh_seconds=3600):
+        return worker.DownloadCache(tmp_path / "cache", max_bytes, fresh_seconds)
+    return make
+
+
+def blob_exists(cache, body):
+    return cache._blob_path(hashlib.sha256(body).hexdigest()).exists()
+
+
+def test_fresh_entry_is_served_from_disk(origin, make_cache):
+    origin.files['u/a'] = (b"garment-a", '"v1"')
+    cache = make_cache()
+
+    assert bytes(cache.fetch('u/a')) == b"garment-a"
+    assert bytes(cache.fetch('u/a')) == b"garment-a"
+
+    assert len(origin.requests) == 1
+    assert (cache.stats['misses'], cache.stats['hits']) == (1, 1)
+
+
+def test_stale_entry_is_revalidated_with_etag(origin, make_cache):
+    origin.files['u/a'] = (b"garment-a", '"v1"')
+    cache = make_cache(fresh_seconds=0)
+    cache.fetch('u/a')
+
+    assert bytes(cache.fetch('u/a')) == b"garment-a"
+
+    url, headers = origin.requests[-1]
+    assert headers == {'If-None-Match': '"v1"'}
+    assert cache.stats['revalidated'] == 1 and cache.stats['misses'] == 1
+
+
+def test_changed_etag_downloads_new_content(origin, make_cache):
+    origin.files['u/a'] = (b"old", '"v1"')
+    cache = make_cache(fresh_seconds=0)
+    cache.fetch('u/a')
+    origin.files['u/a'] = (b"new", '"v2"')
+
+    assert bytes(cache.fetch('u/a')) == b"new"
+    assert cache.stats['misses'] == 2 and cache.stats['revalidated'] == 0
+
+
+def test_origin_down_serves_stale_copy(origin, make_cache):
+    origin.files['u/a'] = (b"garment-a", '"v1"')
+    cache = make_cache(fresh_seconds=0)
+    cache.fetch('u/a')
+    origin.down = True
+
+    assert bytes(cache.fetch('u/a')) == b"garment-a"
+
+
+def test_least_recently_used_blob_is_evicted_first(origin, make_cache):
+    for name in 'abc':
+        origin.files[f'u/{name}'] = (name.encode() * 10, f'"{name}"')
+    cache = make_cache(max_bytes=25)
+
+    cache.fetch('u/a')
+    cache.fetch('u/b')
+    cache.fetch('u/a')  # 'a' pasa a ser el más reciente
+    cache.fetch('u/c')  # 30 bytes > 25: sale el menos usado
+
+    assert not blob_exists(cache, b"b" * 10)
+    assert blob_exists(cache, b"a" * 10) and blob_exists(cache, b"c" * 10)
+    assert set(cache._urls) == {'u/a', 'u/c'}
+    assert cache.stats['evictions'] == 1
+
+    # 'b' se vuelve a descargar; ahora el menos usado es 'a'
+    cache.fetch('u/b')
+    assert not blob_exists(cache, b"a" * 10)
+    assert list(cache._blobs) == [hashlib.sha256(b"c" * 10).hexdigest(), hashlib.sha256(b"b" * 10).hexdigest()]
+
+
+def test_lru_order_survives_restart(origin, make_cache):
+    for name in 'abc':
+        origin.files[f'u/{name}'] = (name.encode() * 10, f'"{name}"')
+    cache = make_cache(max_bytes=25)
+    cache.fetch('u/a')
+    cache.fetch('u/b')
+    cache.fetch('u/a')
+    cache.report()  # heartbeat: persiste el orden LRU de los hits
+
+    restarted = make_cache(max_bytes=25)
+    restarted.fetch('u/c')
+
+    assert not blob_exists(restarted, b"b" * 10)
+    assert bytes(restarted.fetch('u/a')) == b"a" * 10
+
+
+def test_disabled_cache_streams_without_buffering_content(origin, make_cache):
+    origin.files['u/a'] = (b"x" * 1000, '"v1"')
+    cache = make_cache(max_bytes=0)
+
+    assert not cache.enabled
+    assert bytes(cache.fetch('u/a')) == b"x" * 1000
+    response, = origin.responses
+    assert not response.buffered and response.closed
+    assert not (cache.root / "blobs").exists()
@@ -0,0 +1,99 @@
+"""PooledHTTPClient: reintentos con presupuesto de tokens contra una sesión falsa"""
+
+import time
+import types
+
+import pytest
+import requests
+
+
+class FakeSession:
+    """requests.Session falsa: cada llamada consume el siguiente status (o excepción) del guion"""
+
+    def __init__(self, script):
+        self.script = list(script)
+        self.calls = []
+
+    def request(self, method, url, timeout=None, **kwargs):
+        self.calls.append((method, url))
+        outcome = self.script.pop(0) if len(self.script) > 1 else self.script[0]
+        if isinstance(outcome, Exception):
+            raise outcome
+        return types.SimpleNamespace(status_code=outcome, close=lambda: None)
+
+
+@pytest.fixture
+def make_client(worker, monkeypatch):
+    monkeypatch.setattr(worker, "HTTP_CLIENTS", [])
+    monkeypatch.setattr(worker, "time", types.SimpleNamespace(time=time.time, sleep=lambda seconds: None))
+
+    def make(script, tokens=None, retry_ratio=0.0, max_retries=2):
+        client = worker.PooledHTTPClient("test", "http://origin", max_retries=max_retries, retry_ratio=retry_ratio)
+        client.session = FakeSession(script)
+        if tokens is not None:
+            client._retry_tokens = tokens
+        return client
+    return make
+
+
+def test_transient_503_is_retried(make_client):
+    client = make_client([503, 200])
+
+    assert client.get("/x").status_code == 200
+    assert len(client.session.calls) == 2
+    assert client.stats['retries'] == 1
+
+
+def test_exhausted_budget_returns_error_without_retrying(make_client):
+    client = make_client([503], tokens=1.0)
+
+    first = client.get("/x")
+    assert first.status_code == 503
+    assert len(client.session.calls) == 2  # un reintento: el único token
+
+    second = client.get("/x")
+    assert second.status_code == 503
+    assert len(client.session.calls) == 3  # sin tokens: sin reintento
+    assert client.stats['retries'] == 1
+    assert client.stats['retries_denied'] == 2
+    assert client.stats['errors'] == 3
+
+
+def test_exhausted_budget_raises_connection_errors(make_client):
+    client = make_client([requests.exceptions.ConnectionError("caído")], tokens=0.0)
+
+    with pytest.raises(requests.exceptions.ConnectionError):
+        client.get("/x")
+    assert len(client.session.calls) == 1
+    assert client.stats['retries_denied'] == 1
+
+
+def test_successful_requests_refill_the_budget(make_client):
+    client = make_client([200, 200, 503, 200], tokens=0.0, retry_ratio=0.5)
+
+    client.get("/a")
+    client.get("/b")  # 2 × 0.5 = un token
+    assert client.get("/c").status_code == 200
+    assert client.stats['retries'] == 1
+
+
+def test_budget_is_capped(make_client, worker):
+    client = make_client([200], retry_ratio=5.0)
+    for _ in range(5):
+        client.get("/x")
+    assert client._retry_tokens == worker.PooledHTTPClient.MAX_RETRY_TOKENS
+
+
+def test_non_idempotent_requests_are_not_retried(make_client):
+    client = make_client([503, 200])
+
+    assert client.post("/prompt").status_code == 503
+    assert len(client.session.calls) == 1
+    assert client.stats['retries'] == 0
+
+
+def test_retries_stop_at_max_retries(make_client):
+    client = make_client([504], max_retries=2)
+
+    assert client.get("/x").status_code == 504
+    assert len(client.session.calls) == 3
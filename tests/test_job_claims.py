@@ -0,0 +1,178 @@
+"""Claim de jobs contra un Supabase falso: RPC, UPDATE condicional, leases y tipos excluidos"""
+
+import threading
+from datetime import datetime, timedelta
+
+import pytest
+
+from postgrest.exceptions import APIError
+
+TABLE = 'ai_generation_jobs'
+
+
+def missing_rpc():
+    return APIError({'code': 'PGRST202', 'message': 'Could not find the function public.claim_vast_jobs'})
+
+
+def pending_job(job_id, priority=0, created_at="2026-01-01T00:00:00", job_type=None):
+    return {
+        'id': job_id, 'status': 'pending', 'preferred_backend': 'vast', 'job_type': job_type,
+        'priority': priority, 'created_at': created_at, 'claimed_by': None, 'lease_expires_at': None,
+    }
+
+
+@pytest.fixture
+def excluded(worker, monkeypatch):
+    types_ = []
+    monkeypatch.setattr(worker, "claim_excluded_job_types", lambda: list(types_))
+    return types_
+
+
+def test_rpc_claim_returns_jobs_in_queue_order(worker, fake_supabase, excluded):
+    fake_supabase.rpc_handler = lambda name, params: [
+        {'id': 'old', 'priority': 0, 'created_at': "2026-01-01T00:00:00"},
+        {'id': 'urgent', 'priority': 5, 'created_at': "2026-01-02T00:00:00"},
+    ]
+
+    jobs = worker.claim_pending_jobs(4)
+
+    assert [job['id'] for job in jobs] == ['urgent', 'old']
+    name, params = fake_supabase.rpc_calls[0]
+    assert name == 'claim_vast_jobs'
+    assert params == {
+        'p_worker_id': worker.WORKER_ID, 'p_limit': 4,
+        'p_lease_seconds': worker.WORKER_CONFIG['JOB_LEASE_SECONDS'],
+    }
+    assert worker.CLAIM_RPC_AVAILABLE is True
+
+
+def test_missing_rpc_falls_back_to_conditional_update(worker, fake_supabase, excluded):
+    def handler(name, params):
+        raise missing_rpc()
+
+    fake_supabase.rpc_handler = handler
+    fake_supabase.insert(TABLE, pending_job('a', created_at="2026-01-02T00:00:00"))
+    fake_supabase.insert(TABLE, pending_job('b', priority=3))
+    fake_supabase.insert(TABLE, {**pending_job('c'), 'preferred_backend': 'fal'})
+
+    jobs = worker.claim_pending_jobs(5)
+
+    assert [job['id'] for job in jobs] == ['b', 'a']
+    assert worker.CLAIM_RPC_AVAILABLE is False
+    assert len(fake_supabase.rpc_calls) == 1  # sin reintentos si la función no existe
+    rows = fake_supabase.rows()
+    assert rows['a']['status'] == rows['b']['status'] == 'processing'
+    assert rows['a']['claimed_by'] == worker.WORKER_ID
+    assert rows['c']['status'] == 'pending'
+
+    # Las siguientes vueltas van directas al UPDATE condicional
+    fake_supabase.insert(TABLE, pending_job('d'))
+    assert [job['id'] for job in worker.claim_pending_jobs(5)] == ['d']
+    assert len(fake_supabase.rpc_calls) == 1
+
+
+def test_conditional_update_skips_jobs_claimed_in_between(worker, fake_supabase, excluded, monkeypatch):
+    monkeypatch.setattr(worker, "CLAIM_RPC_AVAILABLE", False)
+    fake_supabase.insert(TABLE, pending_job('a'))
+    fake_supabase.insert(TABLE, pending_job('b'))
+
+    def other_worker_wins():
+        fake_supabase.after_select = lambda: None
+        fake_supabase.rows()['a'].update(status='processing', claimed_by='otro-worker')
+
+    fake_supabase.after_select = other_worker_wins
+
+    jobs = worker.claim_pending_jobs(5)
+
+    assert [job['id'] for job in jobs] == ['b']
+    assert fake_supabase.rows()['a']['claimed_by'] == 'otro-worker'
+
+
+def test_old_rpc_signature_is_retried_without_exclusions(worker, fake_supabase, excluded):
+    excluded.append('tryoff')
+
+    def old_rpc(name, params):
+        if 'p_exclude_job_types' in params:
+            raise missing_rpc()
+        fake_supabase.rows()['t'].update(status='processing', claimed_by=worker.WORKER_ID)
+        return [{'id': 'j', 'job_type': 'tryon'}, {'id': 't', 'job_type': 'tryoff'}]
+
+    fake_supabase.rpc_handler = old_rpc
+    fake_supabase.insert(TABLE, pending_job('t', job_type='tryoff'))
+
+    jobs = worker.claim_pending_jobs(5)
+
+    # La RPC sigue en uso; el try-off reclamado de más vuelve a pending
+    assert [job['id'] for job in jobs] == ['j']
+    assert worker.CLAIM_RPC_AVAILABLE is True
+    assert worker.CLAIM_RPC_EXCLUDE_AVAILABLE is False
+    assert [('p_exclude_job_types' in params) for _, params in fake_supabase.rpc_calls] == [True, False]
+    assert fake_supabase.rows()['t']['status'] == 'pending'
+    assert fake_supabase.rows()['t']['claimed_by'] is None
+
+    # No se vuelve a probar la firma nueva
+    fake_supabase.rpc_handler = lambda name, params: []
+    worker.claim_pending_jobs(5)
+    assert 'p_exclude_job_types' not in fake_supabase.rpc_calls[-1][1]
+
+
+def test_excluded_types_are_sent_to_new_rpc(worker, fake_supabase, excluded):
+    excluded.append('tryoff')
+    fake_supabase.rpc_handler = lambda name, params: []
+
+    worker.claim_pending_jobs(2)
+
+    assert fake_supabase.rpc_calls[0][1]['p_exclude_job_types'] == ['tryoff']
+    assert worker.CLAIM_RPC_EXCLUDE_AVAILABLE is True
+
+
+def test_conditional_update_excludes_types_but_keeps_null(worker, fake_supabase, excluded, monkeypatch):
+    excluded.append('tryoff')
+    monkeypatch.setattr(worker, "CLAIM_RPC_AVAILABLE", False)
+    fake_supabase.insert(TABLE, pending_job('legacy'))
+    fake_supabase.insert(TABLE, pending_job('on', job_type='tryon'))
+    fake_supabase.insert(TABLE, pending_job('off', job_type='tryoff'))
+
+    jobs = worker.claim_pending_jobs(5)
+
+    assert sorted(job['id'] for job in jobs) == ['legacy', 'on']
+    assert fake_supabase.rows()['off']['status'] == 'pending'
+
+
+def test_claimed_excluded_job_is_released_not_failed(worker, fake_supabase, excluded, monkeypatch):
+    excluded.append('tryoff')
+    processed = []
+    monkeypatch.setattr(worker, "process_job", processed.append)
+    fake_supabase.insert(TABLE, {
+        **pending_job('t', job_type='tryoff'), 'status': 'processing', 'claimed_by': worker.WORKER_ID,
+    })
+
+    assert worker.run_claimed_job(dict(fake_supabase.rows()['t'])) is False
+
+    assert processed == []
+    assert fake_supabase.rows()['t']['status'] == 'pending'
+    assert fake_supabase.rows()['t']['claimed_by'] is None
+
+
+def test_lease_keeper_renews_own_leases_and_requeues_expired(worker, fake_supabase, monkeypatch):
+    monkeypatch.setitem(worker.WORKER_CONFIG, 'HEARTBEAT_INTERVAL_SECONDS', 0.05)
+    expired = (datetime.utcnow() - timedelta(minutes=5)).isoformat()
+    fake_supabase.insert(TABLE, {
+        **pending_job('mine'), 'status': 'processing', 'claimed_by': worker.WORKER_ID, 'lease_expires_at': expired,
+    })
+    fake_supabase.insert(TABLE, {
+        **pending_job('dead'), 'status': 'processing', 'claimed_by': 'worker-muerto', 'lease_expires_at': expired,
+    })
+
+    stop = threading.Event()
+    keeper = threading.Thread(target=worker.lease_keeper_loop, args=(stop,), daemon=True)
+    keeper.start()
+    deadline = datetime.utcnow() + timedelta(seconds=5)
+    while fake_supabase.rows()['dead']['status'] != 'pending' and datetime.utcnow() < deadline:
+        stop.wait(0.02)
+    stop.set()
+    keeper.join(2)
+
+    mine, dead = fake_supabase.rows()['mine'], fake_supabase.rows()['dead']
+    assert mine['status'] == 'processing' and mine['lease_expires_at'] > datetime.utcnow().isoformat()
+    assert dead['status'] == 'pending' and dead['claimed_by'] is None and dead['lease_expires_at'] is None
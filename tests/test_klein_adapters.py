@@ -0,0 +1,94 @@
+"""LoRAs Klein: cambio de adaptador, agrupado de jobs por LoRA y si la instancia sirve try-off"""
+
+import pytest
+
+
+class AdapterPipeline:
+    def __init__(self):
+        self.set_calls = []
+
+    def set_adapters(self, names, adapter_weights=None):
+        self.set_calls.append((names, adapter_weights))
+
+
+@pytest.fixture
+def klein(worker, monkeypatch):
+    monkeypatch.setattr(worker, "UNET_CONFIG", {
+        'model_type': 'klein', 'has_tryon_lora': True,
+        'tryon_lora_name': "flux-klein-tryon.safetensors", 'tryoff_lora_name': "virtual-tryoff-lora.safetensors",
+    })
+    manager = worker.KleinAdapterManager()
+    manager.loaded = {'tryon', 'tryoff'}
+    monkeypatch.setattr(worker, "KLEIN_ADAPTERS", manager)
+    monkeypatch.setattr(worker, "_klein_pipeline", None)
+    return manager
+
+
+def test_activate_switches_only_when_needed(klein):
+    pipeline = AdapterPipeline()
+
+    klein.activate(pipeline, 'tryon')
+    assert klein.activate(pipeline, 'tryon') == 0.0
+    klein.activate(pipeline, 'tryoff')
+
+    assert pipeline.set_calls == [(['tryon'], [1.0]), (['tryoff'], [1.0])]
+    assert klein.active == 'tryoff'
+    assert klein.stats['switches'] == 2
+
+
+def test_activate_unknown_adapter_fails_without_switching(klein):
+    pipeline = AdapterPipeline()
+    klein.activate(pipeline, 'tryon')
+
+    with pytest.raises(Exception, match="no cargada"):
+        klein.activate(pipeline, 'upscale')
+    assert klein.active == 'tryon' and len(pipeline.set_calls) == 1
+
+
+def test_jobs_are_grouped_by_adapter_starting_with_the_active_one(worker, klein):
+    klein.active = 'tryoff'
+    jobs = [
+        {'id': 'on-1', 'job_type': 'tryon'},
+        {'id': 'off-1', 'job_type': 'tryoff'},
+        {'id': 'face', 'job_type': 'face_enhancement'},  # ComfyUI: no fuerza cambio de LoRA
+        {'id': 'on-2'},                                   # job_type NULL = try-on
+        {'id': 'off-2', 'job_type': 'tryoff'},
+    ]
+
+    ordered = [job['id'] for job in worker.group_jobs_by_adapter(jobs)]
+
+    assert ordered == ['off-1', 'face', 'off-2', 'on-1', 'on-2']
+
+
+def test_priority_wins_over_adapter_grouping(worker, klein):
+    klein.active = 'tryon'
+    jobs = [
+        {'id': 'on-low', 'job_type': 'tryon', 'priority': 0},
+        {'id': 'off-high', 'job_type': 'tryoff', 'priority': 5},
+        {'id': 'on-high', 'job_type': 'tryon', 'priority': 5},
+    ]
+
+    assert [job['id'] for job in worker.group_jobs_by_adapter(jobs)] == ['on-high', 'off-high', 'on-low']
+
+
+def test_tryoff_needs_klein_with_its_lora(worker, klein, monkeypatch):
+    assert worker.can_serve_tryoff() and worker.claim_excluded_job_types() == []
+
+    monkeypatch.setitem(worker.UNET_CONFIG, 'tryoff_lora_name', None)
+    assert not worker.can_serve_tryoff()
+    assert worker.claim_excluded_job_types() == ['tryoff']
+
+
+def test_tryoff_unavailable_without_klein(worker, klein, monkeypatch):
+    monkeypatch.setitem(worker.UNET_CONFIG, 'model_type', 'dev')
+    assert not worker.can_serve_tryoff()
+
+
+def test_tryoff_unavailable_when_loaded_pipeline_lacks_the_lora(worker, klein, monkeypatch):
+    # Carga desde el hub: solo trae la LoRA try-on
+    monkeypatch.setattr(worker, "_klein_pipeline", object())
+    klein.loaded = {'tryon'}
+    assert not worker.can_serve_tryoff()
+
+    klein.loaded = {'tryon', 'tryoff'}
+    assert worker.can_serve_tryoff()
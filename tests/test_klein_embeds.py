@@ -0,0 +1,55 @@
+"""Cache de embeddings de Klein: la clave cambia con la cuantización y la LoRA del text encoder"""
+
+import types
+
+import pytest
+
+torch = pytest.importorskip("torch")
+
+
+class EncodingPipeline:
+    def __init__(self, text_encoder=None):
+        self.text_encoder = text_encoder or types.SimpleNamespace()
+        self._execution_device = torch.device("cpu")
+        self.encoded = []
+
+    def encode_prompt(self, prompt, device, num_images_per_prompt):
+        self.encoded.append(prompt)
+        return torch.zeros(1, 4), None
+
+    def __call__(self, prompt_embeds=None):
+        pass
+
+
+@pytest.fixture
+def embeds(worker, monkeypatch):
+    monkeypatch.setattr(worker, "KLEIN_EMBED_CACHE", worker.PromptEmbeddingCache(1024 * 1024))
+    monkeypatch.setattr(worker, "KLEIN_STARTUP_METRICS", {'klein_quant': 'bf16'})
+    monkeypatch.setattr(worker.KLEIN_ADAPTERS, 'active', 'tryon')
+
+
+def test_same_prompt_is_encoded_once(worker, embeds):
+    pipeline = EncodingPipeline()
+    worker.klein_prompt_kwargs(pipeline, "TRYON person")
+    assert worker.klein_prompt_kwargs(pipeline, "TRYON person")['_cache_info']['hit']
+    assert pipeline.encoded == ["TRYON person"]
+
+
+def test_quantization_mode_is_part_of_the_key(worker, embeds):
+    pipeline = EncodingPipeline()
+    worker.klein_prompt_kwargs(pipeline, "TRYON person")
+    worker.KLEIN_STARTUP_METRICS['klein_quant'] = 'fp8'
+
+    assert not worker.klein_prompt_kwargs(pipeline, "TRYON person")['_cache_info']['hit']
+    assert pipeline.encoded == ["TRYON person", "TRYON person"]
+
+
+def test_active_adapter_matters_only_with_text_encoder_lora(worker, embeds, monkeypatch):
+    plain = EncodingPipeline()
+    lora = EncodingPipeline(types.SimpleNamespace(peft_config={'tryon': {}, 'tryoff': {}}))
+
+    plain_tryon, lora_tryon = worker.klein_embed_key(plain, "p"), worker.klein_embed_key(lora, "p")
+    monkeypatch.setattr(worker.KLEIN_ADAPTERS, 'active', 'tryoff')
+
+    assert worker.klein_embed_key(plain, "p") == plain_tryon
+    assert worker.klein_embed_key(lora, "p") != lora_tryon
@@ -0,0 +1,52 @@
+"""klein_local_sources: snapshot diffusers de Klein + LoRAs en KLEIN_PIPELINE_DIR"""
+
+import pytest
+
+
+@pytest.fixture
+def klein_dir(worker, monkeypatch, tmp_path):
+    (tmp_path / "transformer").mkdir()
+    (tmp_path / "loras").mkdir()
+    (tmp_path / "model_index.json").write_text("{}")
+    (tmp_path / "transformer" / "config.json").write_text("{}")
+    (tmp_path / "transformer" / "diffusion_pytorch_model.safetensors").write_bytes(b"")
+    monkeypatch.setitem(worker.WORKER_CONFIG, 'KLEIN_PIPELINE_DIR', str(tmp_path))
+    monkeypatch.setattr(worker, "UNET_CONFIG", {'model_type': 'klein', 'loras_dir': str(tmp_path / "loras")})
+    return tmp_path
+
+
+def test_complete_snapshot(worker, klein_dir):
+    (klein_dir / "loras" / "flux-klein-tryon.safetensors").write_bytes(b"")
+    worker.UNET_CONFIG['tryon_lora_name'] = "flux-klein-tryon.safetensors"
+
+    sources = worker.klein_local_sources()
+
+    assert sources['pipeline_dir'] == str(klein_dir)
+    assert sources['adapters'] == {'tryon': "flux-klein-tryon.safetensors"}
+
+
+def test_missing_tryon_lora_is_reported_by_name(worker, klein_dir, capsys):
+    assert worker.klein_local_sources() is None
+
+    out = capsys.readouterr().out
+    assert "LoRA try-on" in out and "None" not in out
+
+
+def test_missing_files_are_listed(worker, klein_dir, capsys):
+    worker.UNET_CONFIG['tryon_lora_name'] = "flux-klein-tryon.safetensors"
+    (klein_dir / "transformer" / "config.json").unlink()
+
+    assert worker.klein_local_sources() is None
+
+    out = capsys.readouterr().out
+    assert str(klein_dir / "transformer" / "config.json") in out
+    assert str(klein_dir / "loras" / "flux-klein-tryon.safetensors") in out
+
+
+def test_quant_benchmark_requires_klein(worker, monkeypatch, capsys):
+    pytest.importorskip("torch")
+    monkeypatch.setattr(worker, "UNET_CONFIG", {'name': "flux2_dev_fp8mixed.safetensors", 'model_type': 'dev'})
+    monkeypatch.setattr(worker, "build_klein_pipeline", lambda quant: pytest.fail("no debe cargar Klein"))
+
+    assert worker.benchmark_klein_quantization() is None
+    assert "❌ Klein no detectado" in capsys.readouterr().out
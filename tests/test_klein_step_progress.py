@@ -0,0 +1,86 @@
+"""KleinStepProgress: progreso 20% → 50% por step y resumen de it/s con reloj falso"""
+
+import types
+
+import pytest
+
+pytest.importorskip("torch")
+
+
+class StepClock:
+    """perf_counter falso: cada lectura avanza lo que indique el siguiente valor de `steps`"""
+
+    def __init__(self, steps):
+        self.now = 100.0
+        self.steps = list(steps)
+
+    def perf_counter(self):
+        if self.steps:
+            self.now += self.steps.pop(0)
+        return self.now
+
+
+@pytest.fixture
+def progress_log(worker, monkeypatch):
+    log = []
+
+    def record(job_id, progress, message=None):
+        log.append((job_id, progress, message))
+
+    monkeypatch.setattr(worker, "update_job_progress", record)
+    return log
+
+
+def run_steps(worker, monkeypatch, job_ids, total_steps, durations):
+    clock = StepClock([0.0, *durations])
+    monkeypatch.setattr(worker, "time", types.SimpleNamespace(perf_counter=clock.perf_counter))
+    step_progress = worker.KleinStepProgress(job_ids, total_steps)
+    step_progress.start()
+    for step_index in range(len(durations)):
+        assert step_progress(None, step_index, 1000 - step_index, {'latents': step_index}) == {'latents': step_index}
+    return step_progress
+
+
+def test_progress_goes_from_20_to_50_for_every_job(worker, monkeypatch, progress_log):
+    run_steps(worker, monkeypatch, ['a', 'b'], 10, [0.5] * 10)
+
+    assert [progress for job_id, progress, _ in progress_log if job_id == 'a'] == list(range(23, 51, 3))
+    assert [entry for entry in progress_log if entry[0] == 'b'][-1] == ('b', 50, "Step 10/10")
+
+
+def test_progress_is_only_published_when_the_percentage_changes(worker, monkeypatch, progress_log):
+    run_steps(worker, monkeypatch, ['a'], 60, [0.1] * 60)
+
+    progresses = [progress for _, progress, _ in progress_log]
+    assert progresses == sorted(set(progresses))
+    assert progresses[-1] == 50 and len(progresses) == 30
+
+
+def test_metrics_skip_the_first_step(worker, monkeypatch, progress_log):
+    # Primer step lento (preparación + compilación): no cuenta para el it/s
+    step_progress = run_steps(worker, monkeypatch, ['a'], 4, [5.0, 0.5, 0.25, 1.0])
+
+    metrics = step_progress.metrics()
+
+    assert metrics['steps'] == 4
+    assert metrics['first_step_s'] == 5.0
+    assert metrics['mean_it_s'] == round(3 / 1.75, 3)
+    assert (metrics['min_it_s'], metrics['p50_it_s'], metrics['max_it_s']) == (1.0, 2.0, 4.0)
+
+
+def test_histogram_buckets(worker, monkeypatch, progress_log):
+    step_progress = run_steps(worker, monkeypatch, ['a'], 6, [1.0, 4.0, 1.0, 0.75, 0.4, 0.1])
+
+    # it/s: 0.25, 1, 1.33, 2.5, 10
+    assert step_progress.metrics()['it_s_histogram'] == {'0-0.5': 1, '1-2': 2, '2-4': 1, '>=8': 1}
+
+
+def test_single_step_is_used_for_metrics(worker, monkeypatch, progress_log):
+    step_progress = run_steps(worker, monkeypatch, ['a'], 1, [0.5])
+
+    metrics = step_progress.metrics()
+    assert metrics['steps'] == 1 and metrics['mean_it_s'] == 2.0
+
+
+def test_no_steps_no_metrics(worker):
+    assert worker.KleinStepProgress(['a'], 28).metrics() == {}
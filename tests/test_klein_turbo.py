@@ -0,0 +1,87 @@
+"""enable_klein_turbo con un pipeline Klein mini en CPU: caches de Inductor y vuelta a eager si compilar falla"""
+
+import types
+
+import pytest
+
+torch = pytest.importorskip("torch")
+
+
+class TinyKleinPipeline:
+    """Misma interfaz que Flux2KleinPipeline para el benchmark: transformer, vae.decoder y callback por step"""
+
+    def __init__(self):
+        self.transformer = torch.nn.Linear(8, 8)
+        self.vae = types.SimpleNamespace(decoder=torch.nn.Linear(8, 8))
+        self._execution_device = torch.device("cpu")
+        self.calls = []
+
+    def __call__(self, image, prompt, height, width, num_inference_steps, guidance_scale,
+                 generator, callback_on_step_end=None):
+        self.calls.append(len(image))
+        latents = torch.randn(len(image), 8, generator=generator)
+        for step in range(num_inference_steps):
+            latents = self.transformer(latents)
+            if callback_on_step_end is not None:
+                callback_on_step_end(self, step, step, {})
+        return types.SimpleNamespace(images=[self.vae.decoder(latents)])
+
+
+@pytest.fixture
+def turbo_env(worker, monkeypatch, tmp_path):
+    monkeypatch.setitem(worker.WORKER_CONFIG, 'KLEIN_COMPILE_CACHE_DIR', str(tmp_path / "compile"))
+    monkeypatch.setattr(worker.KLEIN_ADAPTERS, 'loaded', set())
+    yield
+    torch._dynamo.reset()
+
+
+def test_compile_failure_restores_eager_modules(worker, turbo_env, monkeypatch):
+    import torch._inductor.compile_fx as compile_fx
+
+    def broken_compile_fx(*args, **kwargs):
+        raise RuntimeError("inductor roto a propósito")
+
+    monkeypatch.setattr(compile_fx, "compile_fx", broken_compile_fx)
+    pipeline = TinyKleinPipeline()
+    eager_transformer, eager_decoder = pipeline.transformer, pipeline.vae.decoder
+
+    metrics = worker.enable_klein_turbo(pipeline, height=16, width=16, steps=2)
+
+    assert metrics['compiled'] is False
+    assert "inductor roto" in metrics['error']
+    assert 'eager_step_s' in metrics
+    assert pipeline.transformer is eager_transformer
+    assert pipeline.vae.decoder is eager_decoder
+
+    # El pipeline restaurado sigue generando en eager
+    worker._klein_step_seconds(pipeline, 16, 16, 2)
+    assert pipeline.calls[-1] == 3
+
+
+def test_inductor_cache_is_configured_directly(worker, turbo_env, monkeypatch, tmp_path):
+    import torch._inductor.config as inductor_config
+
+    monkeypatch.setattr(inductor_config, "fx_graph_cache", False)
+    monkeypatch.setenv("TORCHINDUCTOR_CACHE_DIR", "/tmp/otra-cache")  # p.ej. ya fijada por una compilación previa
+
+    worker.configure_inductor_cache(str(tmp_path / "compile"))
+
+    assert inductor_config.fx_graph_cache is True
+    from torch._inductor.runtime.cache_dir_utils import cache_dir
+    assert cache_dir() == str(tmp_path / "compile")
+
+
+def test_each_adapter_is_compiled_with_its_image_count(worker, turbo_env, monkeypatch):
+    activations = []
+    monkeypatch.setattr(worker.KLEIN_ADAPTERS, 'loaded', {'tryon', 'tryoff'})
+    monkeypatch.setattr(worker.KLEIN_ADAPTERS, 'activate', lambda pipeline, adapter: activations.append(adapter))
+    monkeypatch.setattr(torch, "compile", lambda module, **kwargs: module)  # sin Inductor: solo el orden
+
+    pipeline = TinyKleinPipeline()
+    metrics = worker.enable_klein_turbo(pipeline, height=16, width=16, steps=2)
+
+    assert metrics['compiled'] is True
+    assert set(metrics['compile_seconds']) == {'tryon', 'tryoff'}
+    # eager (try-on), variante try-on, variante try-off, benchmark compilado (try-on)
+    assert pipeline.calls == [3, 3, 1, 3]
+    assert activations == ['tryon', 'tryoff', 'tryon']
@@ -0,0 +1,80 @@
+"""Latentes subidos a ComfyUI: se vuelven a subir si ComfyUI los perdió (reinicio)"""
+
+import types
+
+import pytest
+
+
+class FakeComfyHTTP:
+    """POST /prompt falso: rechaza LoadLatent mientras su .latent no se haya (re)subido"""
+
+    def __init__(self):
+        self.inputs = set()
+        self.prompts = 0
+
+    def post(self, path, json=None, timeout=None, **kwargs):
+        self.prompts += 1
+        missing = {
+            node_id: {'class_type': node['class_type'], 'errors': [{'type': 'value_not_in_list'}]}
+            for node_id, node in json['prompt'].items()
+            if node['class_type'] == 'LoadLatent' and node['inputs']['latent'] not in self.inputs
+        }
+        if missing:
+            body = {'error': {'type': 'prompt_outputs_failed_validation'}, 'node_errors': missing}
+            return types.SimpleNamespace(status_code=400, json=lambda: body, text=str(body))
+        return types.SimpleNamespace(status_code=200, json=lambda: {'prompt_id': "p-1"}, text="")
+
+
+@pytest.fixture
+def endpoint(worker, monkeypatch, tmp_path):
+    cache = worker.LatentCache(tmp_path / "latents", 1024 * 1024)
+    monkeypatch.setattr(worker, "LATENT_CACHE", cache)
+    endpoint = types.SimpleNamespace(url="http://comfy", http=FakeComfyHTTP(), uploaded_latents=set(), events=None)
+
+    def fake_upload(target, filename, data):
+        target.http.inputs.add(filename)
+        return filename
+
+    monkeypatch.setattr(worker, "upload_comfy_input", fake_upload)
+    return endpoint
+
+
+def load_latent_workflow(worker, endpoint, key):
+    return {"40": {"inputs": {"latent": worker.ensure_comfy_latent(endpoint, key)}, "class_type": "LoadLatent"}}
+
+
+def test_restarted_comfy_gets_latents_reuploaded(worker, endpoint):
+    worker.LATENT_CACHE.put("k1", b"latent")
+    workflow = load_latent_workflow(worker, endpoint, "k1")
+    endpoint.http.inputs.clear()  # ComfyUI reiniciado: input/ vacío, uploaded_latents obsoleto
+
+    assert worker.submit_comfy_prompt("job-1", endpoint, workflow) == "p-1"
+    assert endpoint.http.prompts == 2
+    assert "lat_k1.latent" in endpoint.http.inputs
+    assert endpoint.uploaded_latents == {"k1"}
+
+
+def test_evicted_latent_fails_without_retry(worker, endpoint):
+    worker.LATENT_CACHE.put("k1", b"latent")
+    workflow = load_latent_workflow(worker, endpoint, "k1")
+    endpoint.http.inputs.clear()
+    worker.LATENT_CACHE._entries.clear()
+
+    with pytest.raises(Exception, match="400"):
+        worker.submit_comfy_prompt("job-1", endpoint, workflow)
+    assert endpoint.http.prompts == 1
+    assert "k1" not in endpoint.uploaded_latents
+
+
+def test_other_validation_errors_are_not_retried(worker, endpoint):
+    workflow = {"9": {"inputs": {}, "class_type": "SaveImage"}}
+
+    def reject(path, json=None, timeout=None, **kwargs):
+        endpoint.http.prompts += 1
+        body = {'node_errors': {"9": {'class_type': 'SaveImage', 'errors': []}}}
+        return types.SimpleNamespace(status_code=400, json=lambda: body, text=str(body))
+
+    endpoint.http.post = reject
+    with pytest.raises(Exception):
+        worker.submit_comfy_prompt("job-1", endpoint, workflow)
+    assert endpoint.http.prompts == 1
@@ -0,0 +1,99 @@
+"""Publicador de progreso coalescente: un UPDATE por intervalo con el último valor de cada job"""
+
+import threading
+import time
+
+import pytest
+
+TABLE = 'ai_generation_jobs'
+
+
+@pytest.fixture
+def publisher(worker, fake_supabase, monkeypatch):
+    """Publicador con estado propio e intervalo corto sobre el Supabase falso"""
+    monkeypatch.setitem(worker.WORKER_CONFIG, 'PROGRESS_MIN_INTERVAL_SECONDS', 0.3)
+    monkeypatch.setattr(worker, "_progress_pending", {})
+    monkeypatch.setattr(worker, "_progress_last_write", {})
+    monkeypatch.setattr(worker, "_progress_writing", set())
+    monkeypatch.setattr(worker, "_progress_cond", threading.Condition())
+    for job_id in ('j1', 'j2'):
+        fake_supabase.insert(TABLE, {'id': job_id, 'status': 'processing'})
+    worker.start_progress_publisher()
+    return fake_supabase
+
+
+def written(server, job_id):
+    return [(values['progress'], values.get('result_metadata', {}).get('status_message'))
+            for table, values, ids in server.updates if 'progress' in values and job_id in ids]
+
+
+def wait_until(predicate, timeout=3):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if predicate():
+            return True
+        time.sleep(0.01)
+    return False
+
+
+def test_burst_is_coalesced_into_latest_value(worker, publisher):
+    worker.update_job_progress('j1', 10, "Descargando")
+    assert wait_until(lambda: written(publisher, 'j1'))
+
+    for step in range(20, 90, 10):
+        worker.update_job_progress('j1', step, f"Step {step}")
+    assert wait_until(lambda: len(written(publisher, 'j1')) == 2)
+    time.sleep(0.4)
+
+    assert written(publisher, 'j1') == [(10, "Descargando"), (80, "Step 80")]
+
+
+def test_jobs_are_throttled_independently(worker, publisher):
+    worker.update_job_progress('j1', 10)
+    worker.update_job_progress('j2', 30)
+
+    assert wait_until(lambda: written(publisher, 'j1') and written(publisher, 'j2'))
+    assert written(publisher, 'j2') == [(30, None)]
+
+
+def test_pending_message_survives_update_without_message(worker, publisher):
+    worker.update_job_progress('j1', 10, "Descargando")
+    assert wait_until(lambda: written(publisher, 'j1'))
+
+    worker.update_job_progress('j1', 40, "Generando")
+    worker.update_job_progress('j1', 50)
+    assert wait_until(lambda: len(written(publisher, 'j1')) == 2)
+
+    assert written(publisher, 'j1')[-1] == (50, "Generando")
+
+
+def test_finish_drops_pending_progress(worker, publisher):
+    worker.update_job_progress('j1', 10)
+    assert wait_until(lambda: written(publisher, 'j1'))
+
+    worker.update_job_progress('j1', 60)  # aún dentro del intervalo: pendiente
+    worker.finish_job_progress('j1')
+    time.sleep(0.5)
+
+    assert written(publisher, 'j1') == [(10, None)]
+
+
+def test_progress_never_overwrites_finished_job(worker, publisher):
+    publisher.rows()['j1']['status'] = 'completed'
+    worker.update_job_progress('j1', 97)
+    assert wait_until(lambda: publisher.updates)
+
+    assert 'progress' not in publisher.rows()['j1']
+    assert written(publisher, 'j1') == []
+
+
+def test_progress_is_capped_below_100(worker, publisher):
+    worker.update_job_progress('j1', 100)
+    assert wait_until(lambda: written(publisher, 'j1'))
+    assert publisher.rows()['j1']['progress'] == 99
+
+
+def test_warmup_jobs_are_not_published(worker, publisher):
+    worker.update_job_progress(f"{worker.WARMUP_JOB_PREFIX}flux", 50)
+    time.sleep(0.3)
+    assert worker._progress_pending == {} and publisher.updates == []
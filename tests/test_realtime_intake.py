@@ -0,0 +1,217 @@
+"""Intake push: suscripción Realtime filtrada, JOB_WAKEUP y poll de seguridad"""
+
+import threading
+import time
+
+import pytest
+
+
+class FakeRealtime:
+    """
+    Stand-in de Supabase Realtime sobre PostgREST: guarda las suscripciones
+    postgres_changes y aplica su filtro (`columna=eq.valor`) a cada INSERT.
+    """
+
+    def __init__(self):
+        self.subscriptions = []
+        self.is_connected = True
+        self.closed = False
+        self.fail_subscribe = False
+        self.closes = 0
+
+    def insert(self, table, row):
+        for sub in self.subscriptions:
+            if sub['event'] in ('INSERT', '*') and sub['table'] == table and self._matches(sub['filter'], row):
+                sub['callback']({'data': {'type': 'INSERT', 'table': table, 'record': row}})
+
+    @staticmethod
+    def _matches(filter_expr, row):
+        if not filter_expr:
+            return True
+        column, expr = filter_expr.split('=', 1)
+        op, value = expr.split('.', 1)
+        assert op == 'eq', f"operador no soportado por el stand-in: {op}"
+        return str(row.get(column)) == value
+
+    async def close(self):
+        self.closes += 1
+
+
+class FakeChannel:
+    def __init__(self, server):
+        self.server = server
+
+    def on_postgres_changes(self, event, schema, table, filter=None, callback=None):
+        self.server.subscriptions.append(
+            {'event': event, 'schema': schema, 'table': table, 'filter': filter, 'callback': callback}
+        )
+        return self
+
+    async def subscribe(self, callback):
+        if self.server.fail_subscribe:
+            raise ConnectionError("suscripción rechazada")
+        callback('SUBSCRIBED')
+        return self
+
+
+class FakeAsyncClient:
+    def __init__(self, server):
+        self.realtime = server
+
+    def channel(self, name):
+        return FakeChannel(self.realtime)
+
+    async def remove_all_channels(self):
+        self.realtime.subscriptions.clear()
+
+
+@pytest.fixture
+def realtime(worker, monkeypatch):
+    server = FakeRealtime()
+
+    async def acreate_client(url, key):
+        if server.closed:
+            raise ConnectionError("stand-in cerrado")
+        return FakeAsyncClient(server)
+
+    monkeypatch.setattr(worker, "JOB_WAKEUP", threading.Event())
+    threading.Thread(target=worker._realtime_intake_thread, args=(acreate_client,), daemon=True).start()
+
+    deadline = time.time() + 5
+    while not server.subscriptions and time.time() < deadline:
+        time.sleep(0.01)
+    assert server.subscriptions, "el worker no llegó a suscribirse"
+    assert worker.REALTIME_INTAKE_HEALTHY
+    worker.JOB_WAKEUP.clear()  # el SUBSCRIBED despierta al loop una vez
+    yield server
+    server.closed = True
+    server.is_connected = False
+    monkeypatch.setattr(worker, "REALTIME_INTAKE_HEALTHY", False)
+
+
+def test_subscribes_to_vast_inserts_only(realtime):
+    sub, = realtime.subscriptions
+    assert sub['event'] == 'INSERT'
+    assert (sub['schema'], sub['table']) == ('public', 'ai_generation_jobs')
+    assert sub['filter'] == 'preferred_backend=eq.vast'
+
+
+def test_insert_for_other_backend_does_not_wake(worker, realtime):
+    realtime.insert('ai_generation_jobs', {'id': 'j1', 'status': 'pending', 'preferred_backend': 'fal'})
+    assert not worker.JOB_WAKEUP.is_set()
+
+
+def test_pending_vast_insert_wakes_main_loop(worker, realtime, monkeypatch):
+    monkeypatch.setitem(worker.WORKER_CONFIG, 'SAFETY_POLL_INTERVAL_SECONDS', 10)
+
+    def insert_later():
+        time.sleep(0.1)
+        realtime.insert('ai_generation_jobs', {'id': 'j2', 'status': 'pending', 'preferred_backend': 'vast'})
+
+    threading.Thread(target=insert_later, daemon=True).start()
+    start = time.time()
+    assert worker.wait_for_new_jobs() is True
+    assert time.time() - start < 2
+    assert not worker.JOB_WAKEUP.is_set()  # se limpia para el siguiente wait
+
+
+def test_non_pending_vast_insert_does_not_wake(worker, realtime):
+    realtime.insert('ai_generation_jobs', {'id': 'j3', 'status': 'completed', 'preferred_backend': 'vast'})
+    assert not worker.JOB_WAKEUP.is_set()
+
+
+class RecordingEvent:
+    """JOB_WAKEUP que no duerme: registra el timeout con el que espera el loop"""
+
+    def __init__(self):
+        self.timeouts = []
+
+    def wait(self, timeout):
+        self.timeouts.append(timeout)
+        return False
+
+    def clear(self):
+        pass
+
+
+def test_safety_poll_interval_with_healthy_realtime(worker, monkeypatch):
+    event = RecordingEvent()
+    monkeypatch.setattr(worker, "JOB_WAKEUP", event)
+    monkeypatch.setattr(worker, "REALTIME_INTAKE_HEALTHY", True)
+
+    assert worker.wait_for_new_jobs() is False
+    assert event.timeouts == [30]
+
+
+def test_plain_polling_when_realtime_is_down(worker, monkeypatch):
+    event = RecordingEvent()
+    monkeypatch.setattr(worker, "JOB_WAKEUP", event)
+    monkeypatch.setattr(worker, "REALTIME_INTAKE_HEALTHY", False)
+
+    worker.wait_for_new_jobs()
+    assert event.timeouts == [worker.WORKER_CONFIG['POLL_INTERVAL_SECONDS']]
+
+
+def test_safety_poll_returns_without_event(worker, monkeypatch):
+    monkeypatch.setattr(worker, "JOB_WAKEUP", threading.Event())
+    monkeypatch.setattr(worker, "REALTIME_INTAKE_HEALTHY", True)
+    monkeypatch.setitem(worker.WORKER_CONFIG, 'SAFETY_POLL_INTERVAL_SECONDS', 0.2)
+
+    start = time.time()
+    assert worker.wait_for_new_jobs() is False
+    assert 0.15 < time.time() - start < 2
+
+
+def test_insert_wakes_two_workers_but_only_one_claims(worker, realtime, fake_supabase, monkeypatch):
+    monkeypatch.setattr(worker, "CLAIM_RPC_AVAILABLE", False)  # UPDATE condicional
+    monkeypatch.setattr(worker, "claim_excluded_job_types", lambda: [])
+    # Los dos workers ven el mismo candidato antes de lanzar su UPDATE
+    barrier = threading.Barrier(2)
+    fake_supabase.after_select = lambda: barrier.wait(5)
+    claims = []
+
+    def worker_loop():
+        assert worker.JOB_WAKEUP.wait(5)
+        claims.append(worker.claim_pending_jobs(5))
+
+    threads = [threading.Thread(target=worker_loop, daemon=True) for _ in range(2)]
+    for thread in threads:
+        thread.start()
+
+    row = {'id': 'j-race', 'status': 'pending', 'preferred_backend': 'vast', 'priority': 0,
+           'created_at': "2026-01-01T00:00:00", 'claimed_by': None}
+    fake_supabase.insert('ai_generation_jobs', row)
+    realtime.insert('ai_generation_jobs', row)
+    for thread in threads:
+        thread.join(5)
+
+    assert sorted(len(jobs) for jobs in claims) == [0, 1]
+    winner, = [jobs for jobs in claims if jobs]
+    assert winner[0]['id'] == 'j-race'
+    assert fake_supabase.rows()['j-race']['status'] == 'processing'
+    # Los dos UPDATE llegaron a la BD; solo uno encontró la fila en pending
+    claims_sent = [ids for table, values, ids in fake_supabase.updates if values.get('status') == 'processing']
+    assert sorted(claims_sent) == [[], ['j-race']]
+
+
+def test_failed_connection_closes_client_before_reconnecting(worker, monkeypatch):
+    server = FakeRealtime()
+    server.fail_subscribe = True
+    clients = []
+
+    async def acreate_client(url, key):
+        if server.closed:
+            raise ConnectionError("stand-in cerrado")
+        clients.append(FakeAsyncClient(server))
+        return clients[-1]
+
+    monkeypatch.setattr(worker, "JOB_WAKEUP", threading.Event())
+    threading.Thread(target=worker._realtime_intake_thread, args=(acreate_client,), daemon=True).start()
+
+    deadline = time.time() + 5
+    while not server.closes and time.time() < deadline:
+        time.sleep(0.01)
+    server.closed = True
+    assert len(clients) == 1 and server.closes == 1
+    assert server.subscriptions == []  # canales del cliente viejo eliminados
+    assert not worker.REALTIME_INTAKE_HEALTHY
@@ -0,0 +1,140 @@
+"""VramArbiter: Klein sale a RAM fuera del lock y nadie entra mientras tanto; reservas de ComfyUI en ejecución"""
+
+import threading
+import time
+import types
+
+import pytest
+
+torch = pytest.importorskip("torch")
+
+
+class SlowPipeline:
+    """Stand-in de Klein: .to("cpu") tarda hasta que el test abre `gate`"""
+
+    def __init__(self):
+        self.gate = threading.Event()
+        self.devices = []
+
+    def to(self, device):
+        self.devices.append(device)
+        assert self.gate.wait(5)
+        return self
+
+
+@pytest.fixture
+def arbiter(worker, monkeypatch):
+    pipeline = SlowPipeline()
+    monkeypatch.setattr(worker, "_klein_pipeline", pipeline)
+    arbiter = worker.VramArbiter({'klein': 10, 'comfy_image': 30, 'comfy_video': 45}, 2, 5)
+    arbiter.enabled = True
+    arbiter.total_gb = 48
+    arbiter.klein_resident_gb = 10
+    arbiter.pipeline = pipeline
+    return arbiter
+
+
+def run_in_thread(fn):
+    result = {}
+    thread = threading.Thread(target=lambda: result.setdefault('value', fn()), daemon=True)
+    thread.start()
+    return thread, result
+
+
+def test_offload_runs_outside_the_lock_and_holds_admissions(arbiter):
+    video, video_result = run_in_thread(lambda: arbiter.acquire('comfy_video'))
+    deadline = time.time() + 5
+    while not arbiter.klein_offloading and time.time() < deadline:
+        time.sleep(0.01)
+    assert arbiter.klein_offloading and arbiter.pipeline.devices == ["cpu"]
+
+    # El lock queda libre durante la transferencia (report/release no se bloquean)...
+    assert arbiter._cond.acquire(timeout=1)
+    arbiter._cond.release()
+
+    # ...pero nadie es admitido hasta que Klein termina de salir
+    image, image_result = run_in_thread(lambda: arbiter.acquire('comfy_image'))
+    image.join(0.3)
+    assert image.is_alive()
+
+    arbiter.pipeline.gate.set()
+    video.join(5)
+    assert video_result['value'] == ('comfy_video', 1)
+    assert arbiter.klein_offloaded and not arbiter.klein_offloading
+    assert arbiter.stats['klein_offloads'] == 1
+
+    # Video (45) + imagen (30) no caben en 46 GB: la imagen espera al video
+    image.join(0.3)
+    assert image.is_alive()
+    arbiter.release(video_result['value'])
+    image.join(5)
+    assert image_result['value'] == ('comfy_image', 1)
+
+
+def test_failed_offload_is_not_retried(arbiter, monkeypatch):
+    def broken_to(device):
+        raise RuntimeError("sin RAM")
+
+    monkeypatch.setattr(arbiter.pipeline, "to", broken_to)
+    token = arbiter.acquire('comfy_video')  # nada activo: entra aunque no quepa
+
+    assert token == ('comfy_video', 1)
+    assert not arbiter.klein_offloaded and not arbiter.klein_offloading
+    assert arbiter._offload_failed
+    assert not arbiter._klein_offloadable()
+
+
+def test_reload_counts_klein_as_resident_during_the_transfer(arbiter, monkeypatch):
+    monkeypatch.setattr(torch.cuda, "synchronize", lambda: None)
+    arbiter.klein_offloaded = True
+    states = []
+
+    def to(device):
+        # Moviéndose a la GPU: ya cuenta como residente y el lock está libre
+        assert arbiter._cond.acquire(timeout=1)
+        states.append(arbiter.klein_offloaded)
+        arbiter._cond.release()
+        return arbiter.pipeline
+
+    arbiter.pipeline.to = to
+    arbiter._reload_klein()
+
+    assert states == [False]
+    assert not arbiter.klein_offloaded and arbiter.stats['klein_reloads'] == 1
+
+
+def test_failed_reload_keeps_klein_offloaded(arbiter):
+    arbiter.klein_offloaded = True
+
+    def broken_to(device):
+        raise RuntimeError("OOM")
+
+    arbiter.pipeline.to = broken_to
+    with pytest.raises(RuntimeError):
+        arbiter._reload_klein()
+
+    assert arbiter.klein_offloaded and arbiter.stats['klein_reloads'] == 0
+
+
+def test_reserve_while_running_starts_at_on_start(arbiter):
+    with arbiter.reserve_while_running('comfy_image') as on_start:
+        assert not any(arbiter._active.values())
+        on_start()
+        assert arbiter._active['comfy_image'] == [1]
+    assert arbiter._active['comfy_image'] == []
+
+
+def test_running_comfy_is_registered_without_waiting(arbiter):
+    video = arbiter.acquire('comfy_video')
+
+    # Ya ejecuta en ComfyUI: no espera hueco aunque no quepa junto al video
+    token = arbiter.occupy('comfy_image')
+
+    assert token == ('comfy_image', 1)
+    assert not arbiter._fits('klein', 1)
+    arbiter.release(token)
+    arbiter.release(video)
+
+
+def test_remote_comfy_is_not_arbitrated(arbiter):
+    assert arbiter.occupy('comfy_image', endpoint=types.SimpleNamespace(is_local=False)) is None
@@ -9,10 +9,19 @@ import os
 import sys
 import time
 import json
+import queue
+import threading
 import requests
-from datetime import datetime
+from contextlib import contextmanager
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from datetime import datetime, timedelta
 from supabase import create_client, Client
 import base64
+import hashlib
+import io
+import mmap
+import tempfile
 from pathlib import Path
 from PIL import Image
 
@@ -27,12 +36,68 @@ WORKER_ID = os.getenv("WORKER_ID", f"vast-worker-{int(time.time())}")
 # Template vastai/comfy: puerto 18188
 COMFY_URL = os.getenv("COMFYUI_API_BASE", "http://127.0.0.1:18188")
 
+# Pool de ComfyUI (varias GPUs / máquinas): COMFY_URLS="http://gpu1:8188,http://gpu2:8188"
+# Sin definir → solo COMFY_URL. El primero es el primario (detección de nodos/modelos)
+COMFY_URLS = [
+    url.strip().rstrip('/') for url in os.getenv("COMFY_URLS", COMFY_URL).split(',') if url.strip()
+]
+COMFY_URL = COMFY_URLS[0]
+
+MAX_TRYON_GARMENTS = 5       # Kontext acepta hasta 5 prendas
+MAX_KLEIN_GARMENTS = 2       # Klein: top + bottom
+
 WORKER_CONFIG = {
     'POLL_INTERVAL_SECONDS': 5,      # Polling cada 5s
     'MAX_BATCH_SIZE': 12,            # Máximo 12 jobs simultáneos
     'MIN_BATCH_SIZE': 1,             # Mínimo 1 (FCFS)
     'JOB_TIMEOUT_SECONDS': 300,      # Timeout 5 minutos
     'HEARTBEAT_INTERVAL_SECONDS': 30, # Heartbeat cada 30s
+    'JOB_LEASE_SECONDS': 120,        # Lease de cada job reclamado (se renueva cada heartbeat)
+    'JOB_INTAKE_MODE': os.getenv("JOB_INTAKE_MODE", "realtime"),  # 'realtime' (push) o 'poll'
+    'SAFETY_POLL_INTERVAL_SECONDS': 30,  # Poll de seguridad con Realtime activo (eventos perdidos)
+    'PREFETCH_DEPTH': 2,             # Jobs por delante con inputs descargados mientras la GPU trabaja
+    'PREFETCH_WORKERS': 2,           # Hilos de descarga del prefetch
+    'COMFY_PIPELINE_DEPTH': 2,       # Prompts ComfyUI encolados por delante del job actual
+    'MAX_CONCURRENT_JOBS': int(os.getenv("MAX_CONCURRENT_JOBS", "4")),  # Jobs ejecutándose a la vez
+    'PROGRESS_MIN_INTERVAL_SECONDS': 2,  # Mínimo entre UPDATEs de progreso de un mismo job
+    # max_wait de cada prompt cuenta desde que ComfyUI empieza a ejecutarlo;
+    # esperando en cola (detrás de otros prompts) el límite es este
+    'COMFY_QUEUE_MAX_WAIT_SECONDS': int(os.getenv("COMFY_QUEUE_MAX_WAIT_SECONDS", "1800")),
+    # Cache en disco de descargas (prendas de catálogo, avatares): 0 MB = desactivada
+    'DOWNLOAD_CACHE_DIR': os.getenv("DOWNLOAD_CACHE_DIR", "/workspace/cache/downloads"),
+    'DOWNLOAD_CACHE_MAX_MB': int(os.getenv("DOWNLOAD_CACHE_MAX_MB", "2048")),
+    'DOWNLOAD_CACHE_FRESH_SECONDS': 300,  # Sin revalidar (cero red) durante este tiempo
+    'DOWNLOAD_WORKERS': 8,           # Descargas en paralelo (todas las imágenes de un job a la vez)
+    'AVATAR_CACHE_TTL_SECONDS': 300, # Análisis Grok del avatar (virtual_avatars) en memoria
+    'AVATAR_CACHE_MAX_USERS': 1000,
+    # Cache de latentes VAE de referencia (Kontext): 0 MB = desactivada
+    'LATENT_CACHE_DIR': os.getenv("LATENT_CACHE_DIR", "/workspace/cache/latents"),
+    'LATENT_CACHE_MAX_MB': int(os.getenv("LATENT_CACHE_MAX_MB", "1024")),
+    'KLEIN_EMBED_CACHE_MB': int(os.getenv("KLEIN_EMBED_CACHE_MB", "512")),  # Embeddings de prompt Klein en VRAM (0 = off)
+    # Turbo: torch.compile de Klein (transformer + decoder VAE) con cache de Inductor en disco
+    'KLEIN_TURBO': os.getenv("KLEIN_TURBO", "0") == "1",
+    # Pesos de Klein: 'auto' (según VRAM), 'bf16', 'fp8' o 'int8' (torchao, weight-only)
+    'KLEIN_QUANT': os.getenv("KLEIN_QUANT", "auto"),
+    'KLEIN_COMPILE_CACHE_DIR': os.getenv("KLEIN_COMPILE_CACHE_DIR", "/workspace/cache/torch_compile"),
+    # Componentes diffusers de Klein (configs, tokenizer, text encoder, VAE) descargados por
+    # provision-looks.sh; el transformer y las LoRAs se leen de /workspace/ComfyUI/models
+    'KLEIN_PIPELINE_DIR': os.getenv("KLEIN_PIPELINE_DIR", "/workspace/models/flux2-klein-base-9b"),
+    # Árbitro de VRAM entre Klein (este proceso) y el ComfyUI local (otro proceso)
+    'VRAM_ARBITER': os.getenv("VRAM_ARBITER", "1") == "1",
+    'VRAM_PEAK_GB': {  # Pico conocido por tipo de trabajo (Klein: activaciones por imagen; ComfyUI: modelos + activaciones)
+        'klein': float(os.getenv("VRAM_PEAK_KLEIN_GB", "10")),
+        'comfy_image': float(os.getenv("VRAM_PEAK_COMFY_IMAGE_GB", "30")),
+        'comfy_video': float(os.getenv("VRAM_PEAK_COMFY_VIDEO_GB", "45")),
+    },
+    'VRAM_HEADROOM_GB': 2,           # Margen para fragmentación / contexto CUDA
+    'VRAM_ADMISSION_TIMEOUT_SECONDS': 180,  # Tras esto el trabajo entra igualmente (mejor que bloquear)
+    # Slots por recurso: cuántos jobs pueden usar cada recurso a la vez
+    'RESOURCE_SLOTS': {
+        'klein': 1,                                               # Pipeline diffusers Klein (no reentrante)
+        'comfy_image': int(os.getenv("SLOTS_COMFY_IMAGE", "3")),  # Prompts de imagen en cola de ComfyUI
+        'comfy_video': int(os.getenv("SLOTS_COMFY_VIDEO", "1")),  # Renders LTX en ComfyUI
+        'io': int(os.getenv("SLOTS_IO", "6")),                    # Descargas / subidas a Storage
+    },
 }
 
 # ============================================
@@ -40,6 +105,30 @@ WORKER_CONFIG = {
 # Prioridad: Klein 9B (try-on LoRA) > NVFP4 > fp8
 # ============================================
 
+def detect_gpu():
+    """(VRAM total en GB, compute capability) de la GPU 0; (None, None) si no se puede leer"""
+    try:
+        import torch
+        props = torch.cuda.get_device_properties(0)
+        return round(props.total_memory / 1024 ** 3, 1), (props.major, props.minor)
+    except Exception as e:
+        print(f"   ⚠️ No se pudo leer la GPU: {e}")
+        return None, None
+
+
+def select_klein_quant(vram_gb, capability):
+    """
+    bf16 con 80GB+ (Klein, LTX y Gemma residentes). Por debajo (tarjetas de 48GB)
+    pesos cuantizados: fp8 si la GPU lo soporta en hardware (Ada / Hopper, sm_89+), si no int8.
+    """
+    forced = WORKER_CONFIG['KLEIN_QUANT']
+    if forced != 'auto':
+        return forced
+    if vram_gb is None or vram_gb >= 80:
+        return 'bf16'
+    return 'fp8' if capability and capability >= (8, 9) else 'int8'
+
+
 def get_optimal_unet_config():
     """Detecta el mejor modelo disponible (prioriza Klein 9B para try-on LoRA)"""
     models_dir = "/workspace/ComfyUI/models/diffusion_models"
@@ -71,21 +160,39 @@ def get_optimal_unet_config():
                 print(f"   🎬 LTX Video: {f}")
                 break
     
+    # Klein en formato diffusers (base-9B + LoRAs diffusers, de provision-looks.sh).
+    # Las LoRAs *_comfy de models/loras no sirven a diffusers: solo indican que hay try-on
+    klein_dir = WORKER_CONFIG['KLEIN_PIPELINE_DIR']
+    klein_loras_dir = os.path.join(klein_dir, "loras")
+    klein_loras = sorted(f for f in os.listdir(klein_loras_dir) if f.endswith('.safetensors')) if os.path.isdir(klein_loras_dir) else []
+    if klein_loras:
+        print(f"   LoRAs Klein (diffusers): {klein_loras}")
+    
     # Prioridad: Klein 9B (para LoRAs try-on/try-off) > NVFP4 > fp8
-    klein_names = ["flux2-klein-9b.safetensors", "flux2-klein-base-9b.safetensors"]
+    klein_names = ["flux2-klein-base-9b.safetensors", "flux2-klein-9b.safetensors"]
     klein_found = None
+    if os.path.exists(os.path.join(klein_dir, "model_index.json")):
+        klein_found = os.path.basename(klein_dir.rstrip('/'))
     for name in klein_names:
-        if os.path.exists(f"{models_dir}/{name}"):
+        if not klein_found and os.path.exists(f"{models_dir}/{name}"):
             klein_found = name
-            break
     
     if klein_found:
-        has_tryon_lora = any('tryon' in f.lower() for f in loras)
-        has_tryoff_lora = any('tryoff' in f.lower() or 'try-off' in f.lower() for f in loras)
-        tryon_lora_name = next((f for f in loras if 'tryon' in f.lower()), None)
-        tryoff_lora_name = next((f for f in loras if 'tryoff' in f.lower() or 'try-off' in f.lower()), None)
+        def is_tryon(f):
+            return 'tryon' in f.lower()
         
+        def is_tryoff(f):
+            return 'tryoff' in f.lower() or 'try-off' in f.lower()
+        
+        has_tryon_lora = any(is_tryon(f) for f in klein_loras + loras)
+        has_tryoff_lora = any(is_tryoff(f) for f in klein_loras + loras)
+        tryon_lora_name = next((f for f in klein_loras if is_tryon(f)), None)
+        tryoff_lora_name = next((f for f in klein_loras if is_tryoff(f)), None)
+        
+        vram_gb, capability = detect_gpu()
+        klein_quant = select_klein_quant(vram_gb, capability)
         print(f"   ⚡ Seleccionado: Klein 9B (try-on: {has_tryon_lora}, try-off: {has_tryoff_lora}, video: {has_ltx})")
+        print(f"   🧮 Pesos Klein: {klein_quant} (VRAM: {vram_gb} GB, sm_{''.join(map(str, capability or ()))})")
         return {
             "name": klein_found,
             "dtype": "default",  # bf16 nativo en 96GB
@@ -94,6 +201,9 @@ def get_optimal_unet_config():
             "has_tryoff_lora": has_tryoff_lora,
             "tryon_lora_name": tryon_lora_name,
             "tryoff_lora_name": tryoff_lora_name,
+            "loras_dir": klein_loras_dir,
+            "klein_quant": klein_quant,
+            "vram_gb": vram_gb,
             "has_ltx": has_ltx,
             "ltx_model": ltx_model,
         }
@@ -129,44 +239,213 @@ if not SUPABASE_URL or not SUPABASE_KEY:
 # Cliente Supabase
 supabase: Client = create_client(SUPABASE_URL, SUPABASE_KEY)
 
+# ============================================
+# CLIENTES HTTP CON KEEP-ALIVE
+# Una sesión con pool de conexiones por servicio (cada ComfyUI, Storage,
+# descargas): timeout por endpoint, presupuesto de reintentos y stats
+# ============================================
+
+HTTP_CLIENTS = []  # para reportar stats de todos los pools
+
+
+class PooledHTTPClient:
+    """
+    Sesión requests keep-alive de un servicio.
+    Los reintentos (solo peticiones idempotentes, errores de conexión / 502-504)
+    salen de un presupuesto: cada petición aporta `retry_ratio` tokens, cada
+    reintento gasta uno → un servicio caído no multiplica la carga.
+    """
+    
+    RETRY_STATUS = (502, 503, 504)
+    MAX_RETRY_TOKENS = 10.0
+    
+    def __init__(self, name, base_url='', pool_size=8, timeouts=None, default_timeout=30,
+                 max_retries=2, retry_ratio=0.1, headers=None):
+        self.name = name
+        self.base_url = base_url.rstrip('/')
+        self.timeouts = timeouts or {}   # prefijo de ruta -> timeout (s)
+        self.default_timeout = default_timeout
+        self.max_retries = max_retries
+        self.retry_ratio = retry_ratio
+        self.session = requests.Session()
+        self._adapter = requests.adapters.HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount('https://', self._adapter)
+        self.session.mount('http://', self._adapter)
+        if headers:
+            self.session.headers.update(headers)
+        self._lock = threading.Lock()
+        self._retry_tokens = self.MAX_RETRY_TOKENS
+        self.stats = {'requests': 0, 'errors': 0, 'retries': 0, 'retries_denied': 0}
+        self._last_report = None
+        HTTP_CLIENTS.append(self)
+    
+    def _timeout_for(self, path):
+        for prefix, timeout in self.timeouts.items():
+            if path.startswith(prefix):
+                return timeout
+        return self.default_timeout
+    
+    def _take_retry_token(self):
+        with self._lock:
+            if self._retry_tokens >= 1:
+                self._retry_tokens -= 1
+                self.stats['retries'] += 1
+                return True
+            self.stats['retries_denied'] += 1
+            return False
+    
+    def request(self, method, path, timeout=None, idempotent=None, **kwargs):
+        url = path if '://' in path else f"{self.base_url}{path}"
+        if timeout is None:
+            timeout = self._timeout_for(path)
+        if idempotent is None:
+            idempotent = method in ('GET', 'HEAD')
+        
+        attempt = 0
+        while True:
+            with self._lock:
+                self.stats['requests'] += 1
+                self._retry_tokens = min(self.MAX_RETRY_TOKENS, self._retry_tokens + self.retry_ratio)
+            try:
+                resp = self.session.request(method, url, timeout=timeout, **kwargs)
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout):
+                with self._lock:
+                    self.stats['errors'] += 1
+                if idempotent and attempt < self.max_retries and self._take_retry_token():
+                    attempt += 1
+                    time.sleep(0.25 * 2 ** attempt)
+                    continue
+                raise
+            
+            if resp.status_code in self.RETRY_STATUS:
+                with self._lock:
+                    self.stats['errors'] += 1
+                if idempotent and attempt < self.max_retries and self._take_retry_token():
+                    resp.close()
+                    attempt += 1
+                    time.sleep(0.25 * 2 ** attempt)
+                    continue
+            return resp
+    
+    def get(self, path, **kwargs):
+        return self.request('GET', path, **kwargs)
+    
+    def post(self, path, **kwargs):
+        return self.request('POST', path, **kwargs)
+    
+    def pool_stats(self):
+        """Peticiones, conexiones abiertas por urllib3 y reutilización del pool"""
+        connections = sent = 0
+        pools = self._adapter.poolmanager.pools
+        for key in list(pools.keys()):
+            pool = pools.get(key)
+            if pool is not None:
+                connections += pool.num_connections
+                sent += pool.num_requests
+        with self._lock:
+            stats = dict(self.stats)
+        stats['connections_opened'] = connections
+        stats['connection_reuse'] = round(1 - connections / sent, 3) if sent else 0.0
+        return stats
+    
+    def report(self):
+        """Loguear las stats del pool si cambiaron desde el último reporte"""
+        stats = self.pool_stats()
+        if stats['requests'] == 0 or stats == self._last_report:
+            return
+        self._last_report = stats
+        print(
+            f"🔗 HTTP {self.name}: {stats['requests']} peticiones, "
+            f"{stats['connections_opened']} conexiones ({stats['connection_reuse']:.0%} reutilizadas), "
+            f"{stats['retries']} reintentos ({stats['retries_denied']} sin presupuesto), {stats['errors']} errores"
+        )
+
+
+def report_http_pools():
+    for client in HTTP_CLIENTS:
+        client.report()
+
+
+# Timeouts por endpoint de ComfyUI (los renders se esperan por /ws, no por HTTP)
+COMFY_TIMEOUTS = {
+    '/system_stats': 5,
+    '/queue': 5,
+    '/history': 10,
+    '/object_info': 15,
+    '/upload/image': 30,
+    '/prompt': 60,
+    '/view': 120,
+}
+
+STORAGE_HTTP = PooledHTTPClient(
+    "storage", f"{SUPABASE_URL}/storage/v1",
+    pool_size=WORKER_CONFIG['RESOURCE_SLOTS']['io'], default_timeout=120,
+    headers={'Authorization': f"Bearer {SUPABASE_KEY}", 'apikey': SUPABASE_KEY},
+)
+
+
+def upload_storage_object(bucket, path, data, content_type):
+    """
+    Subir un objeto a Supabase Storage (API REST) por la sesión keep-alive.
+    Con upsert la subida es idempotente → se puede reintentar (las rutas
+    llevan job_id + timestamp, nunca pisan otro objeto).
+    """
+    resp = STORAGE_HTTP.post(
+        f"/object/{bucket}/{path}",
+        data=data,
+        headers={'Content-Type': content_type, 'x-upsert': 'true'},
+        idempotent=True,
+    )
+    if resp.status_code >= 400:
+        raise Exception(f"Storage {resp.status_code}: {resp.text[:200]}")
+    return f"{SUPABASE_URL}/storage/v1/object/public/{bucket}/{path}"
+
 # ============================================
 # FUNCIONES AUXILIARES
 # ============================================
 
 def check_comfy_ready():
-    """Verificar que ComfyUI esté listo"""
-    try:
-        resp = requests.get(f"{COMFY_URL}/system_stats", timeout=5)
-        return resp.status_code == 200
-    except:
-        return False
+    """Verificar que al menos un ComfyUI del pool esté listo"""
+    return any(endpoint.is_ready() for endpoint in COMFY_ENDPOINTS)
 
 AVAILABLE_NODES_CACHE = None
 
 
-def get_available_comfy_nodes(force_refresh=False):
-    """Lee /object_info para saber qué nodos tiene ComfyUI realmente cargados."""
+def get_available_comfy_nodes(force_refresh=False, endpoints=None):
+    """
+    Lee /object_info para saber qué nodos tiene ComfyUI realmente cargados.
+    Sin `endpoints` se consulta todo el pool y vale la intersección de los que
+    responden (un workflow puede acabar en cualquiera de ellos); los caídos no
+    cuentan, igual que en check_comfy_ready.
+    """
     global AVAILABLE_NODES_CACHE
-    if AVAILABLE_NODES_CACHE is not None and not force_refresh:
-        return AVAILABLE_NODES_CACHE
-    try:
-        resp = requests.get(f"{COMFY_URL}/object_info", timeout=15)
-        resp.raise_for_status()
-        data = resp.json()
-        AVAILABLE_NODES_CACHE = set(data.keys())
-        return AVAILABLE_NODES_CACHE
-    except Exception as e:
-        print(f"⚠️ No se pudo leer /object_info de ComfyUI: {e}")
-        AVAILABLE_NODES_CACHE = set()
+    use_cache = endpoints is None
+    if use_cache and AVAILABLE_NODES_CACHE is not None and not force_refresh:
         return AVAILABLE_NODES_CACHE
+    
+    available = None
+    for endpoint in (COMFY_ENDPOINTS if endpoints is None else endpoints):
+        try:
+            resp = endpoint.http.get("/object_info")
+            resp.raise_for_status()
+            nodes = set(resp.json().keys())
+        except Exception as e:
+            print(f"⚠️ No se pudo leer /object_info de ComfyUI {endpoint.url}: {e}")
+            continue
+        available = nodes if available is None else available & nodes
+    
+    available = available or set()
+    if use_cache:
+        AVAILABLE_NODES_CACHE = available
+    return available
 
 
-def wait_for_comfy_nodes(required_nodes, timeout=90):
-    """Espera a que ComfyUI termine de cargar los custom nodes requeridos."""
+def wait_for_comfy_nodes(required_nodes, timeout=90, endpoints=None):
+    """Espera a que ComfyUI (todo el pool, o `endpoints`) termine de cargar los custom nodes requeridos."""
     deadline = time.time() + timeout
     last_missing = set(required_nodes)
     while time.time() < deadline:
-        available = get_available_comfy_nodes(force_refresh=True)
+        available = get_available_comfy_nodes(force_refresh=True, endpoints=endpoints)
         missing = {node for node in required_nodes if node not in available}
         if not missing:
             return True, set()
@@ -175,8 +454,45 @@ def wait_for_comfy_nodes(required_nodes, timeout=90):
         time.sleep(3)
     return False, last_missing
 
+# ============================================
+# PUBLICADOR DE PROGRESO (coalescente)
+# update_job_progress no bloquea: guarda el último valor por job y un hilo
+# lo escribe en Supabase como mucho cada PROGRESS_MIN_INTERVAL_SECONDS
+# ============================================
+
+_progress_pending = {}      # job_id -> (progress, message) aún sin escribir
+_progress_last_write = {}   # job_id -> timestamp del último UPDATE
+_progress_writing = set()   # job_ids con UPDATE en vuelo
+_progress_cond = threading.Condition()
+
+
 def update_job_progress(job_id, progress, message=None):
-    """Actualizar progreso del job en Supabase (para Realtime)"""
+    """Publicar progreso del job (para Realtime); se agrupa con los siguientes"""
+    if str(job_id).startswith(WARMUP_JOB_PREFIX):
+        return  # jobs sintéticos del warmup: no existen en BD
+    print(f"📊 [Job {job_id}] Progreso: {progress}% {f'- {message}' if message else ''}")
+    with _progress_cond:
+        previous = _progress_pending.get(job_id)
+        if message is None and previous is not None:
+            message = previous[1]  # conservar el último mensaje aún no escrito
+        _progress_pending[job_id] = (progress, message)
+        _progress_cond.notify()
+
+
+def finish_job_progress(job_id):
+    """
+    Antes de un UPDATE que reemplaza el progreso (hito o estado terminal):
+    descartar el progreso pendiente y esperar al UPDATE en vuelo, para que
+    ninguno llegue después y pise el estado final.
+    """
+    with _progress_cond:
+        _progress_pending.pop(job_id, None)
+        while job_id in _progress_writing:
+            _progress_cond.wait()
+        _progress_last_write.pop(job_id, None)
+
+
+def _write_job_progress(job_id, progress, message):
     try:
         update_data = {
             'progress': min(progress, 99),  # No llegar a 100 hasta completar
@@ -185,133 +501,1435 @@ def update_job_progress(job_id, progress, message=None):
         if message:
             update_data['result_metadata'] = {'status_message': message}
         
-        supabase.table('ai_generation_jobs').update(update_data).eq('id', job_id).execute()
-        print(f"📊 [Job {job_id}] Progreso: {progress}% {f'- {message}' if message else ''}")
+        # Solo mientras processing: nunca pisa un completed / failed / re-encolado
+        supabase.table('ai_generation_jobs').update(update_data) \
+            .eq('id', job_id).eq('status', 'processing').execute()
     except Exception as e:
         print(f"⚠️ Error actualizando progreso: {e}")
 
-def get_comfy_queue_progress(prompt_id):
-    """Obtener progreso de ComfyUI via /queue endpoint"""
+
+def _progress_publisher_loop():
+    interval = WORKER_CONFIG['PROGRESS_MIN_INTERVAL_SECONDS']
+    while True:
+        with _progress_cond:
+            now = time.time()
+            due = [
+                job_id for job_id in _progress_pending
+                if job_id not in _progress_writing and now - _progress_last_write.get(job_id, 0) >= interval
+            ]
+            if not due:
+                # Dormir hasta que venza el siguiente job pendiente o llegue progreso nuevo
+                next_due = min(
+                    (_progress_last_write.get(job_id, 0) + interval for job_id in _progress_pending),
+                    default=None,
+                )
+                _progress_cond.wait(None if next_due is None else max(0.05, next_due - now))
+                continue
+            batch = {job_id: _progress_pending.pop(job_id) for job_id in due}
+            for job_id in due:
+                _progress_last_write[job_id] = now
+            _progress_writing.update(due)
+        
+        for job_id, (progress, message) in batch.items():
+            _write_job_progress(job_id, progress, message)
+        
+        with _progress_cond:
+            _progress_writing.difference_update(batch)
+            _progress_cond.notify_all()
+
+
+def start_progress_publisher():
+    threading.Thread(target=_progress_publisher_loop, daemon=True, name="progress-publisher").start()
+
+
+# ============================================
+# MÉTRICAS POR JOB
+# Las etapas anotan métricas del job (caches, tiempos) y se publican
+# en result_metadata al entregar la imagen y al completar
+# ============================================
+
+_job_metrics = {}  # job_id -> dict
+_job_metrics_lock = threading.Lock()
+
+
+def record_job_metrics(job_id, **metrics):
+    with _job_metrics_lock:
+        _job_metrics.setdefault(job_id, {}).update(metrics)
+
+
+def get_job_metrics(job_id):
+    with _job_metrics_lock:
+        return dict(_job_metrics.get(job_id, {}))
+
+
+def pop_job_metrics(job_id):
+    with _job_metrics_lock:
+        return _job_metrics.pop(job_id, {})
+
+def wait_for_comfy_result(job_id, endpoint, prompt_id, output_node_id, max_wait=180, total_steps=20, on_start=None):
+    """
+    Esperar resultado de ComfyUI con actualizaciones de progreso REAL.
+    Con el WebSocket del endpoint conectado se reacciona a los eventos al instante;
+    si no, se consulta /queue + /history cada segundo.
+    `max_wait` cuenta desde que el prompt empieza a ejecutarse, no desde el envío:
+    el tiempo en cola detrás de otros prompts tiene su propio límite.
+    `on_start` se llama una vez, cuando el prompt sale de la cola.
+    """
+    ws_events = endpoint.events
+    if ws_events is None or not ws_events.connected.is_set():
+        if ws_events is not None:
+            ws_events.unsubscribe(prompt_id)
+        return _wait_for_comfy_result_polling(
+            job_id, endpoint, prompt_id, output_node_id, max_wait, total_steps, on_start
+        )
+    
+    events = ws_events.subscribe(prompt_id)
+    deadline = time.time() + WORKER_CONFIG['COMFY_QUEUE_MAX_WAIT_SECONDS']
+    started = False
+    last_progress = 20  # Empezamos en 20% (ya enviado antes de llamar)
+    last_history_check = time.time()
+    
     try:
-        resp = requests.get(f"{COMFY_URL}/queue", timeout=5)
-        if resp.status_code == 200:
-            queue = resp.json()
-            # Verificar si nuestro prompt está ejecutándose
-            running = queue.get('queue_running', [])
-            for item in running:
-                if item[1] == prompt_id:
-                    # Item encontrado, está ejecutándose
-                    return {'status': 'running', 'position': 0}
+        while time.time() < deadline:
+            try:
+                event_type, data = events.get(timeout=1)
+            except queue.Empty:
+                event_type, data = None, {}
             
-            pending = queue.get('queue_pending', [])
-            for i, item in enumerate(pending):
-                if item[1] == prompt_id:
-                    return {'status': 'pending', 'position': i + 1}
+            if not started and event_type in ('execution_start', 'executing', 'progress'):
+                # Sale de la cola: desde aquí corre el límite de ejecución
+                started = True
+                deadline = time.time() + max_wait
+                if on_start is not None:
+                    on_start()
             
-            # No está en cola, probablemente terminó
-            return {'status': 'completed', 'position': 0}
-    except:
-        pass
-    return {'status': 'unknown', 'position': 0}
+            if event_type == 'progress':
+                current_step = data.get('value', 0)
+                max_steps = data.get('max') or total_steps
+                # Mapear steps a progreso: 20% (inicio) a 85% (fin)
+                real_progress = 20 + int((current_step / max_steps) * 65)
+                if real_progress > last_progress:
+                    update_job_progress(job_id, real_progress, f"Step {current_step}/{max_steps}")
+                    last_progress = real_progress
+                continue
+            
+            if event_type == 'execution_error':
+                raise Exception(f"ComfyUI error: {data.get('exception_message', 'Error desconocido')}")
+            if event_type == 'execution_interrupted':
+                raise Exception("ComfyUI interrumpió la ejecución")
+            
+            # Fin de ejecución (o WS caído / evento perdido → comprobar history cada 10s)
+            finished = event_type == 'execution_success' or (event_type == 'executing' and data.get('node') is None)
+            stale = time.time() - last_history_check > 10 or not ws_events.connected.is_set()
+            if finished or stale:
+                last_history_check = time.time()
+                try:
+                    result_bytes = _check_comfy_history(job_id, endpoint, prompt_id, output_node_id)
+                    if result_bytes:
+                        return result_bytes
+                except requests.exceptions.RequestException as e:
+                    print(f"⚠️ Error consultando history: {e}")
+    finally:
+        ws_events.unsubscribe(prompt_id)
+    
+    if not started:
+        raise Exception(f"Timeout en cola de ComfyUI ({WORKER_CONFIG['COMFY_QUEUE_MAX_WAIT_SECONDS']}s sin empezar)")
+    raise Exception(f"Timeout esperando resultado ({max_wait}s)")
+
 
-def wait_for_comfy_result(job_id, prompt_id, output_node_id, max_wait=180, total_steps=20):
+def _check_comfy_history(job_id, endpoint, prompt_id, output_node_id):
     """
-    Esperar resultado de ComfyUI con actualizaciones de progreso REAL
-    Consulta /queue para obtener el step actual
+    Leer /history/{prompt_id}: bytes del resultado si terminó, None si sigue en curso.
+    Lanza excepción si ComfyUI reporta error o terminó sin output.
     """
-    waited = 0
+    hist_resp = endpoint.http.get(f"/history/{prompt_id}")
+    history = hist_resp.json()
+    
+    if prompt_id not in history:
+        return None
+    
+    outputs = history[prompt_id].get('outputs', {})
+    
+    if output_node_id in outputs:
+        node_output = outputs[output_node_id]
+        
+        # Buscar resultado: images (SaveImage) o gifs (VHS_VideoCombine)
+        result_info = None
+        if node_output.get('images'):
+            result_info = node_output['images'][0]
+        elif node_output.get('gifs'):
+            result_info = node_output['gifs'][0]
+        elif node_output.get('videos'):
+            result_info = node_output['videos'][0]
+        
+        if result_info:
+            update_job_progress(job_id, 90, "Subiendo resultado...")
+            return fetch_comfy_output(endpoint, result_info)
+    
+    # Verificar errores
+    status = history[prompt_id].get('status', {})
+    if status.get('status_str') == 'error':
+        error_msg = status.get('messages', [['', 'Error desconocido']])[0][1]
+        raise Exception(f"ComfyUI error: {error_msg}")
+    
+    if status.get('completed', False):
+        raise Exception("ComfyUI completó pero no hay output en el nodo esperado")
+    
+    return None
+
+
+def _wait_for_comfy_result_polling(job_id, endpoint, prompt_id, output_node_id, max_wait=180, total_steps=20,
+                                   on_start=None):
+    """
+    Fallback sin WebSocket: consulta /queue para obtener el step actual
+    y /history cada segundo
+    """
+    deadline = time.time() + WORKER_CONFIG['COMFY_QUEUE_MAX_WAIT_SECONDS']
+    started = False
     last_progress = 20  # Empezamos en 20% (ya enviado antes de llamar)
     last_step = 0
     
-    while waited < max_wait:
-        time.sleep(1)  # Polling cada 1 segundo para más actualizaciones
-        waited += 1
-        
-        # Obtener progreso REAL de ComfyUI via /queue
-        try:
-            queue_resp = requests.get(f"{COMFY_URL}/queue", timeout=5)
-            if queue_resp.status_code == 200:
-                queue_data = queue_resp.json()
-                running = queue_data.get('queue_running', [])
-                
-                for item in running:
-                    if len(item) > 2 and item[1] == prompt_id:
-                        # item[2] tiene info del nodo actual
-                        node_info = item[2] if len(item) > 2 else {}
-                        current_step = node_info.get('value', 0)
-                        max_steps = node_info.get('max', total_steps)
-                        
-                        if max_steps > 0 and current_step > last_step:
-                            last_step = current_step
-                            # Mapear steps a progreso: 20% (inicio) a 85% (fin)
-                            real_progress = 20 + int((current_step / max_steps) * 65)
-                            
-                            if real_progress > last_progress:
-                                print(f"📊 [Job {job_id}] Progreso: {real_progress}% - Step {current_step}/{max_steps}")
-                                update_job_progress(job_id, real_progress, f"Step {current_step}/{max_steps}")
-                                last_progress = real_progress
-        except Exception as e:
-            pass  # Si falla, seguimos con history
-        
-        # Verificar si ComfyUI terminó
-        try:
-            hist_resp = requests.get(f"{COMFY_URL}/history/{prompt_id}", timeout=10)
-            history = hist_resp.json()
-            
-            if prompt_id in history:
-                outputs = history[prompt_id].get('outputs', {})
-                
-                if output_node_id in outputs:
-                    node_output = outputs[output_node_id]
-                    
-                    # Buscar resultado: images (SaveImage) o gifs (VHS_VideoCombine)
-                    result_info = None
-                    if node_output.get('images'):
-                        result_info = node_output['images'][0]
-                    elif node_output.get('gifs'):
-                        result_info = node_output['gifs'][0]
-                    elif node_output.get('videos'):
-                        result_info = node_output['videos'][0]
-                    
-                    if result_info:
-                        result_filename = result_info['filename']
-                        result_subfolder = result_info.get('subfolder', '')
-                        result_type = result_info.get('type', 'output')
-                        
-                        base_dir = f"/workspace/ComfyUI/{result_type}" if result_type != 'output' else "/workspace/ComfyUI/output"
-                        result_path = f"{base_dir}/{result_subfolder}/{result_filename}" if result_subfolder else f"{base_dir}/{result_filename}"
-                        
-                        update_job_progress(job_id, 90, "Subiendo resultado...")
-                        return result_path
-                
-                # Verificar errores
-                status = history[prompt_id].get('status', {})
-                if status.get('status_str') == 'error':
-                    error_msg = status.get('messages', [['', 'Error desconocido']])[0][1]
-                    raise Exception(f"ComfyUI error: {error_msg}")
-                
-                if status.get('completed', False):
-                    raise Exception("ComfyUI completó pero no hay output en el nodo esperado")
-        except requests.exceptions.RequestException as e:
-            print(f"⚠️ Error consultando history: {e}")
+    while time.time() < deadline:
+        time.sleep(1)  # Polling cada 1 segundo para más actualizaciones
+        
+        # Obtener progreso REAL de ComfyUI via /queue
+        try:
+            queue_resp = endpoint.http.get("/queue")
+            if queue_resp.status_code == 200:
+                queue_data = queue_resp.json()
+                running = queue_data.get('queue_running', [])
+                
+                if not started and any(len(item) > 1 and item[1] == prompt_id for item in running):
+                    # Sale de la cola: desde aquí corre el límite de ejecución
+                    started = True
+                    deadline = time.time() + max_wait
+                    if on_start is not None:
+                        on_start()
+                
+                for item in running:
+                    if len(item) > 2 and item[1] == prompt_id:
+                        # item[2] tiene info del nodo actual
+                        node_info = item[2] if len(item) > 2 else {}
+                        current_step = node_info.get('value', 0)
+                        max_steps = node_info.get('max', total_steps)
+                        
+                        if max_steps > 0 and current_step > last_step:
+                            last_step = current_step
+                            # Mapear steps a progreso: 20% (inicio) a 85% (fin)
+                            real_progress = 20 + int((current_step / max_steps) * 65)
+                            
+                            if real_progress > last_progress:
+                                print(f"📊 [Job {job_id}] Progreso: {real_progress}% - Step {current_step}/{max_steps}")
+                                update_job_progress(job_id, real_progress, f"Step {current_step}/{max_steps}")
+                                last_progress = real_progress
+        except Exception as e:
+            pass  # Si falla, seguimos con history
+        
+        # Verificar si ComfyUI terminó
+        try:
+            result_bytes = _check_comfy_history(job_id, endpoint, prompt_id, output_node_id)
+            if result_bytes:
+                return result_bytes
+        except requests.exceptions.RequestException as e:
+            print(f"⚠️ Error consultando history: {e}")
+    
+    if not started:
+        raise Exception(f"Timeout en cola de ComfyUI ({WORKER_CONFIG['COMFY_QUEUE_MAX_WAIT_SECONDS']}s sin empezar)")
+    raise Exception(f"Timeout esperando resultado ({max_wait}s)")
+
+
+# ============================================
+# TRANSPORTE EN MEMORIA CON COMFYUI
+# Inputs → POST /upload/image, outputs ← GET /view
+# Sin rutas de disco compartidas: ComfyUI puede estar en otro host
+# ============================================
+
+def upload_comfy_input(endpoint, filename, data):
+    """Subir bytes de imagen al input dir del ComfyUI dado; devuelve el nombre para LoadImage"""
+    resp = endpoint.http.post(
+        "/upload/image",
+        files={"image": (filename, data, "application/octet-stream")},
+        data={"overwrite": "true", "type": "input"},
+        idempotent=True,  # overwrite=true: reintentar deja el mismo archivo
+    )
+    resp.raise_for_status()
+    info = resp.json()
+    name = info.get('name', filename)
+    return f"{info['subfolder']}/{name}" if info.get('subfolder') else name
+
+
+def fetch_comfy_output(endpoint, result_info):
+    """Descargar un output de ComfyUI (/view) y borrar la copia local si ComfyUI es local"""
+    params = {
+        "filename": result_info['filename'],
+        "subfolder": result_info.get('subfolder', ''),
+        "type": result_info.get('type', 'output'),
+    }
+    resp = endpoint.http.get("/view", params=params)
+    resp.raise_for_status()
+    
+    # El worker siempre borró sus outputs tras subirlos; solo es posible si comparte disco
+    if endpoint.is_local:
+        local_path = os.path.join(
+            "/workspace/ComfyUI", params['type'], params['subfolder'], params['filename']
+        )
+        try:
+            os.remove(local_path)
+        except OSError:
+            pass
+    
+    return resp.content
+
+
+# ============================================
+# EVENTOS COMFYUI POR WEBSOCKET (/ws)
+# Un cliente persistente por worker: ComfyUI envía progress / executing /
+# executed / execution_error al client_id que encoló el prompt (WORKER_ID)
+# ============================================
+
+class ComfyEventClient:
+    """Conexión /ws persistente que reparte los eventos a cada prompt_id en espera"""
+    
+    TERMINAL_EVENTS = ('execution_success', 'execution_error', 'execution_interrupted')
+    
+    def __init__(self, base_url, client_id):
+        scheme, rest = base_url.split('://', 1)
+        ws_scheme = 'wss' if scheme == 'https' else 'ws'
+        self.ws_url = f"{ws_scheme}://{rest.rstrip('/')}/ws?clientId={client_id}"
+        self.connected = threading.Event()
+        self._lock = threading.Lock()
+        self._subscribers = {}         # prompt_id -> queue.Queue de (tipo, data)
+        self._orphans = OrderedDict()  # eventos de prompts aún sin suscriptor (acotado)
+        self.queue_remaining = 0       # último 'status' de ComfyUI (prompts en cola, de cualquiera)
+        self.on_connect = None         # se llama en cada (re)conexión: ComfyUI pudo reiniciarse
+    
+    def start(self):
+        threading.Thread(target=self._run, daemon=True, name=f"comfy-ws-{self.ws_url}").start()
+    
+    def subscribe(self, prompt_id):
+        """Cola de eventos del prompt (incluye los llegados antes de suscribirse)"""
+        with self._lock:
+            events = self._subscribers.get(prompt_id)
+            if events is None:
+                events = queue.Queue()
+                for event in self._orphans.pop(prompt_id, []):
+                    events.put(event)
+                self._subscribers[prompt_id] = events
+            return events
+    
+    def unsubscribe(self, prompt_id):
+        with self._lock:
+            self._subscribers.pop(prompt_id, None)
+    
+    def _dispatch(self, message):
+        event_type = message.get('type')
+        data = message.get('data') or {}
+        if event_type == 'status':
+            exec_info = (data.get('status') or {}).get('exec_info') or {}
+            self.queue_remaining = exec_info.get('queue_remaining', self.queue_remaining)
+            return
+        prompt_id = data.get('prompt_id')
+        if not prompt_id:
+            return
+        with self._lock:
+            events = self._subscribers.get(prompt_id)
+            if events is None:
+                # El prompt puede empezar antes de que el job se suscriba
+                self._orphans.setdefault(prompt_id, []).append((event_type, data))
+                self._orphans.move_to_end(prompt_id)
+                while len(self._orphans) > 256:
+                    self._orphans.popitem(last=False)
+                return
+        events.put((event_type, data))
+    
+    def _run(self):
+        import websocket
+        backoff = 1
+        while True:
+            try:
+                ws = websocket.create_connection(self.ws_url, timeout=10)
+                ws.settimeout(None)
+                self.connected.set()
+                backoff = 1
+                print(f"🔌 WebSocket ComfyUI conectado: {self.ws_url}")
+                if self.on_connect is not None:
+                    self.on_connect()
+                while True:
+                    message = ws.recv()
+                    if isinstance(message, bytes):
+                        continue  # previews binarios
+                    self._dispatch(json.loads(message))
+            except Exception as e:
+                if self.connected.is_set():
+                    print(f"⚠️ WebSocket ComfyUI desconectado: {e}")
+                self.connected.clear()
+            time.sleep(backoff)
+            backoff = min(backoff * 2, 30)
+
+
+def start_comfy_events():
+    """Arrancar un cliente /ws por endpoint (si websocket-client no está, se sigue con polling)"""
+    try:
+        import websocket  # noqa: F401
+    except ImportError:
+        print("⚠️ websocket-client no instalado, progreso ComfyUI por polling")
+        return
+    for endpoint in COMFY_ENDPOINTS:
+        endpoint.events = ComfyEventClient(endpoint.url, WORKER_ID)
+        # Un ComfyUI reiniciado perdió su input/: los latentes se vuelven a subir
+        endpoint.events.on_connect = endpoint.uploaded_latents.clear
+        endpoint.events.start()
+    for endpoint in COMFY_ENDPOINTS:
+        endpoint.events.connected.wait(5)
+
+
+# ============================================
+# POOL DE ENDPOINTS COMFYUI
+# Cada workflow va al ComfyUI menos cargado: prompts propios en vuelo
+# y profundidad de cola (evento 'status' del /ws, o GET /queue sin WS)
+# ============================================
+
+class ComfyEndpoint:
+    """Un servidor ComfyUI del pool con su /ws y su carga conocida"""
+    
+    QUEUE_CHECK_SECONDS = 2
+    
+    def __init__(self, url):
+        self.url = url
+        self.is_local = url.split('://', 1)[-1].split(':', 1)[0].split('/', 1)[0] in ('127.0.0.1', 'localhost')
+        self.http = PooledHTTPClient(f"comfy {url}", url, timeouts=COMFY_TIMEOUTS)
+        self.uploaded_latents = set()  # claves de LATENT_CACHE ya subidas a su input dir
+        self.events = None
+        self.in_flight = 0          # prompts de este worker enviados y aún no recogidos
+        self.healthy = True
+        self.has_ltx = True         # False si su warmup LTX falló (no recibe videos)
+        self._queue_depth = 0
+        self._queue_checked_at = 0
+    
+    def is_ready(self):
+        try:
+            return self.http.get("/system_stats", idempotent=False).status_code == 200
+        except Exception:
+            return False
+    
+    def queue_depth(self):
+        """Prompts en cola (running + pending), de este worker o de cualquier otro cliente"""
+        if self.events is not None and self.events.connected.is_set():
+            self.healthy = True
+            return self.events.queue_remaining
+        if time.time() - self._queue_checked_at > self.QUEUE_CHECK_SECONDS:
+            self._queue_checked_at = time.time()
+            try:
+                resp = self.http.get("/queue")
+                resp.raise_for_status()
+                data = resp.json()
+                self._queue_depth = len(data.get('queue_running', [])) + len(data.get('queue_pending', []))
+                self.healthy = True
+            except Exception as e:
+                if self.healthy:
+                    print(f"⚠️ ComfyUI {self.url} no responde: {e}")
+                self.healthy = False
+        return self._queue_depth
+    
+    def load(self, queue_depth=None):
+        # La cola ya incluye nuestros prompts; in_flight cubre los aún no reflejados
+        if queue_depth is None:
+            queue_depth = self.queue_depth()
+        return max(self.in_flight, queue_depth)
+
+
+COMFY_ENDPOINTS = [ComfyEndpoint(url) for url in COMFY_URLS]
+_comfy_endpoints_lock = threading.Lock()
+
+
+def acquire_comfy_endpoint(need_ltx=False):
+    """Elegir el ComfyUI menos cargado (con LTX si `need_ltx`) y contar un prompt en vuelo en él"""
+    # Las colas (GET /queue sin WS) se leen fuera del lock: un endpoint lento
+    # no bloquea la elección del resto de hilos
+    endpoints = [endpoint for endpoint in COMFY_ENDPOINTS if endpoint.has_ltx or not need_ltx]
+    if not endpoints:
+        raise Exception("Ningún ComfyUI del pool tiene LTX disponible")
+    depths = [endpoint.queue_depth() for endpoint in endpoints]
+    with _comfy_endpoints_lock:
+        loads = [(endpoint.load(depth), idx, endpoint) for idx, (endpoint, depth) in enumerate(zip(endpoints, depths))]
+        candidates = [item for item in loads if item[2].healthy] or loads
+        endpoint = min(candidates)[2]
+        endpoint.in_flight += 1
+        return endpoint
+
+
+def release_comfy_endpoint(endpoint):
+    with _comfy_endpoints_lock:
+        endpoint.in_flight -= 1
+
+
+# ============================================
+# SLOTS DE RECURSOS (ejecución concurrente de jobs)
+# Cada job corre en su hilo y solo espera por el recurso que usa:
+# un try-on Klein no espera a un render LTX de 5 min en ComfyUI
+# ============================================
+
+RESOURCE_SEMAPHORES = {
+    name: threading.BoundedSemaphore(max(1, slots))
+    for name, slots in WORKER_CONFIG['RESOURCE_SLOTS'].items()
+}
+
+
+@contextmanager
+def resource_slot(name):
+    """Ocupar un slot del recurso `name` durante el bloque"""
+    semaphore = RESOURCE_SEMAPHORES[name]
+    semaphore.acquire()
+    try:
+        yield
+    finally:
+        semaphore.release()
+
+
+# ============================================
+# ÁRBITRO DE VRAM
+# Klein (diffusers, en este proceso) y ComfyUI (otro proceso, --highvram)
+# comparten la GPU sin ver el uso del otro. El árbitro admite trabajo según
+# el pico conocido de cada tipo, pide a ComfyUI que libere modelos (/free)
+# antes de Klein y saca Klein a RAM cuando el video LTX necesita el hueco.
+# Solo actúa con Klein cargado y ComfyUI en la misma máquina.
+# ============================================
+
+GB = 1024 ** 3
+
+
+class VramArbiter:
+    """Reservas de VRAM por tipo de trabajo ('klein', 'comfy_image', 'comfy_video')"""
+    
+    def __init__(self, peaks_gb, headroom_gb, admission_timeout):
+        self.peaks_gb = dict(peaks_gb)
+        self.headroom_gb = headroom_gb
+        self.admission_timeout = admission_timeout
+        self.enabled = False
+        self.total_gb = None
+        self.klein_resident_gb = 0.0  # pesos + cache de embeddings de Klein (medido con Klein parado)
+        self.klein_offloaded = False
+        self.klein_offloading = False  # Klein saliendo a RAM (fuera del lock): nadie entra mientras tanto
+        self._offload_failed = False
+        self.stats = {'waits': 0, 'wait_seconds': 0.0, 'timeouts': 0,
+                      'comfy_frees': 0, 'klein_offloads': 0, 'klein_reloads': 0}
+        self._active = {}  # tipo -> [unidades de cada reserva activa]
+        self._cond = threading.Condition()
+    
+    def configure(self, enabled):
+        self.enabled = enabled
+        if not enabled:
+            return
+        import torch
+        self.total_gb = torch.cuda.mem_get_info()[1] / GB
+        print(f"🧠 Árbitro de VRAM activo: {self.total_gb:.0f} GB, picos {self.peaks_gb}")
+    
+    # --- Medidas ---
+    
+    def free_gb(self):
+        import torch
+        return torch.cuda.mem_get_info()[0] / GB
+    
+    def comfy_vram_gb(self):
+        """VRAM reservada por el torch de los ComfyUI locales (/system_stats)"""
+        used = 0.0
+        for endpoint in COMFY_ENDPOINTS:
+            if not endpoint.is_local:
+                continue
+            try:
+                resp = endpoint.http.get("/system_stats")
+                resp.raise_for_status()
+                for device in resp.json().get('devices', []):
+                    used += (device.get('torch_vram_total') or 0) / GB
+            except Exception as e:
+                print(f"⚠️ No se pudo leer /system_stats de {endpoint.url}: {e}")
+        return used
+    
+    # --- Admisión ---
+    
+    def _fits(self, kind, units):
+        """¿Cabe `kind` junto a lo activo? Cada tipo cuenta una vez: ComfyUI y Klein ejecutan en serie"""
+        reserved = {k: max(v) for k, v in self._active.items() if v}
+        reserved[kind] = max(reserved.get(kind, 0), units)
+        needed = sum(self.peaks_gb[k] * n for k, n in reserved.items())
+        klein_gb = self.klein_resident_gb if (kind == 'klein' or not self.klein_offloaded) else 0.0
+        return needed + klein_gb <= self.total_gb - self.headroom_gb
+    
+    def acquire(self, kind, units=1, endpoint=None):
+        """Esperar hueco para `kind`; devuelve el token para release() (None si no aplica)"""
+        if not self.enabled or (endpoint is not None and not endpoint.is_local):
+            return None
+        start = time.time()
+        waited = False
+        while True:
+            with self._cond:
+                while True:
+                    if not self.klein_offloading:
+                        if kind == 'comfy_video' and not self._fits(kind, units) and self._klein_offloadable():
+                            # Se marca aquí y se mueve fuera del lock (decenas de GB a RAM)
+                            self.klein_offloading = True
+                            break
+                        if self._fits(kind, units) or not any(self._active.values()):
+                            return self._admit(kind, units, start, waited)
+                    remaining = start + self.admission_timeout - time.time()
+                    if remaining <= 0:
+                        self.stats['timeouts'] += 1
+                        print(f"⚠️ VRAM: {kind} entra sin hueco tras {self.admission_timeout}s (activos: {self._active})")
+                        return self._admit(kind, units, start, waited)
+                    waited = True
+                    self._cond.wait(min(remaining, 5))
+            self._offload_klein()
+    
+    def _admit(self, kind, units, start, waited):
+        # Llamar con el lock tomado
+        self._active.setdefault(kind, []).append(units)
+        if waited:
+            self.stats['waits'] += 1
+            self.stats['wait_seconds'] += time.time() - start
+        return (kind, units)
+    
+    def occupy(self, kind, units=1, endpoint=None):
+        """
+        Registrar `kind` que ya está ejecutando (ComfyUI sacó el prompt de su cola):
+        no espera hueco, solo cuenta para las siguientes admisiones. Token para release().
+        """
+        if not self.enabled or (endpoint is not None and not endpoint.is_local):
+            return None
+        with self._cond:
+            return self._admit(kind, units, time.time(), False)
+    
+    def release(self, token):
+        if token is None:
+            return
+        kind, units = token
+        with self._cond:
+            self._active[kind].remove(units)
+            self._cond.notify_all()
+    
+    @contextmanager
+    def reserve(self, kind, units=1, endpoint=None):
+        token = self.acquire(kind, units, endpoint)
+        try:
+            if token is not None and kind == 'klein':
+                with self._klein_run(units):
+                    yield
+            else:
+                yield
+        finally:
+            self.release(token)
+    
+    @contextmanager
+    def reserve_while_running(self, kind, endpoint=None):
+        """
+        on_start para wait_for_comfy_result: la reserva empieza cuando ComfyUI
+        ejecuta el prompt (no al encolarlo) y se libera al salir del bloque
+        """
+        tokens = []
+        try:
+            yield lambda: tokens.append(self.occupy(kind, endpoint=endpoint))
+        finally:
+            for token in tokens:
+                self.release(token)
+    
+    # --- Klein ↔ ComfyUI ---
+    
+    @contextmanager
+    def _klein_run(self, units):
+        """Klein admitido: traerlo de RAM, hacer sitio en ComfyUI y aprender su pico real"""
+        import torch
+        
+        with self._cond:
+            offloaded = self.klein_offloaded
+        if offloaded:
+            self._reload_klein()
+        needed = self.peaks_gb['klein'] * units + self.headroom_gb
+        with self._cond:
+            comfy_busy = any(self._active.get(kind) for kind in ('comfy_image', 'comfy_video'))
+        if self.free_gb() < needed and not comfy_busy:
+            self._free_comfy(needed)
+        
+        baseline = torch.cuda.memory_allocated()
+        torch.cuda.reset_peak_memory_stats()
+        try:
+            yield
+        finally:
+            observed = (torch.cuda.max_memory_allocated() - baseline) / GB / units
+            resident_gb = torch.cuda.memory_allocated() / GB
+            with self._cond:
+                if observed > self.peaks_gb['klein']:
+                    print(f"🧠 VRAM: pico Klein observado {observed:.1f} GB/imagen (antes {self.peaks_gb['klein']:.1f})")
+                    self.peaks_gb['klein'] = round(observed, 1)
+                self.klein_resident_gb = resident_gb
+    
+    def _free_comfy(self, needed_gb):
+        """POST /free a los ComfyUI locales (descarga modelos) y esperar a que baje su VRAM"""
+        if self.comfy_vram_gb() < 1:
+            return
+        for endpoint in COMFY_ENDPOINTS:
+            if endpoint.is_local:
+                try:
+                    endpoint.http.post("/free", json={"unload_models": True, "free_memory": True}, idempotent=True)
+                except Exception as e:
+                    print(f"⚠️ /free en {endpoint.url} falló: {e}")
+        self.stats['comfy_frees'] += 1
+        deadline = time.time() + 15
+        while self.free_gb() < needed_gb and time.time() < deadline:
+            time.sleep(0.5)
+        print(f"🧹 VRAM: ComfyUI liberó modelos para Klein ({self.free_gb():.1f} GB libres)")
+    
+    def _klein_offloadable(self):
+        # Llamar con el lock tomado: Klein cargado, en GPU y parado
+        return (not self.klein_offloaded and not self._offload_failed
+                and not self._active.get('klein') and _klein_pipeline is not None)
+    
+    def _offload_klein(self):
+        """
+        Klein a RAM. Sin el lock del árbitro: klein_offloading (puesto por acquire)
+        retiene las demás admisiones, que se despiertan al terminar.
+        """
+        import torch
+        
+        start = time.time()
+        ok = False
+        try:
+            _klein_pipeline.to("cpu")
+            torch.cuda.empty_cache()
+            ok = True
+        except Exception as e:
+            print(f"⚠️ VRAM: no se pudo sacar Klein de la GPU: {e}")
+        finally:
+            with self._cond:
+                self.klein_offloading = False
+                if ok:
+                    self.klein_offloaded = True
+                    self.stats['klein_offloads'] += 1
+                else:
+                    self._offload_failed = True  # no reintentar en cada video
+                self._cond.notify_all()
+        if ok:
+            print(f"💤 VRAM: Klein a RAM para el video ({time.time() - start:.1f}s, {self.klein_resident_gb:.1f} GB liberados)")
+    
+    def _reload_klein(self):
+        """
+        Klein de RAM a la GPU (con su reserva 'klein' activa). Cuenta como residente
+        desde antes de moverlo: ninguna admisión reparte la VRAM que va a ocupar.
+        """
+        import torch
+        
+        start = time.time()
+        with self._cond:
+            self.klein_offloaded = False
+        try:
+            _klein_pipeline.to("cuda")
+            torch.cuda.synchronize()
+        except Exception:
+            with self._cond:
+                self.klein_offloaded = True
+            raise
+        with self._cond:
+            self.stats['klein_reloads'] += 1
+        print(f"⚡ VRAM: Klein de vuelta en GPU ({time.time() - start:.1f}s)")
+    
+    def report(self):
+        if not self.enabled:
+            return
+        with self._cond:
+            active = {kind: len(units) for kind, units in self._active.items() if units}
+            klein_state = "RAM" if self.klein_offloaded else f"{self.klein_resident_gb:.1f} GB"
+        print(f"🧠 VRAM: {self.free_gb():.1f}/{self.total_gb:.0f} GB libres, ComfyUI {self.comfy_vram_gb():.1f} GB, "
+              f"Klein {klein_state}, activos {active}, {self.stats['waits']} esperas "
+              f"({self.stats['wait_seconds']:.0f}s), {self.stats['comfy_frees']} /free, "
+              f"{self.stats['klein_offloads']} offloads / {self.stats['klein_reloads']} reloads")
+
+
+VRAM_ARBITER = VramArbiter(
+    WORKER_CONFIG['VRAM_PEAK_GB'], WORKER_CONFIG['VRAM_HEADROOM_GB'],
+    WORKER_CONFIG['VRAM_ADMISSION_TIMEOUT_SECONDS'],
+)
+
+
+# ============================================
+# COLA DE COMFYUI EN PIPELINE
+# Los prompts de los siguientes jobs se envían mientras el actual
+# sigue en GPU / subiendo resultado → la GPU nunca espera al worker
+# ============================================
+
+COMFY_SUBMIT_EXECUTOR = ThreadPoolExecutor(
+    max_workers=max(1, WORKER_CONFIG['COMFY_PIPELINE_DEPTH']), thread_name_prefix="comfy-submit"
+)
+_comfy_submissions = {}  # job_id -> Future con {'prompt_id', 'output_node', ...}
+_comfy_submissions_lock = threading.Lock()
+# Solo el POST /prompt va en serie: los prompts entran en la cola de ComfyUI en orden
+_comfy_post_lock = threading.Lock()
+
+
+def submit_comfy_prompt(job_id, endpoint, workflow, timeout=None):
+    """POST /prompt con client_id del worker (eventos WS y tracking por prompt_id)"""
+    payload = {"prompt": workflow, "client_id": WORKER_ID}
+    resp = endpoint.http.post("/prompt", json=payload, timeout=timeout)
+    if resp.status_code != 200 and _reupload_stale_latents(job_id, endpoint, workflow, resp):
+        resp = endpoint.http.post("/prompt", json=payload, timeout=timeout)
+    if resp.status_code != 200:
+        print(f"❌ [Job {job_id}] Error HTTP {resp.status_code}")
+        print(f"   Response: {resp.text[:500]}")
+        raise Exception(f"ComfyUI returned {resp.status_code}: {resp.text[:200]}")
+    
+    prompt_id = resp.json().get("prompt_id")
+    if not prompt_id:
+        raise Exception(f"No prompt_id en respuesta: {resp.text[:200]}")
+    if endpoint.events is not None:
+        # Suscribir ya: el prompt puede ejecutarse antes de que el job lo espere
+        endpoint.events.subscribe(prompt_id)
+    return prompt_id
+
+
+def _reupload_stale_latents(job_id, endpoint, workflow, resp):
+    """
+    ¿ComfyUI rechazó LoadLatent porque su .latent ya no está en input/ (p.ej. se
+    reinició sin que el /ws lo notara)? Se vuelven a subir desde LATENT_CACHE;
+    True si el prompt se puede reenviar tal cual.
+    """
+    if resp.status_code != 400:
+        return False
+    try:
+        node_errors = resp.json().get('node_errors') or {}
+    except ValueError:
+        return False
+    names = [
+        workflow[node_id]['inputs']['latent'] for node_id in node_errors
+        if workflow.get(node_id, {}).get('class_type') == 'LoadLatent'
+    ]
+    if not names:
+        return False
+    for name in names:
+        key = name[len("lat_"):-len(".latent")]
+        endpoint.uploaded_latents.discard(key)
+        if ensure_comfy_latent(endpoint, key) is None:
+            return False  # expulsado de la cache entre medias: no hay qué subir
+    print(f"♻️ [Job {job_id}] {len(names)} latente(s) ya no estaban en {endpoint.url}, re-subidos")
+    return True
+
+
+def cancel_comfy_prompt(endpoint, prompt_id):
+    """Quitar un prompt aún no ejecutado de la cola de ComfyUI"""
+    if endpoint.events is not None:
+        endpoint.events.unsubscribe(prompt_id)
+    try:
+        endpoint.http.post("/queue", json={"delete": [prompt_id]}, idempotent=True)
+    except Exception as e:
+        print(f"⚠️ No se pudo cancelar prompt {prompt_id}: {e}")
+
+
+def build_comfy_job(job, endpoint):
+    """Workflow ComfyUI del job para `endpoint`, o None si el job no va por ComfyUI (Klein)"""
+    job_type = job.get('job_type', 'tryon')
+    if job_type == 'face_enhancement':
+        return build_face_enhancement_workflow(job, endpoint)
+    if job_type == 'avatar_generation':
+        return build_avatar_generation_workflow(job, endpoint)
+    if uses_klein_tryon() or job_type == 'tryoff':
+        return None
+    return build_flux_direct_workflow(job, endpoint)
+
+
+def is_comfy_job(job):
+    return klein_adapter_for(job) is None
+
+
+def _submit_comfy_job(job):
+    """
+    Elegir el ComfyUI menos cargado, subirle los inputs y encolar el workflow.
+    Se llama con los inputs listos y el slot 'comfy_image' ya tomado: lo conserva
+    (y cuenta en el endpoint) hasta que el job recoge su resultado. La VRAM se
+    reserva en run_comfy_job, cuando ComfyUI empieza a ejecutar el prompt.
+    """
+    endpoint = acquire_comfy_endpoint()
+    try:
+        comfy_job = build_comfy_job(job, endpoint)
+        with _comfy_post_lock:
+            comfy_job['prompt_id'] = submit_comfy_prompt(job['id'], endpoint, comfy_job.pop('workflow'))
+    except Exception:
+        release_comfy_endpoint(endpoint)
+        RESOURCE_SEMAPHORES['comfy_image'].release()
+        raise
+    comfy_job['endpoint'] = endpoint
+    comfy_job['awaited'] = False
+    print(f"📤 [Job {job['id']}] En cola de ComfyUI {endpoint.url}, prompt_id: {comfy_job['prompt_id']}")
+    return comfy_job
+
+
+def _comfy_submission(job):
+    """
+    Future del envío del job: el que lanzó presubmit_comfy_jobs o, si no hubo,
+    uno que se resuelve aquí. Las esperas (inputs, slot) van en el hilo del job:
+    un job lento no frena los envíos de los demás.
+    """
+    with _comfy_submissions_lock:
+        future = _comfy_submissions.get(job['id'])
+        if future is not None:
+            return future
+        future = Future()
+        future.set_running_or_notify_cancel()  # ya no se puede cancelar desde discard
+        _comfy_submissions[job['id']] = future
+    try:
+        get_job_inputs(job)
+        RESOURCE_SEMAPHORES['comfy_image'].acquire()
+        future.set_result(_submit_comfy_job(job))
+    except Exception as e:
+        future.set_exception(e)
+    return future
+
+
+def presubmit_comfy_jobs(jobs):
+    """
+    Mantener la cola de ComfyUI alimentada: encolar los prompts de los siguientes
+    COMFY_PIPELINE_DEPTH jobs ComfyUI (además del actual). Sin esperas: solo entran
+    jobs con los inputs ya descargados y si hay slot libre; el resto se reintenta
+    en la siguiente vuelta del main loop.
+    """
+    upcoming = [job for job in jobs if is_comfy_job(job)][:1 + WORKER_CONFIG['COMFY_PIPELINE_DEPTH']]
+    for job in upcoming:
+        if not job_inputs_ready(job):
+            continue
+        with _comfy_submissions_lock:
+            if job['id'] in _comfy_submissions:
+                continue
+            if not RESOURCE_SEMAPHORES['comfy_image'].acquire(blocking=False):
+                return
+            _comfy_submissions[job['id']] = COMFY_SUBMIT_EXECUTOR.submit(_submit_comfy_job, job)
+
+
+def _take_comfy_prompt(comfy_job):
+    """
+    Quedarse con el prompt enviado y sus recursos (slot, endpoint).
+    Lo llaman el job que lo espera y discard_comfy_submissions: solo el primero gana.
+    """
+    with _comfy_submissions_lock:
+        if comfy_job['awaited']:
+            return False
+        comfy_job['awaited'] = True
+        return True
+
+
+def discard_comfy_submissions(job_ids):
+    """Olvidar envíos de jobs terminados; cancelar los prompts que nadie llegó a esperar"""
+    with _comfy_submissions_lock:
+        futures = [_comfy_submissions.pop(job_id, None) for job_id in job_ids]
+    for future in futures:
+        if future is None:
+            continue
+        if future.cancel():
+            # Pre-encolado que no llegó a ejecutarse: su slot lo tomó presubmit_comfy_jobs
+            RESOURCE_SEMAPHORES['comfy_image'].release()
+            continue
+        try:
+            comfy_job = future.result()
+        except Exception:
+            continue
+        if _take_comfy_prompt(comfy_job):
+            cancel_comfy_prompt(comfy_job['endpoint'], comfy_job['prompt_id'])
+            release_comfy_endpoint(comfy_job['endpoint'])
+            RESOURCE_SEMAPHORES['comfy_image'].release()
+
+
+def run_comfy_job(job, progress_message):
+    """Esperar el resultado del prompt del job (pre-encolado o enviado ahora)"""
+    job_id = job['id']
+    update_job_progress(job_id, 15, "Enviando a GPU...")
+    comfy_job = _comfy_submission(job).result()
+    if not _take_comfy_prompt(comfy_job):
+        raise Exception("El prompt ComfyUI del job ya se canceló")
+    
+    try:
+        update_job_progress(job_id, 20, progress_message)
+        # La VRAM de ComfyUI cuenta desde que ejecuta el prompt, no mientras espera en su cola
+        with VRAM_ARBITER.reserve_while_running('comfy_image', comfy_job['endpoint']) as on_start:
+            result_bytes = wait_for_comfy_result(
+                job_id, comfy_job['endpoint'], comfy_job['prompt_id'], comfy_job['output_node'],
+                max_wait=comfy_job['max_wait'], total_steps=comfy_job['total_steps'], on_start=on_start,
+            )
+        if comfy_job.get('latent_outputs'):
+            # Fuera del camino del job: el resultado ya está, los latentes van a la cache
+            DOWNLOAD_EXECUTOR.submit(
+                harvest_kontext_latents, comfy_job['endpoint'], comfy_job['prompt_id'], comfy_job['latent_outputs']
+            )
+        return result_bytes
+    finally:
+        release_comfy_endpoint(comfy_job['endpoint'])
+        RESOURCE_SEMAPHORES['comfy_image'].release()
+
+
+# ============================================
+# DESCARGAS EN PARALELO
+# Keep-alive: las imágenes del mismo host (Storage / CDN del catálogo)
+# reutilizan la conexión TLS en vez de abrir una por imagen
+# ============================================
+
+DOWNLOAD_HTTP = PooledHTTPClient("descargas", pool_size=WORKER_CONFIG['DOWNLOAD_WORKERS'])
+DOWNLOAD_EXECUTOR = ThreadPoolExecutor(
+    max_workers=WORKER_CONFIG['DOWNLOAD_WORKERS'], thread_name_prefix="download"
+)
+
+
+# ============================================
+# CACHE DE DESCARGAS (direccionada por contenido)
+# Las prendas del catálogo se repiten entre miles de usuarios y el avatar
+# en cada try-on del usuario: URL -> sha256 -> blob en disco.
+# Revalidación con ETag / Last-Modified y expulsión LRU por tamaño.
+# ============================================
+
+class DownloadCache:
+    """
+    Cache en disco de URL -> bytes, con blobs por sha256 e índice persistente.
+    Devuelve vistas mmap de solo lectura de los blobs: el contenido se lee del
+    page cache cuando se usa (decodificar, subir a ComfyUI), no al devolverlo.
+    """
+    
+    def __init__(self, root, max_bytes, fresh_seconds):
+        self.root = Path(root)
+        self.max_bytes = max_bytes
+        self.fresh_seconds = fresh_seconds
+        self.stats = {'hits': 0, 'revalidated': 0, 'misses': 0, 'evictions': 0, 'bytes_saved': 0}
+        self._lock = threading.Lock()
+        self._urls = {}                # url -> {'sha256', 'etag', 'last_modified', 'validated_at'}
+        self._blobs = OrderedDict()    # sha256 -> tamaño, en orden LRU (último = más reciente)
+        self._total_bytes = 0
+        self._lru_dirty = False       # hits que aún no están en index.json
+        self._last_report = None
+        self.enabled = max_bytes > 0
+        if self.enabled:
+            try:
+                (self.root / "blobs").mkdir(parents=True, exist_ok=True)
+                self._load_index()
+            except OSError as e:
+                print(f"⚠️ Cache de descargas desactivada ({self.root}): {e}")
+                self.enabled = False
+    
+    def _blob_path(self, sha256):
+        return self.root / "blobs" / sha256
+    
+    def _load_index(self):
+        """Recuperar el índice de la ejecución anterior (blobs huérfanos se borran)"""
+        index_path = self.root / "index.json"
+        index = {}
+        if index_path.exists():
+            try:
+                index = json.loads(index_path.read_text())
+            except Exception as e:
+                print(f"⚠️ Índice de cache corrupto, se empieza vacío: {e}")
+        for url, entry in index.get('urls', {}).items():
+            if self._blob_path(entry['sha256']).exists():
+                self._urls[url] = entry
+        for sha256 in index.get('lru', []):
+            path = self._blob_path(sha256)
+            if path.exists() and sha256 not in self._blobs:
+                self._blobs[sha256] = path.stat().st_size
+        for path in (self.root / "blobs").iterdir():
+            if path.name not in self._blobs:
+                path.unlink(missing_ok=True)
+        self._urls = {url: e for url, e in self._urls.items() if e['sha256'] in self._blobs}
+        self._total_bytes = sum(self._blobs.values())
+        if self._blobs:
+            print(f"🗃️ Cache de descargas: {len(self._blobs)} blobs, {self._total_bytes/1024/1024:.0f} MB")
+    
+    def _save_index(self):
+        # Llamar con el lock tomado
+        self._lru_dirty = False
+        tmp_path = self.root / "index.json.tmp"
+        tmp_path.write_text(json.dumps({'urls': self._urls, 'lru': list(self._blobs)}))
+        os.replace(tmp_path, self.root / "index.json")
+    
+    @staticmethod
+    def _map_file(f):
+        """Vista de solo lectura del archivo abierto (sigue válida tras cerrarlo, expulsarlo o renombrarlo)"""
+        if os.fstat(f.fileno()).st_size == 0:
+            return b''
+        return memoryview(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+    
+    @classmethod
+    def _map_blob(cls, path):
+        with open(path, 'rb') as f:
+            return cls._map_file(f)
+    
+    @classmethod
+    def _fetch_uncached(cls, url, timeout):
+        """Sin cache: el body va por chunks a un temporal anónimo, nunca entero en el heap"""
+        resp = DOWNLOAD_HTTP.get(url, timeout=timeout, stream=True)
+        try:
+            resp.raise_for_status()
+            with tempfile.TemporaryFile() as f:
+                for chunk in resp.iter_content(chunk_size=256 * 1024):
+                    f.write(chunk)
+                f.flush()
+                return cls._map_file(f)
+        finally:
+            resp.close()
+    
+    def _read_blob(self, url, entry):
+        """Contenido del blob de la entrada (None si ya no está en disco)"""
+        sha256 = entry['sha256']
+        try:
+            data = self._map_blob(self._blob_path(sha256))
+        except OSError:
+            with self._lock:
+                self._urls.pop(url, None)
+            return None
+        with self._lock:
+            if sha256 in self._blobs:
+                self._blobs.move_to_end(sha256)
+                self._lru_dirty = True  # se guarda en el siguiente report (no en cada hit)
+            self.stats['bytes_saved'] += len(data)
+        return data
+    
+    def _store(self, url, resp):
+        """Volcar el body por chunks a un temporal (hasheando), y guardarlo como blob"""
+        digest = hashlib.sha256()
+        tmp_path = self.root / "blobs" / f"download.{threading.get_ident()}.tmp"
+        try:
+            with open(tmp_path, 'wb') as f:
+                for chunk in resp.iter_content(chunk_size=256 * 1024):
+                    digest.update(chunk)
+                    f.write(chunk)
+            # Mapear antes del rename: la vista sobrevive a os.replace/expulsión
+            data = self._map_blob(tmp_path)
+        except Exception:
+            tmp_path.unlink(missing_ok=True)
+            raise
+        finally:
+            resp.close()
+        
+        sha256 = digest.hexdigest()
+        headers = resp.headers
+        with self._lock:
+            if sha256 in self._blobs:
+                tmp_path.unlink(missing_ok=True)  # mismo contenido desde otra URL
+            else:
+                os.replace(tmp_path, self._blob_path(sha256))
+                self._blobs[sha256] = len(data)
+                self._total_bytes += len(data)
+            self._blobs.move_to_end(sha256)
+            self._urls[url] = {
+                'sha256': sha256,
+                'etag': headers.get('ETag'),
+                'last_modified': headers.get('Last-Modified'),
+                'validated_at': time.time(),
+            }
+            self._evict()
+            self._save_index()
+        return data
+    
+    def _evict(self):
+        # Llamar con el lock tomado: expulsar los blobs menos usados hasta caber
+        while self._total_bytes > self.max_bytes and len(self._blobs) > 1:
+            sha256, size = self._blobs.popitem(last=False)
+            self._total_bytes -= size
+            self._blob_path(sha256).unlink(missing_ok=True)
+            self._urls = {url: e for url, e in self._urls.items() if e['sha256'] != sha256}
+            self.stats['evictions'] += 1
+    
+    def fetch(self, url, timeout=30):
+        """Contenido de `url` (bytes o vista mmap): del disco si está fresca, revalidada (304) o descargada"""
+        if not self.enabled:
+            return self._fetch_uncached(url, timeout)
+        
+        with self._lock:
+            entry = dict(self._urls[url]) if url in self._urls else None
+        
+        if entry and time.time() - entry['validated_at'] < self.fresh_seconds:
+            data = self._read_blob(url, entry)
+            if data is not None:
+                with self._lock:
+                    self.stats['hits'] += 1
+                return data
+            entry = None
+        
+        headers = {}
+        if entry:
+            if entry.get('etag'):
+                headers['If-None-Match'] = entry['etag']
+            if entry.get('last_modified'):
+                headers['If-Modified-Since'] = entry['last_modified']
+        
+        try:
+            resp = DOWNLOAD_HTTP.get(url, headers=headers, timeout=timeout, stream=True)
+        except requests.exceptions.RequestException:
+            if entry:
+                # Origen caído: mejor la copia (posiblemente antigua) que fallar el job
+                data = self._read_blob(url, entry)
+                if data is not None:
+                    print(f"⚠️ Revalidación falló, usando copia en cache: {url[:80]}")
+                    return data
+            raise
+        
+        if resp.status_code == 304 and entry:
+            resp.close()
+            data = self._read_blob(url, entry)
+            if data is not None:
+                with self._lock:
+                    if url in self._urls:
+                        self._urls[url]['validated_at'] = time.time()
+                    self.stats['revalidated'] += 1
+                return data
+            # El blob desapareció: descarga completa
+            resp = DOWNLOAD_HTTP.get(url, timeout=timeout, stream=True)
+        
+        if resp.status_code >= 400:
+            resp.close()
+            resp.raise_for_status()
+        with self._lock:
+            self.stats['misses'] += 1
+        return self._store(url, resp)
+    
+    def report(self):
+        """Loguear las estadísticas si cambiaron desde el último reporte"""
+        if not self.enabled:
+            return
+        with self._lock:
+            if self._lru_dirty:
+                try:
+                    self._save_index()
+                except OSError as e:
+                    print(f"⚠️ No se pudo guardar el índice de la cache: {e}")
+        summary = self.summary()
+        if summary != self._last_report:
+            self._last_report = summary
+            print(f"🗃️ Cache de descargas: {summary}")
+    
+    def summary(self):
+        with self._lock:
+            stats = dict(self.stats)
+            blobs, total = len(self._blobs), self._total_bytes
+        requests_total = stats['hits'] + stats['revalidated'] + stats['misses']
+        hit_rate = (stats['hits'] + stats['revalidated']) / requests_total if requests_total else 0
+        return (
+            f"{hit_rate:.0%} hits ({stats['hits']} directos, {stats['revalidated']} revalidados, "
+            f"{stats['misses']} misses), {blobs} blobs / {total/1024/1024:.0f} MB, "
+            f"{stats['evictions']} expulsados, {stats['bytes_saved']/1024/1024:.0f} MB ahorrados"
+        )
+
+
+DOWNLOAD_CACHE = DownloadCache(
+    WORKER_CONFIG['DOWNLOAD_CACHE_DIR'],
+    WORKER_CONFIG['DOWNLOAD_CACHE_MAX_MB'] * 1024 * 1024,
+    WORKER_CONFIG['DOWNLOAD_CACHE_FRESH_SECONDS'],
+)
+
+
+def fetch_image_bytes(url):
+    """Descargar imagen de URL a memoria (vía cache de descargas)"""
+    try:
+        return DOWNLOAD_CACHE.fetch(url)
+    except Exception as e:
+        print(f"❌ Error descargando {url}: {e}")
+        raise
+
+
+# ============================================
+# PREFETCH DE INPUTS (job N+1 mientras N está en GPU)
+# ============================================
+
+PREFETCH_EXECUTOR = ThreadPoolExecutor(
+    max_workers=WORKER_CONFIG['PREFETCH_WORKERS'], thread_name_prefix="prefetch"
+)
+_prefetch_futures = {}  # job_id -> Future con los inputs staged
+_prefetch_lock = threading.Lock()
+
+
+def uses_klein_tryon():
+    """True si los try-on van por Klein (diffusers) en vez de Kontext (ComfyUI)"""
+    return UNET_CONFIG.get('model_type') == 'klein' and UNET_CONFIG.get('has_tryon_lora')
+
+
+def _stage_image(url, filename, keep_decoded=False):
+    """
+    Descargar una imagen a memoria y decodificarla.
+    Una imagen corrupta falla aquí, antes de ocupar la GPU.
+    """
+    with resource_slot('io'):
+        data = fetch_image_bytes(url)
+    with Image.open(io.BytesIO(data)) as img:
+        decoded = img.convert('RGB')
+    return {
+        'filename': filename,
+        'data': data,
+        'image': decoded if keep_decoded else None,
+        'comfy_names': {},  # endpoint.url -> nombre en ese ComfyUI tras /upload/image
+    }
+
+
+def stage_images_parallel(specs):
+    """
+    Stagear varias imágenes [(url, filename, keep_decoded)] en paralelo, en el orden dado.
+    Si una falla, se propaga su error (el job falla antes de ocupar la GPU).
+    """
+    futures = [DOWNLOAD_EXECUTOR.submit(_stage_image, url, filename, keep_decoded) for url, filename, keep_decoded in specs]
+    return [future.result() for future in futures]
+
+
+def staged_rgb_image(staged):
+    """Imagen RGB de un input staged (decodificada en el prefetch si se pidió)"""
+    if staged.get('image') is not None:
+        return staged['image']
+    return Image.open(io.BytesIO(staged['data'])).convert('RGB')
+
+
+def ensure_comfy_input(staged, endpoint):
+    """Subir (una vez por endpoint) un input staged a ComfyUI y devolver su nombre para LoadImage"""
+    comfy_names = staged['comfy_names']
+    if endpoint.url not in comfy_names:
+        comfy_names[endpoint.url] = upload_comfy_input(endpoint, staged['filename'], staged['data'])
+    return comfy_names[endpoint.url]
+
+
+def stage_job_inputs(job):
+    """
+    Resolver URLs, descargar y decodificar en memoria todo lo que necesita un job.
+    Devuelve {'avatar', 'garments', 'face'}; los workflows ComfyUI suben
+    cada input con ensure_comfy_input al construirse.
+    """
+    job_id = job['id']
+    input_data = job.get('input_data') or {}
+    job_type = job.get('job_type', 'tryon')
+
+    staged = {'avatar': None, 'garments': [], 'face': None}
+
+    if job_type == 'face_enhancement':
+        staged['face'], = stage_images_parallel([(input_data['face_photo_url'], f"face_{job_id}.jpg", False)])
+    elif job_type == 'avatar_generation':
+        staged['face'], = stage_images_parallel([(input_data['face_hd_url'], f"face_hd_{job_id}.jpg", False)])
+    elif job_type == 'tryoff':
+        staged['avatar'], = stage_images_parallel([(input_data['image_url'], f"tryoff_{job_id}.jpg", True)])
+    else:
+        # Klein usa las imágenes en proceso → se guardan decodificadas
+        klein = uses_klein_tryon()
+        max_garments = MAX_KLEIN_GARMENTS if klein else MAX_TRYON_GARMENTS
+        specs = [(input_data['avatar_url'], f"avatar_{job_id}.jpg", klein)]
+        for idx, garment in enumerate(input_data.get('garment_images', [])[:max_garments]):
+            specs.append((garment['url'], f"garment_{job_id}_{idx}.jpg", klein))
+        # Avatar + prendas a la vez: el staging tarda lo que la imagen más lenta
+        staged['avatar'], *staged['garments'] = stage_images_parallel(specs)
+
+    print(f"📥 [Job {job_id}] Inputs listos ({1 + len(staged['garments'])} imágenes)")
+    return staged
+
+
+def prefetch_job_inputs(jobs):
+    """Encolar el staging de inputs de los jobs dados (si no está ya en marcha)"""
+    with _prefetch_lock:
+        for job in jobs:
+            if job['id'] not in _prefetch_futures:
+                future = PREFETCH_EXECUTOR.submit(stage_job_inputs, job)
+                # Inputs listos: el main loop puede pre-encolar su prompt ComfyUI ya
+                future.add_done_callback(lambda _: JOB_WAKEUP.set())
+                _prefetch_futures[job['id']] = future
+
+
+def job_inputs_ready(job):
+    """¿Terminó ya el prefetch de los inputs del job? (sin esperar)"""
+    with _prefetch_lock:
+        future = _prefetch_futures.get(job['id'])
+    return future is not None and future.done()
+
+
+def get_job_inputs(job):
+    """Inputs staged del job: espera al prefetch o lo lanza ahora si no hubo"""
+    prefetch_job_inputs([job])
+    with _prefetch_lock:
+        future = _prefetch_futures[job['id']]
+    return future.result()
+
+
+def discard_prefetched_inputs(job_ids):
+    """Olvidar prefetches de jobs terminados o que no se van a procesar"""
+    with _prefetch_lock:
+        for job_id in job_ids:
+            future = _prefetch_futures.pop(job_id, None)
+            if future is not None:
+                future.cancel()
+
+
+# ============================================
+# CACHE DE ANÁLISIS DE AVATAR (virtual_avatars)
+# Cada try-on lee grok_facial_features / grok_body_analysis del usuario;
+# se cachea por user_id (TTL + LRU) y se precarga para todo el batch
+# ============================================
+
+AVATAR_ANALYSIS_COLUMNS = 'grok_facial_features, grok_body_analysis'
+
+_avatar_cache = OrderedDict()  # user_id -> (expira_en, avatar_info o None si no tiene)
+_avatar_cache_lock = threading.Lock()
+
+
+def _cache_avatar_analysis(user_id, avatar_info):
+    # Llamar con el lock tomado
+    _avatar_cache[user_id] = (time.time() + WORKER_CONFIG['AVATAR_CACHE_TTL_SECONDS'], avatar_info)
+    _avatar_cache.move_to_end(user_id)
+    while len(_avatar_cache) > WORKER_CONFIG['AVATAR_CACHE_MAX_USERS']:
+        _avatar_cache.popitem(last=False)
+
+
+def _cached_avatar_analysis(user_id):
+    """(True, avatar_info) si está en cache y vigente; (False, None) si no"""
+    with _avatar_cache_lock:
+        entry = _avatar_cache.get(user_id)
+        if entry is None or entry[0] < time.time():
+            return False, None
+        _avatar_cache.move_to_end(user_id)
+        return True, entry[1]
+
+
+def get_avatar_analysis(user_id):
+    """Análisis Grok del avatar del usuario (None si no tiene o si la consulta falla)"""
+    if not user_id:
+        return None
+    found, avatar_info = _cached_avatar_analysis(user_id)
+    if found:
+        return avatar_info
+    
+    try:
+        resp = supabase.table('virtual_avatars').select(
+            AVATAR_ANALYSIS_COLUMNS
+        ).eq('user_id', user_id).maybe_single().execute()
+        avatar_info = resp.data if resp and resp.data else None
+    except Exception as e:
+        print(f"⚠️ No avatar info para {user_id}: {e}")
+        return None  # sin cachear: el siguiente job reintenta
     
-    raise Exception(f"Timeout esperando resultado ({max_wait}s)")
+    with _avatar_cache_lock:
+        _cache_avatar_analysis(user_id, avatar_info)
+    return avatar_info
+
 
-def download_image(url, local_path):
-    """Descargar imagen de URL a filesystem local"""
+def prefetch_avatar_analysis(jobs):
+    """Una sola consulta in_() para los usuarios de try-on del batch que no están en cache"""
+    user_ids = {
+        job['user_id'] for job in jobs
+        if job.get('job_type', 'tryon') not in ('face_enhancement', 'avatar_generation', 'tryoff')
+    }
+    missing = [user_id for user_id in user_ids if not _cached_avatar_analysis(user_id)[0]]
+    if not missing:
+        return
     try:
-        resp = requests.get(url, timeout=30)
-        resp.raise_for_status()
-        
-        Path(local_path).parent.mkdir(parents=True, exist_ok=True)
-        
-        with open(local_path, 'wb') as f:
-            f.write(resp.content)
-        
-        return local_path
+        resp = supabase.table('virtual_avatars').select(
+            f"user_id, {AVATAR_ANALYSIS_COLUMNS}"
+        ).in_('user_id', missing).execute()
     except Exception as e:
-        print(f"❌ Error descargando {url}: {e}")
-        raise
+        print(f"⚠️ Error precargando análisis de avatares: {e}")
+        return
+    
+    rows = {row['user_id']: row for row in (resp.data or [])}
+    with _avatar_cache_lock:
+        for user_id in missing:
+            row = rows.get(user_id)
+            if row is not None:
+                row = {key: value for key, value in row.items() if key != 'user_id'}
+            _cache_avatar_analysis(user_id, row)
+
+
+def invalidate_avatar_analysis(user_id):
+    """Este worker acaba de escribir virtual_avatars del usuario"""
+    with _avatar_cache_lock:
+        _avatar_cache.pop(user_id, None)
 
 
 def hex_to_color_name(hex_color):
@@ -369,15 +1987,8 @@ def upload_to_storage(job_id, user_id, image_base64):
         filename = f"tryon_{user_id}_{job_id}_{int(time.time())}.jpg"
         filepath = f"{user_id}/tryons/{filename}"
         
-        # Subir a Supabase
-        result = supabase.storage.from_('avatars').upload(
-            filepath,
-            image_bytes,
-            file_options={"content-type": "image/jpeg"}
-        )
-        
-        # Obtener URL pública
-        public_url = supabase.storage.from_('avatars').get_public_url(filepath)
+        # Subir a Supabase (devuelve la URL pública)
+        public_url = upload_storage_object('avatars', filepath, image_bytes, "image/jpeg")
         
         print(f"✅ Imagen subida a Storage: {public_url}")
         return public_url
@@ -767,149 +2378,786 @@ def build_tryon_prompt(products_metadata):
     prompt = f"""@image 1 is the base avatar (person in white t-shirt and blue jeans).
 {chr(10).join(image_descriptions)}
 
-Edit @image 1 by applying these changes:
-{chr(10).join(instructions)}
+Edit @image 1 by applying these changes:
+{chr(10).join(instructions)}
+
+CRITICAL REQUIREMENTS:
+- Preserve EXACT face, skin tone, and body from @image 1
+- Maintain SAME soft studio lighting as @image 1 (no harsh shadows)
+- Background: solid #FFFFFF pure white (RGB 255,255,255) - same as @image 1
+- Keep SAME color temperature and exposure as @image 1
+- Only change the clothing/accessories as specified
+- Do NOT alter face, hair, skin color, or body proportions
+- Do NOT add shadows on the background
+
+Quality: 4K, consistent lighting, photorealistic, seamless white background."""
+    
+    return prompt
+
+
+# ============================================
+# KLEIN TRY-ON + LTX-2.3 VIDEO (NUEVO)
+# ============================================
+
+def execute_klein_tryon(job):
+    """
+    Try-On con FLUX Klein 9B + LoRA via DIFFUSERS (no ComfyUI)
+    ComfyUI no soporta el CLIP type de Klein, así que usamos diffusers directamente.
+    
+    Input: avatar (person) + hasta 2 prendas (top + bottom)
+    Prompt: TRYON [description]. Replace outfit with [top] and [bottom]...
+    Output: bytes JPEG de la imagen generada
+    """
+    job_id = job['id']
+    print(f"👗 [Job {job_id}] Ejecutando Try-On con Klein LoRA (diffusers)...")
+    
+    # 1. Inputs ya descargados/decodificados por el prefetch (o se descargan ahora)
+    inputs = get_job_inputs(job)
+    avatar_input = inputs['avatar']
+    
+    # 2. Separar prendas en top/bottom
+    garments = job['input_data'].get('garment_images', [])
+    products_metadata = job['input_data'].get('products_metadata', [])
+    
+    top_input = avatar_input  # fallback
+    bottom_input = avatar_input  # fallback
+    top_desc = "the current top unchanged"
+    bottom_desc = "the current bottom unchanged"
+    
+    for idx, garment in enumerate(garments[:MAX_KLEIN_GARMENTS]):
+        garment_input = inputs['garments'][idx]
+        
+        cat = garment.get('category', '')
+        if not cat and idx < len(products_metadata):
+            cat = products_metadata[idx].get('category', '')
+        name = products_metadata[idx].get('name', 'clothing') if idx < len(products_metadata) else 'clothing'
+        
+        if cat in ('top', 'outerwear', 'dress', 'set') or (top_input is avatar_input and cat not in ('bottom', 'shoes', 'footwear')):
+            top_input = garment_input
+            top_desc = name
+        else:
+            bottom_input = garment_input
+            bottom_desc = name
+    
+    # 3. Construir prompt
+    avatar_info = get_avatar_analysis(job['user_id'])
+    
+    person_desc = build_model_description(avatar_info) if avatar_info else "person"
+    prompt = f"TRYON {person_desc}, standing casually. Replace the outfit with {top_desc} and {bottom_desc} as shown in the reference images. The final image is a full body shot."
+    
+    print(f"📝 [Job {job_id}] Prompt: {prompt[:200]}...")
+    
+    update_job_progress(job_id, 15, "Cargando Klein 9B + LoRA...")
+    
+    # 5. Imágenes (decodificadas en el prefetch)
+    images = [staged_rgb_image(staged) for staged in (avatar_input, top_input, bottom_input)]
+    result_bytes = run_klein_job(job_id, 'tryon', prompt, images, "Generando look con Klein LoRA...")
+    
+    print(f"✅ [Job {job_id}] Try-on Klein completado ({len(result_bytes)/1024:.1f} KB)")
+    return result_bytes
+
+
+def execute_klein_tryoff(job):
+    """
+    Try-Off con FLUX Klein 9B + LoRA try-off (misma base residente que el try-on)
+    
+    Input: foto de una persona con la prenda puesta (input_data.image_url)
+    Prompt: TRYOFF extract the [garment] over a white background...
+    Output: bytes JPEG de la prenda sola, estilo foto de producto
+    """
+    job_id = job['id']
+    if 'tryoff' not in klein_adapter_files():
+        raise Exception("Try-off no disponible: falta la LoRA try-off de Klein en esta instancia")
+    print(f"🧥 [Job {job_id}] Ejecutando Try-Off con Klein LoRA (diffusers)...")
+    
+    inputs = get_job_inputs(job)
+    garment_desc = job['input_data'].get('garment_description') or "garment"
+    prompt = (
+        f"TRYOFF extract the {garment_desc} over a white background, product photography style. "
+        "NO HUMAN VISIBLE (the garment must be shown as a standalone product)."
+    )
+    
+    update_job_progress(job_id, 15, "Cargando Klein 9B + LoRA try-off...")
+    
+    result_bytes = run_klein_job(
+        job_id, 'tryoff', prompt, [staged_rgb_image(inputs['avatar'])], "Extrayendo prenda con Klein LoRA..."
+    )
+    
+    print(f"✅ [Job {job_id}] Try-off Klein completado ({len(result_bytes)/1024:.1f} KB)")
+    return result_bytes
+
+
+def run_klein_job(job_id, adapter, prompt, images, message, height=1024, width=768, steps=28):
+    """
+    Generar con Klein + la LoRA `adapter` → bytes JPEG.
+    El pipeline no es reentrante: un job Klein a la vez (slot 'klein').
+    """
+    with resource_slot('klein'):
+        # Admisión de VRAM: Klein vuelve de RAM / ComfyUI libera modelos si hace falta
+        with VRAM_ARBITER.reserve('klein'):
+            return _generate_klein(job_id, adapter, prompt, images, message, height, width, steps)
+
+
+def _generate_klein(job_id, adapter, prompt, images, message, height, width, steps):
+    """Requiere el slot 'klein' y la reserva de VRAM"""
+    import inspect
+    import torch
+    
+    # 4. Pipeline (precargado en el arranque; si no, se carga ahora) + LoRA del job
+    pipeline = load_klein_pipeline()
+    switch_ms = KLEIN_ADAPTERS.activate(pipeline, adapter)
+    
+    update_job_progress(job_id, 20, message)
+    
+    # Embeddings del prompt (memoizados: las plantillas se repiten entre jobs)
+    prompt_kwargs = klein_prompt_kwargs(pipeline, prompt)
+    record_job_metrics(
+        job_id, lora_adapter=adapter, lora_switch_ms=switch_ms,
+        **KLEIN_EMBED_CACHE.job_metrics(prompt_kwargs.pop('_cache_info')),
+    )
+    
+    # Progreso real por step (20% → 50%) y tiempos de cada step
+    step_progress = KleinStepProgress([job_id], steps)
+    if 'callback_on_step_end' in inspect.signature(pipeline.__call__).parameters:
+        prompt_kwargs['callback_on_step_end'] = step_progress
+    
+    seed = int(time.time()) % 999999999
+    
+    # 6. Generar
+    step_progress.start()
+    result = pipeline(
+        image=images,
+        **prompt_kwargs,
+        height=height,
+        width=width,
+        num_inference_steps=steps,
+        guidance_scale=2.5,
+        generator=torch.Generator("cuda").manual_seed(seed),
+    )
+    record_job_metrics(job_id, klein_steps=step_progress.metrics())
+    
+    output_image = result.images[0]
+    
+    # 7. Codificar resultado en memoria (sin pasar por disco)
+    buffer = io.BytesIO()
+    output_image.save(buffer, 'JPEG', quality=95)
+    
+    update_job_progress(job_id, 50, "Look generado!")
+    return buffer.getvalue()
+
+
+class KleinStepProgress:
+    """
+    callback_on_step_end del pipeline Klein: progreso por step (20% → 50%, mismo
+    estilo que la ruta ComfyUI) y duración de cada step para el histograma de it/s
+    """
+    
+    IT_S_BUCKETS = (0.5, 1, 2, 4, 8)  # límites del histograma de it/s
+    
+    def __init__(self, job_ids, total_steps):
+        self.job_ids = job_ids
+        self.total_steps = total_steps
+        self.step_seconds = []
+        self._last = None
+        self._last_progress = 20
+    
+    def start(self):
+        self._last = time.perf_counter()
+    
+    def __call__(self, pipeline, step_index, timestep, callback_kwargs):
+        import torch
+        
+        # Los kernels son asíncronos: sincronizar para medir el step real
+        if torch.cuda.is_available():
+            torch.cuda.synchronize()
+        now = time.perf_counter()
+        self.step_seconds.append(now - self._last)
+        self._last = now
+        
+        current_step = step_index + 1
+        real_progress = 20 + int((current_step / self.total_steps) * 30)
+        if real_progress > self._last_progress:
+            for job_id in self.job_ids:
+                update_job_progress(job_id, real_progress, f"Step {current_step}/{self.total_steps}")
+            self._last_progress = real_progress
+        return callback_kwargs
+    
+    def metrics(self):
+        """Resumen de it/s por step; el primer step incluye la preparación y no cuenta"""
+        timings = self.step_seconds[1:] or self.step_seconds
+        if not timings:
+            return {}
+        rates = sorted(1 / seconds for seconds in timings if seconds > 0)
+        histogram = {}
+        for rate in rates:
+            upper = next((limit for limit in self.IT_S_BUCKETS if rate < limit), None)
+            lower = max((limit for limit in self.IT_S_BUCKETS if limit <= rate), default=0)
+            label = f"{lower}-{upper}" if upper is not None else f">={lower}"
+            histogram[label] = histogram.get(label, 0) + 1
+        return {
+            'steps': len(self.step_seconds),
+            'first_step_s': round(self.step_seconds[0], 3),
+            'mean_it_s': round(len(timings) / sum(timings), 3),
+            'p50_it_s': round(rates[len(rates) // 2], 3),
+            'min_it_s': round(rates[0], 3),
+            'max_it_s': round(rates[-1], 3),
+            'it_s_histogram': histogram,
+        }
+
+
+_klein_pipeline = None  # Global para cachear el pipeline
+_klein_pipeline_lock = threading.Lock()
+KLEIN_STARTUP_METRICS = {}  # tiempos de carga / warmup para vast_instances
+
+
+def klein_local_sources():
+    """
+    Klein local: snapshot diffusers de FLUX.2-klein-base-9B (transformer incluido)
+    en KLEIN_PIPELINE_DIR + LoRAs en formato diffusers en su carpeta loras/.
+    None si falta algo (se cargará desde el hub).
+    """
+    pipeline_dir = WORKER_CONFIG['KLEIN_PIPELINE_DIR']
+    transformer_dir = os.path.join(pipeline_dir, "transformer")
+    adapters = klein_adapter_files()
+    required = [
+        os.path.join(pipeline_dir, "model_index.json"),
+        os.path.join(transformer_dir, "config.json"),
+    ]
+    if 'tryon' in adapters:
+        required.append(os.path.join(UNET_CONFIG['loras_dir'], adapters['tryon']))
+    missing = [path for path in required if not os.path.exists(path)]
+    if 'tryon' not in adapters:
+        missing.append(f"LoRA try-on (*tryon*.safetensors en {os.path.join(pipeline_dir, 'loras')})")
+    if os.path.isdir(transformer_dir) and not any(f.endswith('.safetensors') for f in os.listdir(transformer_dir)):
+        missing.append(os.path.join(transformer_dir, "*.safetensors"))
+    if missing:
+        print(f"   ⚠️ Klein local incompleto, falta: {missing}")
+        return None
+    return {
+        'pipeline_dir': pipeline_dir,
+        'loras_dir': UNET_CONFIG['loras_dir'],
+        'adapters': adapters,
+    }
+
+
+def _load_klein_local(sources, dtype):
+    """Klein desde disco a RAM, sin red (local_files_only): safetensors mapeados en memoria (mmap)"""
+    from diffusers import Flux2KleinPipeline
+    
+    pipeline = Flux2KleinPipeline.from_pretrained(
+        sources['pipeline_dir'],
+        torch_dtype=dtype,
+        use_safetensors=True,
+        local_files_only=True,
+    )
+    # Todas las LoRAs sin fusionar: cambiar de una a otra no relee la base
+    for adapter, weight_name in sources['adapters'].items():
+        pipeline.load_lora_weights(
+            sources['loras_dir'],
+            weight_name=weight_name,
+            adapter_name=adapter,
+            local_files_only=True,
+        )
+        KLEIN_ADAPTERS.loaded.add(adapter)
+    return pipeline
+
+
+def _load_klein_hub(dtype):
+    """Fallback: Klein + LoRA try-on resueltos contra el hub de HuggingFace (a RAM)"""
+    from diffusers import Flux2KleinPipeline
+    
+    pipeline = Flux2KleinPipeline.from_pretrained(
+        KLEIN_MODEL_ID,
+        torch_dtype=dtype,
+        token=os.getenv("HF_TOKEN"),
+    )
+    pipeline.load_lora_weights(
+        "fal/flux-klein-9b-virtual-tryon-lora",
+        weight_name="flux-klein-tryon.safetensors",
+        adapter_name="tryon"
+    )
+    KLEIN_ADAPTERS.loaded.add("tryon")
+    return pipeline
+
+
+def quantize_klein_weights(pipeline, quant):
+    """
+    Cuantizar (weight-only, torchao) los Linear del transformer y del text encoder.
+    Las capas LoRA quedan en bf16: se cuantiza solo la base que envuelven.
+    El pipeline está en RAM: cada Linear se sube a la GPU y se cuantiza allí, así
+    el pico de VRAM no llega a los pesos bf16 completos.
+    Devuelve el modo aplicado ('bf16' si no se pudo cuantizar).
+    """
+    if quant == 'bf16':
+        return quant
+    import torch
+    try:
+        from torchao.quantization import Float8WeightOnlyConfig, Int8WeightOnlyConfig, quantize_
+        configs = {'fp8': Float8WeightOnlyConfig, 'int8': Int8WeightOnlyConfig}
+        
+        def is_base_linear(module, fqn):
+            return isinstance(module, torch.nn.Linear) and 'lora_' not in fqn
+        
+        for component in (pipeline.transformer, pipeline.text_encoder):
+            quantize_(component, configs[quant](), filter_fn=is_base_linear, device="cuda")
+        return quant
+    except Exception as e:
+        print(f"⚠️ No se pudo cuantizar Klein a {quant}, se queda en bf16: {e}")
+        return 'bf16'
+
+
+def build_klein_pipeline(quant):
+    """
+    Pipeline Klein con todas sus LoRAs y los pesos en `quant` (sin cachear).
+    Se carga en RAM, se cuantiza y solo entonces pasa entero a la GPU.
+    """
+    import torch
+    
+    sources = klein_local_sources()
+    pipeline = None
+    if sources:
+        print(f"   📂 Klein local (offline): {sources['pipeline_dir']} + LoRAs {sorted(sources['adapters'])}")
+        try:
+            pipeline = _load_klein_local(sources, torch.bfloat16)
+        except Exception as e:
+            # Snapshot corrupto / incompleto: mejor depender de la red que no tener Klein
+            print(f"   ⚠️ Klein local falló, se usa el hub: {e}")
+            KLEIN_ADAPTERS.loaded.clear()
+    if pipeline is None:
+        print(f"   ⚠️ Cargando Klein desde el hub de HuggingFace (depende de la red)")
+        pipeline = _load_klein_hub(torch.bfloat16)
+    
+    applied = quantize_klein_weights(pipeline, quant)
+    pipeline.to("cuda")
+    KLEIN_ADAPTERS.active = None
+    KLEIN_ADAPTERS.activate(pipeline, "tryon")
+    return pipeline, applied
+
+
+def load_klein_pipeline():
+    """Cargar Klein + LoRA try-on en VRAM una sola vez (warmup del arranque o primer job)"""
+    global _klein_pipeline
+    with _klein_pipeline_lock:
+        if _klein_pipeline is not None:
+            return _klein_pipeline
+        
+        print(f"   Cargando Flux2KleinPipeline...")
+        start = time.time()
+        pipeline, applied = build_klein_pipeline(UNET_CONFIG.get('klein_quant', 'bf16'))
+        
+        KLEIN_STARTUP_METRICS['klein_load_seconds'] = round(time.time() - start, 1)
+        KLEIN_STARTUP_METRICS['klein_quant'] = applied
+        print(f"   ✅ Klein ({applied}) + LoRAs {sorted(KLEIN_ADAPTERS.loaded)} cargados en VRAM "
+              f"({KLEIN_STARTUP_METRICS['klein_load_seconds']}s)")
+        _klein_pipeline = pipeline
+        return _klein_pipeline
+
+
+def benchmark_klein_quantization(image_paths=None, modes=('bf16', 'fp8', 'int8'), steps=28, seed=1234):
+    """
+    Benchmark offline (python worker_vast.py --benchmark-klein-quant [persona top bottom]):
+    misma generación try-on en cada modo de pesos → s/step, pico de VRAM y PSNR contra bf16.
+    Carga un pipeline por modo, así que necesita VRAM para el bf16.
+    """
+    import gc
+    import torch
+    
+    if UNET_CONFIG.get('model_type') != 'klein':
+        print(f"❌ Klein no detectado en esta instancia (modelo: {UNET_CONFIG.get('name')}): "
+              f"el benchmark necesita el snapshot Klein y sus LoRAs")
+        return None
+    
+    if image_paths:
+        images = [Image.open(path).convert('RGB') for path in image_paths]
+    else:
+        images = [Image.new('RGB', (768, 1024), color) for color in ((200, 180, 170), (40, 60, 120), (60, 60, 60))]
+    prompt = ("TRYON person, standing casually. Replace the outfit with the top and the bottom "
+              "as shown in the reference images. The final image is a full body shot.")
+    
+    def to_tensor(image):
+        return torch.frombuffer(bytearray(image.tobytes()), dtype=torch.uint8).float()
+    
+    results = {}
+    reference = None
+    for mode in modes:
+        pipeline, applied = build_klein_pipeline(mode)
+        if applied != mode:
+            print(f"   ⚠️ {mode} no disponible, se omite")
+        else:
+            torch.cuda.reset_peak_memory_stats()
+            progress = KleinStepProgress([], steps)
+            progress.start()
+            with torch.no_grad():
+                output = pipeline(
+                    image=images, prompt=prompt, height=1024, width=768,
+                    num_inference_steps=steps, guidance_scale=2.5,
+                    generator=torch.Generator("cuda").manual_seed(seed),
+                    callback_on_step_end=progress,
+                ).images[0]
+            timings = progress.step_seconds[1:] or progress.step_seconds
+            entry = {
+                'step_s': round(sum(timings) / len(timings), 4),
+                'peak_vram_gb': round(torch.cuda.max_memory_allocated() / 1024 ** 3, 1),
+            }
+            output.save(f"/workspace/klein_quant_{mode}.png")
+            if reference is None:
+                reference = to_tensor(output)
+            else:
+                mse = torch.mean((to_tensor(output) - reference) ** 2).item()
+                entry['psnr_vs_bf16'] = round(10 * torch.log10(torch.tensor(255.0 ** 2 / max(mse, 1e-10))).item(), 2)
+            results[mode] = entry
+            print(f"   📊 {mode}: {entry}")
+        del pipeline
+        gc.collect()
+        torch.cuda.empty_cache()
+    
+    with open("/workspace/klein_quant_benchmark.json", "w") as f:
+        json.dump(results, f, indent=2)
+    print("✅ Benchmark guardado en /workspace/klein_quant_benchmark.json (+ klein_quant_*.png)")
+    return results
+
+
+def warmup_klein_pipeline():
+    """
+    Arranque: cargar Klein y hacer una inferencia mínima (256px, 2 steps) para
+    compilar kernels y calentar el allocator de CUDA antes del primer usuario.
+    Con KLEIN_TURBO el warmup es la compilación + benchmark a la resolución real.
+    Devuelve False si falla: con los try-ons en Klein el worker no se marca ready.
+    """
+    import torch
+    try:
+        with resource_slot('klein'):
+            pipeline = load_klein_pipeline()
+            VRAM_ARBITER.klein_resident_gb = torch.cuda.memory_allocated() / GB
+            start = time.time()
+            # Como un job: el árbitro hace sitio en ComfyUI si hace falta
+            with VRAM_ARBITER.reserve('klein'):
+                if WORKER_CONFIG['KLEIN_TURBO']:
+                    # Compilar a 256px sería otra forma: se calienta directamente a 768x1024
+                    KLEIN_STARTUP_METRICS['klein_turbo'] = enable_klein_turbo(pipeline)
+                else:
+                    dummy = Image.new('RGB', (256, 256), (255, 255, 255))
+                    with torch.no_grad():
+                        pipeline(
+                            image=[dummy, dummy, dummy],
+                            prompt="warmup",
+                            height=256,
+                            width=256,
+                            num_inference_steps=2,
+                            guidance_scale=2.5,
+                            generator=torch.Generator("cuda").manual_seed(0),
+                        )
+                torch.cuda.synchronize()
+            KLEIN_STARTUP_METRICS['klein_warmup_seconds'] = round(time.time() - start, 1)
+            VRAM_ARBITER.klein_resident_gb = torch.cuda.memory_allocated() / GB
+        print(f"🔥 Klein warmup OK ({KLEIN_STARTUP_METRICS['klein_warmup_seconds']}s)")
+        return True
+    except Exception as e:
+        print(f"❌ Warmup de Klein falló: {e}")
+        return False
+
+
+# ============================================
+# MODO TURBO DE KLEIN (opt-in: KLEIN_TURBO=1)
+# torch.compile del transformer y del decoder del VAE para la forma fija de
+# cada LoRA (768x1024; 3 imágenes el try-on, 1 el try-off). Cada variante se
+# compila en el warmup: cambiar de LoRA en un job no dispara max-autotune.
+# Los artefactos de Inductor quedan en disco: los siguientes arranques leen
+# la cache en lugar de recompilar.
+# Funciona con cualquier pipeline Flux2Klein (también uno mini en CPU).
+# ============================================
+
+KLEIN_ADAPTER_IMAGES = {'tryon': 3, 'tryoff': 1}  # imágenes de referencia por job de cada LoRA
+
+
+def configure_inductor_cache(cache_dir):
+    """Caches persistentes de Inductor en `cache_dir` (vale aunque torch ya esté importado)"""
+    import torch._dynamo.config as dynamo_config
+    import torch._inductor.config as inductor_config
+    
+    os.makedirs(cache_dir, exist_ok=True)
+    # Inductor lee la ruta en cada compilación (cache_dir()), no al importar
+    os.environ["TORCHINDUCTOR_CACHE_DIR"] = cache_dir
+    inductor_config.fx_graph_cache = True
+    if hasattr(inductor_config, 'autotune_local_cache'):
+        inductor_config.autotune_local_cache = True  # resultados de max-autotune
+    try:
+        import torch._functorch.config as functorch_config
+        functorch_config.enable_autograd_cache = True
+    except (ImportError, AttributeError):
+        pass
+    # Una variante compilada por LoRA / forma sin expulsar a las demás
+    dynamo_config.cache_size_limit = max(dynamo_config.cache_size_limit, 4 * len(KLEIN_ADAPTER_IMAGES))
+
+
+def _klein_step_seconds(pipeline, height, width, steps, num_images=3):
+    """Una generación con imágenes dummy; media de segundos por step (sin el primero)"""
+    import torch
+    
+    device = pipeline._execution_device
+    dummy = Image.new('RGB', (width, height), (255, 255, 255))
+    progress = KleinStepProgress([], steps)
+    progress.start()
+    with torch.no_grad():
+        pipeline(
+            image=[dummy] * num_images,
+            prompt="warmup",
+            height=height,
+            width=width,
+            num_inference_steps=steps,
+            guidance_scale=2.5,
+            generator=torch.Generator(device).manual_seed(0),
+            callback_on_step_end=progress,
+        )
+    timings = progress.step_seconds[1:] or progress.step_seconds
+    return sum(timings) / len(timings)
+
+
+def enable_klein_turbo(pipeline, height=1024, width=768, steps=4):
+    """
+    Compilar Klein (una variante por LoRA cargada) y medir eager vs compilado por step.
+    Si la compilación o la primera ejecución compilada fallan, el pipeline vuelve a eager.
+    Devuelve las métricas del benchmark (para vast_instances.klein_turbo).
+    """
+    import torch
+    
+    configure_inductor_cache(WORKER_CONFIG['KLEIN_COMPILE_CACHE_DIR'])
+    
+    # try-on primero: es la forma del benchmark y la LoRA que queda activa
+    adapters = sorted(KLEIN_ADAPTERS.loaded, key=lambda adapter: adapter != 'tryon') or [None]
+    eager_transformer = pipeline.transformer
+    eager_decoder = pipeline.vae.decoder
+    metrics = {'compiled': False}
+    try:
+        eager_step_s = _klein_step_seconds(pipeline, height, width, steps)
+        metrics['eager_step_s'] = round(eager_step_s, 4)
+        
+        # Forma fija (dynamic=False); las LoRAs siguen accesibles a través del módulo compilado
+        pipeline.transformer = torch.compile(eager_transformer, mode="max-autotune-no-cudagraphs", dynamic=False)
+        pipeline.vae.decoder = torch.compile(eager_decoder, dynamic=False)
+        
+        # Compila (o lee la cache de disco) cada LoRA con su número de imágenes
+        metrics['compile_seconds'] = {}
+        for adapter in adapters:
+            if adapter is not None:
+                KLEIN_ADAPTERS.activate(pipeline, adapter)
+            start = time.time()
+            _klein_step_seconds(pipeline, height, width, steps, KLEIN_ADAPTER_IMAGES.get(adapter, 3))
+            metrics['compile_seconds'][adapter or 'base'] = round(time.time() - start, 1)
+        if adapters[0] is not None:
+            KLEIN_ADAPTERS.activate(pipeline, adapters[0])
+        
+        compiled_step_s = _klein_step_seconds(pipeline, height, width, steps)
+        metrics['compiled_step_s'] = round(compiled_step_s, 4)
+        metrics['speedup'] = round(eager_step_s / compiled_step_s, 2)
+        metrics['compiled'] = True
+        print(f"🏎️ Klein turbo: {metrics['eager_step_s']}s/step eager → {metrics['compiled_step_s']}s/step "
+              f"compilado (x{metrics['speedup']}, compilación {metrics['compile_seconds']})")
+    except Exception as e:
+        pipeline.transformer = eager_transformer
+        pipeline.vae.decoder = eager_decoder
+        torch._dynamo.reset()
+        if adapters[0] is not None:
+            KLEIN_ADAPTERS.activate(pipeline, adapters[0])
+        metrics['error'] = str(e)[:200]
+        print(f"⚠️ Klein turbo falló, se sigue en eager: {e}")
+    return metrics
+
+
+# ============================================
+# ADAPTADORES LoRA DE KLEIN
+# Una sola base Klein residente en VRAM; las LoRAs (try-on, try-off, ...)
+# se cargan sin fusionar y cada job activa la suya con set_adapters:
+# el cambio son milisegundos, sin releer los pesos de la base
+# ============================================
+
+def klein_adapter_files():
+    """adapter -> .safetensors en loras_dir (detectados por get_optimal_unet_config)"""
+    files = {}
+    if UNET_CONFIG.get('tryon_lora_name'):
+        files['tryon'] = UNET_CONFIG['tryon_lora_name']
+    if UNET_CONFIG.get('tryoff_lora_name'):
+        files['tryoff'] = UNET_CONFIG['tryoff_lora_name']
+    return files
 
-CRITICAL REQUIREMENTS:
-- Preserve EXACT face, skin tone, and body from @image 1
-- Maintain SAME soft studio lighting as @image 1 (no harsh shadows)
-- Background: solid #FFFFFF pure white (RGB 255,255,255) - same as @image 1
-- Keep SAME color temperature and exposure as @image 1
-- Only change the clothing/accessories as specified
-- Do NOT alter face, hair, skin color, or body proportions
-- Do NOT add shadows on the background
 
-Quality: 4K, consistent lighting, photorealistic, seamless white background."""
+def can_serve_tryoff():
+    """
+    ¿Esta instancia puede hacer try-off? Hace falta Klein con la LoRA try-off
+    (Kontext no tiene try-off y la carga desde el hub solo trae la de try-on).
+    """
+    if UNET_CONFIG.get('model_type') != 'klein' or 'tryoff' not in klein_adapter_files():
+        return False
+    return _klein_pipeline is None or 'tryoff' in KLEIN_ADAPTERS.loaded
+
+
+def claim_excluded_job_types():
+    """Tipos de job que esta instancia no debe reclamar (los sirve otra)"""
+    return [] if can_serve_tryoff() else ['tryoff']
+
+
+def klein_adapter_for(job):
+    """LoRA Klein que necesita el job, o None si no va por Klein"""
+    job_type = job.get('job_type', 'tryon')
+    if job_type == 'tryoff':
+        return 'tryoff'
+    if job_type in ('face_enhancement', 'avatar_generation') or not uses_klein_tryon():
+        return None
+    return 'tryon'
+
+
+class KleinAdapterManager:
+    """LoRA activa del pipeline Klein. Se usa con el slot 'klein' ocupado."""
+    
+    def __init__(self):
+        self.loaded = set()
+        self.active = None
+        self.stats = {'switches': 0, 'switch_seconds': 0.0}
+    
+    def activate(self, pipeline, adapter):
+        """Dejar solo `adapter` activo; devuelve los ms del cambio (0 si ya lo estaba)"""
+        if adapter not in self.loaded:
+            raise Exception(f"LoRA '{adapter}' no cargada en Klein (disponibles: {sorted(self.loaded)})")
+        if self.active == adapter:
+            return 0.0
+        start = time.time()
+        pipeline.set_adapters([adapter], adapter_weights=[1.0])
+        elapsed = time.time() - start
+        self.active = adapter
+        self.stats['switches'] += 1
+        self.stats['switch_seconds'] += elapsed
+        print(f"   🔀 LoRA Klein activa: {adapter} ({elapsed * 1000:.0f} ms)")
+        return round(elapsed * 1000, 1)
+    
+    def report(self):
+        if not self.loaded:
+            return
+        switches = self.stats['switches']
+        avg_ms = self.stats['switch_seconds'] * 1000 / switches if switches else 0.0
+        print(f"🔀 LoRAs Klein: activa {self.active} de {sorted(self.loaded)}, "
+              f"{switches} cambios (media {avg_ms:.0f} ms)")
+
+
+KLEIN_ADAPTERS = KleinAdapterManager()
+
+
+def group_jobs_by_adapter(jobs):
+    """
+    Dentro de cada prioridad, agrupar los jobs Klein por LoRA empezando por la
+    activa (menos cambios de adaptador). El orden de llegada se mantiene dentro de cada grupo.
+    """
+    active = KLEIN_ADAPTERS.active
     
-    return prompt
+    def key(job):
+        adapter = klein_adapter_for(job) or active
+        return (-(job.get('priority') or 0), adapter != active, adapter or '')
+    
+    return sorted(jobs, key=key)
 
 
 # ============================================
-# KLEIN TRY-ON + LTX-2.3 VIDEO (NUEVO)
+# CACHE DE EMBEDDINGS DE PROMPT (Klein)
+# Los prompts salen de pocas plantillas: el text encoder solo corre
+# para prompts nuevos; los embeddings viven en VRAM con LRU por bytes
 # ============================================
 
-def execute_klein_tryon(job):
+KLEIN_MODEL_ID = "black-forest-labs/FLUX.2-klein-base-9B"
+
+
+class PromptEmbeddingCache:
+    """LRU de tensores de embedding por (estado del encoder, prompt), acotada por bytes"""
+    
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.enabled = max_bytes > 0
+        self.stats = {'hits': 0, 'misses': 0, 'encode_seconds': 0.0, 'saved_seconds': 0.0}
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # clave -> (tensor, bytes)
+        self._total_bytes = 0
+    
+    def get_or_encode(self, key, encode):
+        """(tensor, info) — info: {'hit', 'seconds'} (tiempo de encode, o ahorrado si hit)"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                self.stats['hits'] += 1
+                # Tiempo ahorrado estimado = encode medio observado
+                saved = self.stats['encode_seconds'] / max(1, self.stats['misses'])
+                self.stats['saved_seconds'] += saved
+                return entry[0], {'hit': True, 'seconds': saved}
+        
+        start = time.time()
+        tensor = encode()
+        elapsed = time.time() - start
+        size = tensor.element_size() * tensor.numel()
+        with self._lock:
+            self.stats['misses'] += 1
+            self.stats['encode_seconds'] += elapsed
+            if self.enabled and size <= self.max_bytes:
+                self._entries[key] = (tensor, size)
+                self._total_bytes += size
+                while self._total_bytes > self.max_bytes:
+                    _, (_, old_size) = self._entries.popitem(last=False)
+                    self._total_bytes -= old_size
+        return tensor, {'hit': False, 'seconds': elapsed}
+    
+    def job_metrics(self, info):
+        """Métricas para result_metadata del job"""
+        with self._lock:
+            total = self.stats['hits'] + self.stats['misses']
+            return {
+                'prompt_embed_cache': 'hit' if info['hit'] else 'miss',
+                'text_encode_saved_ms' if info['hit'] else 'text_encode_ms': round(info['seconds'] * 1000),
+                'prompt_embed_hit_rate': round(self.stats['hits'] / total, 3) if total else 0.0,
+                'prompt_embed_saved_s_total': round(self.stats['saved_seconds'], 1),
+            }
+
+
+KLEIN_EMBED_CACHE = PromptEmbeddingCache(WORKER_CONFIG['KLEIN_EMBED_CACHE_MB'] * 1024 * 1024)
+
+
+def klein_embed_key(pipeline, prompt):
     """
-    Try-On con FLUX Klein 9B + LoRA via DIFFUSERS (no ComfyUI)
-    ComfyUI no soporta el CLIP type de Klein, así que usamos diffusers directamente.
-    
-    Input: avatar (person) + hasta 2 prendas (top + bottom)
-    Prompt: TRYON [description]. Replace outfit with [top] and [bottom]...
-    Output: ruta local de la imagen generada
+    Clave del embedding: todo lo que cambia la salida del text encoder además del
+    prompt. Pesos cuantizados (el modo aplicado de verdad) y, si la LoRA toca el
+    text encoder, el adapter activo.
+    """
+    quant = KLEIN_STARTUP_METRICS.get('klein_quant') or UNET_CONFIG.get('klein_quant', 'bf16')
+    text_encoder = getattr(pipeline, 'text_encoder', None)
+    adapter = KLEIN_ADAPTERS.active if getattr(text_encoder, 'peft_config', None) else None
+    return (KLEIN_MODEL_ID, quant, adapter, prompt)
+
+
+def klein_prompt_kwargs(pipeline, prompt):
+    """
+    kwargs de prompt para Flux2KleinPipeline: prompt_embeds precalculados
+    (y el negativo vacío si el pipeline lo admite, para CFG).
+    Si encode_prompt no es compatible, se vuelve a prompt=texto.
     """
+    import inspect
     import torch
-    from diffusers import Flux2KleinPipeline
-    
-    job_id = job['id']
-    print(f"👗 [Job {job_id}] Ejecutando Try-On con Klein LoRA (diffusers)...")
-    
-    COMFY_INPUT_DIR = "/workspace/ComfyUI/input"
-    OUTPUT_DIR = "/workspace/ComfyUI/output"
-    Path(COMFY_INPUT_DIR).mkdir(parents=True, exist_ok=True)
-    Path(OUTPUT_DIR).mkdir(parents=True, exist_ok=True)
-    
-    # 1. Descargar avatar (persona)
-    avatar_url = job['input_data']['avatar_url']
-    avatar_path = f"{COMFY_INPUT_DIR}/person_{job_id}.jpg"
-    download_image(avatar_url, avatar_path)
     
-    # 2. Descargar prendas y separar top/bottom
-    garments = job['input_data'].get('garment_images', [])
-    products_metadata = job['input_data'].get('products_metadata', [])
-    
-    top_path = avatar_path  # fallback
-    bottom_path = avatar_path  # fallback
-    top_desc = "the current top unchanged"
-    bottom_desc = "the current bottom unchanged"
-    
-    for idx, garment in enumerate(garments[:2]):
-        path = f"{COMFY_INPUT_DIR}/garment_{job_id}_{idx}.jpg"
-        download_image(garment['url'], path)
-        
-        cat = garment.get('category', '')
-        if not cat and idx < len(products_metadata):
-            cat = products_metadata[idx].get('category', '')
-        name = products_metadata[idx].get('name', 'clothing') if idx < len(products_metadata) else 'clothing'
-        
-        if cat in ('top', 'outerwear', 'dress', 'set') or (top_path == avatar_path and cat not in ('bottom', 'shoes', 'footwear')):
-            top_path = path
-            top_desc = name
-        else:
-            bottom_path = path
-            bottom_desc = name
+    def encode(text):
+        with torch.no_grad():
+            prompt_embeds, _text_ids = pipeline.encode_prompt(
+                prompt=text, device=pipeline._execution_device, num_images_per_prompt=1,
+            )
+        return prompt_embeds
     
-    # 3. Construir prompt
-    avatar_info = None
     try:
-        user_id = job['user_id']
-        resp = supabase.table('virtual_avatars').select(
-            'grok_facial_features, grok_body_analysis'
-        ).eq('user_id', user_id).maybe_single().execute()
-        if resp.data:
-            avatar_info = resp.data
-    except:
-        pass
-    
-    person_desc = build_model_description(avatar_info) if avatar_info else "person"
-    prompt = f"TRYON {person_desc}, standing casually. Replace the outfit with {top_desc} and {bottom_desc} as shown in the reference images. The final image is a full body shot."
-    
-    print(f"📝 [Job {job_id}] Prompt: {prompt[:200]}...")
-    
-    update_job_progress(job_id, 15, "Cargando Klein 9B + LoRA...")
-    
-    # 4. Cargar pipeline (se cachea en memoria después de la primera vez)
-    global _klein_pipeline
-    if '_klein_pipeline' not in globals() or _klein_pipeline is None:
-        print(f"   Cargando Flux2KleinPipeline por primera vez...")
-        _klein_pipeline = Flux2KleinPipeline.from_pretrained(
-            "black-forest-labs/FLUX.2-klein-base-9B",
-            torch_dtype=torch.bfloat16,
-            token=os.getenv("HF_TOKEN"),
-        ).to("cuda")
-        
-        # Cargar LoRA try-on
-        _klein_pipeline.load_lora_weights(
-            "fal/flux-klein-9b-virtual-tryon-lora",
-            weight_name="flux-klein-tryon.safetensors",
-            adapter_name="tryon"
+        prompt_embeds, info = KLEIN_EMBED_CACHE.get_or_encode(
+            klein_embed_key(pipeline, prompt), lambda: encode(prompt)
         )
-        _klein_pipeline.set_adapters("tryon", adapter_weights=1.0)
-        _klein_pipeline.fuse_lora(adapter_names=["tryon"], lora_scale=1.0)
-        print(f"   ✅ Klein + LoRA cargados en VRAM")
-    else:
-        print(f"   ✅ Klein ya cargado (reutilizando)")
-    
-    update_job_progress(job_id, 20, "Generando look con Klein LoRA...")
-    
-    # 5. Cargar imágenes
-    person_img = Image.open(avatar_path).convert('RGB')
-    top_img = Image.open(top_path).convert('RGB')
-    bottom_img = Image.open(bottom_path).convert('RGB')
-    
-    seed = int(time.time()) % 999999999
-    
-    # 6. Generar try-on
-    result = _klein_pipeline(
-        image=[person_img, top_img, bottom_img],
-        prompt=prompt,
-        height=1024,
-        width=768,
-        num_inference_steps=28,
-        guidance_scale=2.5,
-        generator=torch.Generator("cuda").manual_seed(seed),
-    )
-    
-    output_image = result.images[0]
-    
-    # 7. Guardar resultado
-    result_path = f"{OUTPUT_DIR}/tryon_{job_id}_{int(time.time())}.jpg"
-    output_image.save(result_path, 'JPEG', quality=95)
-    
-    update_job_progress(job_id, 50, "Look generado!")
-    print(f"✅ [Job {job_id}] Try-on Klein completado: {result_path}")
-    return result_path
-
-_klein_pipeline = None  # Global para cachear el pipeline
+        kwargs = {'prompt_embeds': prompt_embeds, '_cache_info': info}
+        if 'negative_prompt_embeds' in inspect.signature(pipeline.__call__).parameters:
+            kwargs['negative_prompt_embeds'], _ = KLEIN_EMBED_CACHE.get_or_encode(
+                klein_embed_key(pipeline, ""), lambda: encode("")
+            )
+        return kwargs
+    except (AttributeError, TypeError) as e:
+        print(f"⚠️ encode_prompt no disponible en el pipeline, se codifica en cada job: {e}")
+        return {'prompt': prompt, '_cache_info': {'hit': False, 'seconds': 0.0}}
 
 
 def build_lookbook_video_prompt(products_metadata):
@@ -987,51 +3235,33 @@ No pose change. No gaze change. No camera movement.
 No face visible after the first shot. No artifacts. No flicker."""
 
 
-def generate_lookbook_video(job_id, tryon_image_path, user_id, products_metadata):
-    """
-    Generar video lookbook usando LTX-2.3 LOCAL en ComfyUI.
-    Con --highvram y 96GB, LTX-2.3 YA está cargado en VRAM.
-    Sin swap, inferencia directa.
-    """
-    
-    print(f"🎬 [Job {job_id}] Generando video lookbook con LTX-2.3 LOCAL...")
-    
-    import shutil
-    COMFY_INPUT_DIR = "/workspace/ComfyUI/input"
-    video_input_filename = f"tryon_for_video_{job_id}.jpg"
-    video_input_path = f"{COMFY_INPUT_DIR}/{video_input_filename}"
-    shutil.copy2(tryon_image_path, video_input_path)
-    
-    prompt = build_lookbook_video_prompt(products_metadata)
-    print(f"📝 [Job {job_id}] Video prompt:\n{prompt[:300]}...")
-    
-    update_job_progress(job_id, 60, "Generando video lookbook...")
-    
-    seed = int(time.time()) % 999999999
-    ltx_model = UNET_CONFIG.get('ltx_model', 'ltx-2.3-22b-distilled.safetensors')
-    
-    # Workflow ComfyUI para LTX-2.3 image-to-video
-    # Usa nodos de ComfyUI-LTXVideo / ComfyUI-VideoHelperSuite
+def require_ltx_nodes(endpoint):
+    """Workflow LTX-2.3 image-to-video: nodos de ComfyUI-LTXVideo / ComfyUI-VideoHelperSuite en `endpoint`"""
     required_nodes = ["EmptyLTXVLatentVideo", "LTXVConditioning", "VHS_VideoCombine"]
-    ok, missing = wait_for_comfy_nodes(required_nodes, timeout=90)
+    ok, missing = wait_for_comfy_nodes(required_nodes, timeout=90, endpoints=[endpoint])
     if not ok:
         custom_nodes_dir = "/workspace/ComfyUI/custom_nodes"
         installed = sorted(os.listdir(custom_nodes_dir)) if os.path.exists(custom_nodes_dir) else []
         raise Exception(
-            "Faltan nodos requeridos en ComfyUI: "
+            f"Faltan nodos requeridos en ComfyUI {endpoint.url}: "
             f"{', '.join(sorted(missing))}. "
             f"custom_nodes instalados: {installed}"
         )
 
-    video_workflow = {
+
+def build_lookbook_video_workflow(job_id, prompt, seed):
+    """Workflow LTX-2.3 image-to-video (la imagen del nodo "2" se rellena al subirla al endpoint)"""
+    ltx_model = UNET_CONFIG.get('ltx_model', 'ltx-2.3-22b-distilled.safetensors')
+    
+    return {
         # Cargar modelo LTX-2.3
         "1": {
             "inputs": {"ckpt_name": ltx_model},
             "class_type": "CheckpointLoaderSimple"
         },
-        # Cargar imagen try-on como referencia
+        # Cargar imagen try-on como referencia (se sube al endpoint elegido)
         "2": {
-            "inputs": {"image": video_input_filename},
+            "inputs": {"image": None},
             "class_type": "LoadImage"
         },
         # Encode prompt
@@ -1099,55 +3329,67 @@ def generate_lookbook_video(job_id, tryon_image_path, user_id, products_metadata
             "class_type": "VHS_VideoCombine"
         }
     }
+
+
+def generate_lookbook_video(job_id, tryon_image_bytes, user_id, products_metadata):
+    """
+    Generar video lookbook usando LTX-2.3 LOCAL en ComfyUI.
+    Con --highvram y 96GB, LTX-2.3 YA está cargado en VRAM.
+    Sin swap, inferencia directa.
+    """
     
-    payload = {"prompt": video_workflow, "client_id": WORKER_ID}
-    
-    print(f"📤 [Job {job_id}] Enviando workflow LTX-2.3 a ComfyUI...")
-    resp = requests.post(f"{COMFY_URL}/prompt", json=payload, timeout=30)
-    resp.raise_for_status()
+    print(f"🎬 [Job {job_id}] Generando video lookbook con LTX-2.3 LOCAL...")
     
-    prompt_id = resp.json()['prompt_id']
-    print(f"📤 [Job {job_id}] Video prompt_id: {prompt_id}")
+    prompt = build_lookbook_video_prompt(products_metadata)
+    print(f"📝 [Job {job_id}] Video prompt:\n{prompt[:300]}...")
     
-    update_job_progress(job_id, 65, "Procesando video en GPU...")
+    update_job_progress(job_id, 60, "Generando video lookbook...")
     
-    # Esperar resultado (video tarda más que imagen)
-    result_path = wait_for_comfy_result(
-        job_id, prompt_id, '8',
-        max_wait=300,     # 5 min máx
-        total_steps=8
-    )
+    video_workflow = build_lookbook_video_workflow(job_id, prompt, int(time.time()) % 999999999)
     
-    print(f"✅ [Job {job_id}] Video generado: {result_path}")
+    # Slot 'comfy_video': los renders LTX no se amontonan en la cola de ComfyUI
+    with resource_slot('comfy_video'):
+        endpoint = acquire_comfy_endpoint(need_ltx=True)
+        try:
+            require_ltx_nodes(endpoint)
+        except Exception:
+            release_comfy_endpoint(endpoint)
+            raise
+        # LTX + Gemma necesitan hueco: el árbitro puede sacar Klein a RAM
+        vram = VRAM_ARBITER.acquire('comfy_video', endpoint=endpoint)
+        try:
+            video_workflow["2"]["inputs"]["image"] = upload_comfy_input(
+                endpoint, f"tryon_for_video_{job_id}.jpg", tryon_image_bytes
+            )
+            print(f"📤 [Job {job_id}] Enviando workflow LTX-2.3 a ComfyUI {endpoint.url}...")
+            prompt_id = submit_comfy_prompt(job_id, endpoint, video_workflow, timeout=30)
+            print(f"📤 [Job {job_id}] Video prompt_id: {prompt_id}")
+            
+            update_job_progress(job_id, 65, "Procesando video en GPU...")
+            
+            # Esperar resultado (video tarda más que imagen)
+            video_data = wait_for_comfy_result(
+                job_id, endpoint, prompt_id, '8',
+                max_wait=300,     # 5 min máx
+                total_steps=8
+            )
+        finally:
+            VRAM_ARBITER.release(vram)
+            release_comfy_endpoint(endpoint)
+    
+    print(f"✅ [Job {job_id}] Video generado ({len(video_data)/1024/1024:.1f} MB)")
     
     # Subir video a Supabase Storage
     update_job_progress(job_id, 88, "Subiendo video...")
     
-    with open(result_path, 'rb') as f:
-        video_data = f.read()
-    
     video_filename = f"lookbook_{user_id}_{job_id}_{int(time.time())}.mp4"
     storage_path = f"{user_id}/videos/{video_filename}"
     
-    supabase.storage.from_("avatars").upload(
-        storage_path,
-        video_data,
-        file_options={"content-type": "video/mp4", "upsert": False}
-    )
-    
-    public_url = supabase.storage.from_("avatars").get_public_url(storage_path)
-    if isinstance(public_url, dict):
-        public_url = public_url.get('publicUrl') or public_url.get('publicURL') or str(public_url)
+    with resource_slot('io'):
+        public_url = upload_storage_object("avatars", storage_path, video_data, "video/mp4")
     
     print(f"✅ [Job {job_id}] Video subido: {public_url[:80]}...")
     
-    # Limpiar
-    try:
-        os.remove(video_input_path)
-        os.remove(result_path)
-    except:
-        pass
-    
     return public_url
 
 
@@ -1161,17 +3403,20 @@ def execute_face_enhancement(job):
     
     print(f"🎭 [Job {job_id}] Ejecutando face enhancement...")
     
-    # Directorio input de ComfyUI
-    COMFY_INPUT_DIR = "/workspace/ComfyUI/input"
-    Path(COMFY_INPUT_DIR).mkdir(parents=True, exist_ok=True)
+    # Enviar a ComfyUI (o reutilizar el prompt ya encolado) y esperar resultado
+    result_bytes = run_comfy_job(job, "Procesando en GPU...")
+    
+    print(f"✅ [Job {job_id}] Face enhancement completado ({len(result_bytes)/1024:.1f} KB)")
+    return result_bytes
+
+
+def build_face_enhancement_workflow(job, endpoint):
+    """Workflow ComfyUI de face enhancement (img2img + ReferenceLatent de la cara)"""
     
-    # Descargar foto de cara del usuario
-    face_url = job['input_data']['face_photo_url']
-    face_filename = f"face_{job_id}.jpg"
-    face_path = f"{COMFY_INPUT_DIR}/{face_filename}"
+    job_id = job['id']
     
-    print(f"📥 [Job {job_id}] Descargando foto de cara...")
-    download_image(face_url, face_path)
+    # Foto de cara del usuario (prefetch → /upload/image de ComfyUI)
+    face_filename = ensure_comfy_input(get_job_inputs(job)['face'], endpoint)
     
     # Obtener datos del análisis facial si están disponibles
     facial_analysis = job['input_data'].get('facial_analysis', {})
@@ -1367,23 +3612,7 @@ Professional portrait quality."""
         }
     }
     
-    # Enviar a ComfyUI
-    update_job_progress(job_id, 15, "Enviando a GPU...")
-    
-    payload = {"prompt": workflow}
-    resp = requests.post(f"{COMFY_URL}/prompt", json=payload, timeout=60)
-    resp.raise_for_status()
-    
-    prompt_id = resp.json()['prompt_id']
-    print(f"📤 [Job {job_id}] ComfyUI prompt_id: {prompt_id}")
-    
-    update_job_progress(job_id, 20, "Procesando en GPU...")
-    
-    # Esperar resultado con actualizaciones de progreso
-    result_path = wait_for_comfy_result(job_id, prompt_id, '9', max_wait=60, total_steps=8)
-    
-    print(f"✅ [Job {job_id}] Face enhancement completado: {result_path}")
-    return result_path
+    return {'workflow': workflow, 'output_node': '9', 'max_wait': 60, 'total_steps': 8}
 
 
 def execute_avatar_generation(job):
@@ -1396,17 +3625,20 @@ def execute_avatar_generation(job):
     
     print(f"🎭 [Job {job_id}] Generando avatar base...")
     
-    # Directorio input de ComfyUI
-    COMFY_INPUT_DIR = "/workspace/ComfyUI/input"
-    Path(COMFY_INPUT_DIR).mkdir(parents=True, exist_ok=True)
+    # Enviar a ComfyUI (o reutilizar el prompt ya encolado) y esperar resultado
+    result_bytes = run_comfy_job(job, "Generando avatar...")
     
-    # Descargar foto HD de cara (ya generada por face_enhancement)
-    face_url = job['input_data']['face_hd_url']
-    face_filename = f"face_hd_{job_id}.jpg"
-    face_path = f"{COMFY_INPUT_DIR}/{face_filename}"
+    print(f"✅ [Job {job_id}] Avatar base generado ({len(result_bytes)/1024:.1f} KB)")
+    return result_bytes
+
+
+def build_avatar_generation_workflow(job, endpoint):
+    """Workflow ComfyUI de avatar base 9:16 (ReferenceLatent de la cara HD)"""
+    
+    job_id = job['id']
     
-    print(f"📥 [Job {job_id}] Descargando face HD...")
-    download_image(face_url, face_path)
+    # Foto HD de cara (ya generada por face_enhancement, descargada por el prefetch)
+    face_filename = ensure_comfy_input(get_job_inputs(job)['face'], endpoint)
     
     # Datos del usuario
     gender = job['input_data'].get('gender', 'person')
@@ -1590,23 +3822,7 @@ High definition, 4K, photorealistic, natural proportions."""
         }
     }
     
-    # Enviar a ComfyUI
-    update_job_progress(job_id, 15, "Enviando a GPU...")
-    
-    payload = {"prompt": workflow}
-    resp = requests.post(f"{COMFY_URL}/prompt", json=payload, timeout=60)
-    resp.raise_for_status()
-    
-    prompt_id = resp.json()['prompt_id']
-    print(f"📤 [Job {job_id}] ComfyUI prompt_id: {prompt_id}")
-    
-    update_job_progress(job_id, 20, "Generando avatar...")
-    
-    # Esperar resultado con actualizaciones de progreso
-    result_path = wait_for_comfy_result(job_id, prompt_id, '9', max_wait=60, total_steps=8)
-    
-    print(f"✅ [Job {job_id}] Avatar base generado: {result_path}")
-    return result_path
+    return {'workflow': workflow, 'output_node': '9', 'max_wait': 60, 'total_steps': 8}
 
 
 def execute_flux_direct(job):
@@ -1622,43 +3838,223 @@ def execute_flux_direct(job):
     
     print(f"🎬 [Job {job_id}] Ejecutando try-on FLUX Kontext...")
     
-    COMFY_INPUT_DIR = "/workspace/ComfyUI/input"
-    Path(COMFY_INPUT_DIR).mkdir(parents=True, exist_ok=True)
+    # Enviar a ComfyUI (o reutilizar el prompt ya encolado) y esperar resultado
+    # (4K + 30 steps = ~5-10 min)
+    result_bytes = run_comfy_job(job, "Procesando en GPU...")
     
-    # 1. Descargar avatar
-    avatar_url = job['input_data']['avatar_url']
-    avatar_filename = f"avatar_{job_id}.jpg"
-    avatar_path = f"{COMFY_INPUT_DIR}/{avatar_filename}"
-    print(f"📥 [Job {job_id}] Descargando avatar...")
-    download_image(avatar_url, avatar_path)
+    print(f"✅ [Job {job_id}] Imagen generada ({len(result_bytes)/1024:.1f} KB)")
+    return result_bytes
+
+
+# ============================================
+# CACHE DE LATENTES VAE (referencias Kontext)
+# El mismo avatar y las prendas populares se codificaban con el VAE en
+# cada job. Miss: VAEEncode + SaveLatent y el .latent se guarda aquí.
+# Hit: se sube el .latent al ComfyUI y entra por LoadLatent (sin VAE).
+# ============================================
+
+KONTEXT_VAE = "flux2-vae.safetensors"
+KONTEXT_REFERENCE_MEGAPIXELS = 1.0
+
+
+class LatentCache:
+    """Archivos .latent (formato SaveLatent) en disco, por clave; LRU acotada por tamaño"""
+    
+    def __init__(self, root, max_bytes, on_evict=None):
+        self.root = Path(root)
+        self.max_bytes = max_bytes
+        self.on_evict = on_evict
+        self.stats = {'hits': 0, 'misses': 0, 'stored': 0, 'evictions': 0}
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # clave -> tamaño, en orden LRU
+        self._total_bytes = 0
+        self._last_report = None
+        self.enabled = max_bytes > 0
+        if self.enabled:
+            try:
+                self.root.mkdir(parents=True, exist_ok=True)
+                for path in sorted(self.root.glob("*.latent"), key=lambda p: p.stat().st_mtime):
+                    self._entries[path.stem] = path.stat().st_size
+                self._total_bytes = sum(self._entries.values())
+            except OSError as e:
+                print(f"⚠️ Cache de latentes desactivada ({self.root}): {e}")
+                self.enabled = False
+    
+    def _path(self, key):
+        return self.root / f"{key}.latent"
+    
+    def get(self, key):
+        if not self.enabled:
+            return None
+        with self._lock:
+            if key not in self._entries:
+                self.stats['misses'] += 1
+                return None
+            self._entries.move_to_end(key)
+            self.stats['hits'] += 1
+        try:
+            return self._path(key).read_bytes()
+        except OSError:
+            with self._lock:
+                self._total_bytes -= self._entries.pop(key, 0)
+            return None
+    
+    def put(self, key, data):
+        if not self.enabled:
+            return
+        tmp_path = self.root / f"{key}.{threading.get_ident()}.tmp"
+        tmp_path.write_bytes(data)
+        os.replace(tmp_path, self._path(key))
+        evicted = []
+        with self._lock:
+            self._total_bytes += len(data) - self._entries.get(key, 0)
+            self._entries[key] = len(data)
+            self._entries.move_to_end(key)
+            self.stats['stored'] += 1
+            while self._total_bytes > self.max_bytes and len(self._entries) > 1:
+                old_key, size = self._entries.popitem(last=False)
+                self._total_bytes -= size
+                self._path(old_key).unlink(missing_ok=True)
+                self.stats['evictions'] += 1
+                evicted.append(old_key)
+        if self.on_evict:
+            for old_key in evicted:
+                self.on_evict(old_key)
+    
+    def report(self):
+        """Loguear las estadísticas si cambiaron desde el último reporte"""
+        if not self.enabled:
+            return
+        with self._lock:
+            stats = dict(self.stats, entries=len(self._entries), mb=round(self._total_bytes / 1024 / 1024))
+        if stats != self._last_report and stats['hits'] + stats['misses'] > 0:
+            self._last_report = stats
+            print(
+                f"🧬 Cache de latentes: {stats['hits']} hits / {stats['misses']} misses, "
+                f"{stats['entries']} latentes / {stats['mb']} MB, {stats['evictions']} expulsados"
+            )
+
+
+def latent_cache_key(staged, megapixels, vae_name):
+    """Clave del latente: contenido de la imagen + escala + VAE"""
+    if 'sha256' not in staged:
+        staged['sha256'] = hashlib.sha256(staged['data']).hexdigest()
+    return hashlib.sha256(f"{staged['sha256']}:{megapixels}:{vae_name}".encode()).hexdigest()[:40]
+
+
+def _comfy_latent_filename(key):
+    return f"lat_{key}.latent"
+
+
+def _forget_comfy_latent(key):
+    """Latente expulsado: olvidarlo en cada ComfyUI (y borrarlo del input dir si es local)"""
+    for endpoint in COMFY_ENDPOINTS:
+        endpoint.uploaded_latents.discard(key)
+        if endpoint.is_local:
+            try:
+                os.remove(os.path.join("/workspace/ComfyUI/input", _comfy_latent_filename(key)))
+            except OSError:
+                pass
+
+
+LATENT_CACHE = LatentCache(
+    WORKER_CONFIG['LATENT_CACHE_DIR'],
+    WORKER_CONFIG['LATENT_CACHE_MAX_MB'] * 1024 * 1024,
+    on_evict=_forget_comfy_latent,
+)
+
+
+def ensure_comfy_latent(endpoint, key):
+    """Nombre del .latent en el input dir del endpoint (subido si hace falta), o None si no está en cache"""
+    if key in endpoint.uploaded_latents:
+        return _comfy_latent_filename(key)
+    data = LATENT_CACHE.get(key)
+    if data is None:
+        return None
+    # /upload/image guarda cualquier archivo en input/; LoadLatent lista los .latent de ahí
+    name = upload_comfy_input(endpoint, _comfy_latent_filename(key), data)
+    endpoint.uploaded_latents.add(key)
+    return name
+
+
+def add_kontext_reference(workflow, staged, endpoint, load_id, scale_id, latent_id, latent_outputs):
+    """
+    Nodos del latente de referencia de una imagen en `latent_id`:
+    hit → LoadLatent; miss → LoadImage → FluxKontextImageScale → VAEEncode,
+    más un SaveLatent (registrado en latent_outputs) para cachearlo.
+    Devuelve una descripción para los logs.
+    """
+    key = latent_cache_key(staged, KONTEXT_REFERENCE_MEGAPIXELS, KONTEXT_VAE)
+    latent_name = ensure_comfy_latent(endpoint, key)
+    if latent_name:
+        workflow[latent_id] = {
+            "inputs": {"latent": latent_name},
+            "class_type": "LoadLatent"
+        }
+        return f"{staged['filename']} (latente en cache)"
     
-    # 2. Descargar prendas (cada una por separado)
-    MAX_PRODUCTS = 5
-    garments = job['input_data'].get('garment_images', [])
-    garment_filenames = []
+    image_name = ensure_comfy_input(staged, endpoint)
+    workflow[load_id] = {
+        "inputs": {
+            "image": image_name,
+            "upload": "image"
+        },
+        "class_type": "LoadImage"
+    }
+    workflow[scale_id] = {
+        "inputs": {
+            "megapixels": KONTEXT_REFERENCE_MEGAPIXELS,  # HD = ~1MP
+            "image": [load_id, 0]
+        },
+        "class_type": "FluxKontextImageScale"
+    }
+    workflow[latent_id] = {
+        "inputs": {
+            "pixels": [scale_id, 0],
+            "vae": ["10", 0]
+        },
+        "class_type": "VAEEncode"
+    }
+    if LATENT_CACHE.enabled:
+        save_id = f"{latent_id}_save"
+        workflow[save_id] = {
+            "inputs": {
+                "samples": [latent_id, 0],
+                "filename_prefix": f"latent_cache/{key}"
+            },
+            "class_type": "SaveLatent"
+        }
+        latent_outputs[save_id] = key
+    return image_name
+
+
+def harvest_kontext_latents(endpoint, prompt_id, latent_outputs):
+    """Guardar en LATENT_CACHE los latentes que el prompt codificó (outputs de SaveLatent)"""
+    try:
+        history = endpoint.http.get(f"/history/{prompt_id}").json().get(prompt_id, {})
+        outputs = history.get('outputs', {})
+        for node_id, key in latent_outputs.items():
+            for latent_info in outputs.get(node_id, {}).get('latents', [])[:1]:
+                LATENT_CACHE.put(key, fetch_comfy_output(endpoint, latent_info))
+    except Exception as e:
+        print(f"⚠️ No se pudieron cachear latentes de {prompt_id}: {e}")
+
+
+def build_flux_direct_workflow(job, endpoint):
+    """
+    Workflow ComfyUI de try-on FLUX Kontext:
+    avatar + cada prenda → FluxKontextImageScale → VAE → ReferenceLatent encadenados
+    """
     
-    products_to_process = min(len(garments), MAX_PRODUCTS)
-    print(f"👗 [Job {job_id}] Descargando {products_to_process} prendas...")
+    job_id = job['id']
     
-    for idx, garment in enumerate(garments[:MAX_PRODUCTS]):
-        filename = f"garment_{job_id}_{idx}.jpg"
-        path = f"{COMFY_INPUT_DIR}/{filename}"
-        download_image(garment['url'], path)
-        garment_filenames.append(filename)
-        print(f"   → image {idx + 2}: {filename}")
+    # 1-2. Avatar + prendas (cada una por separado), descargadas por el prefetch
+    MAX_PRODUCTS = MAX_TRYON_GARMENTS
+    inputs = get_job_inputs(job)
     
     # 3. Obtener settings y avatar info
     settings = job['input_data'].get('settings', None)
-    avatar_info = None
-    try:
-        user_id = job['user_id']
-        resp = supabase.table('virtual_avatars').select(
-            'grok_facial_features, grok_body_analysis'
-        ).eq('user_id', user_id).maybe_single().execute()
-        if resp.data:
-            avatar_info = resp.data
-    except Exception as e:
-        print(f"⚠️ [Job {job_id}] No avatar info: {e}")
+    avatar_info = get_avatar_analysis(job['user_id'])
     
     # 4. Construir prompt
     products_metadata = job['input_data'].get('products_metadata', [])[:MAX_PRODUCTS]
@@ -1697,7 +4093,7 @@ def execute_flux_direct(job):
         },
         "10": {
             "inputs": {
-                "vae_name": "flux2-vae.safetensors"
+                "vae_name": KONTEXT_VAE
             },
             "class_type": "VAELoader"
         },
@@ -1718,28 +4114,7 @@ def execute_flux_direct(job):
             "class_type": "FluxGuidance"
         },
         
-        # === IMAGE 1: AVATAR ===
-        "42": {
-            "inputs": {
-                "image": avatar_filename,
-                "upload": "image"
-            },
-            "class_type": "LoadImage"
-        },
-        "60": {
-            "inputs": {
-                "megapixels": 1.0,  # HD = ~1MP
-                "image": ["42", 0]
-            },
-            "class_type": "FluxKontextImageScale"
-        },
-        "40": {
-            "inputs": {
-                "pixels": ["60", 0],
-                "vae": ["10", 0]
-            },
-            "class_type": "VAEEncode"
-        },
+        # === IMAGE 1: AVATAR (latente "40": LoadImage 42 → Scale 60 → VAEEncode, o LoadLatent) ===
         # ReferenceLatent 1: Avatar
         "39": {
             "inputs": {
@@ -1773,41 +4148,22 @@ def execute_flux_direct(job):
         },
     }
     
+    latent_outputs = {}  # nodo SaveLatent -> clave de LATENT_CACHE (referencias no cacheadas)
+    avatar_filename = add_kontext_reference(workflow, inputs['avatar'], endpoint, "42", "60", "40", latent_outputs)
+    
     # === AÑADIR CADA PRENDA COMO REFERENCIA ===
     last_ref_node = "39"
-    
-    for idx, garment_filename in enumerate(garment_filenames):
-        load_id = f"g{idx}_load"
-        scale_id = f"g{idx}_scale"
-        encode_id = f"g{idx}_encode"
-        ref_id = f"g{idx}_ref"
-        
-        # LoadImage
-        workflow[load_id] = {
-            "inputs": {
-                "image": garment_filename,
-                "upload": "image"
-            },
-            "class_type": "LoadImage"
-        }
-        
-        # FluxKontextImageScale
-        workflow[scale_id] = {
-            "inputs": {
-                "megapixels": 1.0,  # HD
-                "image": [load_id, 0]
-            },
-            "class_type": "FluxKontextImageScale"
-        }
+    garment_filenames = []
+    
+    for idx, garment in enumerate(inputs['garments']):
+        encode_id = f"g{idx}_encode"
+        ref_id = f"g{idx}_ref"
         
-        # VAEEncode
-        workflow[encode_id] = {
-            "inputs": {
-                "pixels": [scale_id, 0],
-                "vae": ["10", 0]
-            },
-            "class_type": "VAEEncode"
-        }
+        # LoadImage → FluxKontextImageScale → VAEEncode (o LoadLatent si está en cache)
+        garment_filename = add_kontext_reference(
+            workflow, garment, endpoint, f"g{idx}_load", f"g{idx}_scale", encode_id, latent_outputs
+        )
+        garment_filenames.append(garment_filename)
         
         # ReferenceLatent encadenado
         workflow[ref_id] = {
@@ -1864,75 +4220,25 @@ def execute_flux_direct(job):
     print(f"   image 1: Avatar ({avatar_filename})")
     for idx, gf in enumerate(garment_filenames):
         print(f"   image {idx+2}: {gf}")
-    print(f"   Referencias: {1 + len(garment_filenames)}")
+    print(f"   Referencias: {1 + len(garment_filenames)} ({len(latent_outputs)} a codificar con VAE)")
     
-    # Enviar a ComfyUI (formato correcto según docs)
-    payload = {
-        "prompt": workflow,
-        "client_id": WORKER_ID
+    return {
+        'workflow': workflow, 'output_node': '9', 'max_wait': 600, 'total_steps': 30,
+        'latent_outputs': latent_outputs,
     }
-    
-    print(f"📤 [Job {job_id}] Enviando payload a ComfyUI...")
-    print(f"   URL: {COMFY_URL}/prompt")
-    
-    resp = requests.post(
-        f"{COMFY_URL}/prompt",
-        json=payload,
-        headers={"Content-Type": "application/json"},
-        timeout=10
-    )
-    print(f"📥 [Job {job_id}] Respuesta HTTP: {resp.status_code}")
-    
-    if resp.status_code != 200:
-        print(f"❌ [Job {job_id}] Error HTTP {resp.status_code}")
-        print(f"   Response: {resp.text[:500]}")
-        raise Exception(f"ComfyUI returned {resp.status_code}: {resp.text[:200]}")
-    
-    result = resp.json()
-    print(f"📋 [Job {job_id}] Respuesta JSON: {json.dumps(result, indent=2)[:500]}")
-    
-    prompt_id = result.get("prompt_id")
-    
-    if not prompt_id:
-        raise Exception(f"No prompt_id en respuesta: {result}")
-    
-    print(f"✅ [Job {job_id}] Workflow enviado a ComfyUI, prompt_id: {prompt_id}")
-    
-    update_job_progress(job_id, 20, "Procesando en GPU...")
-    
-    # Esperar resultado con actualizaciones de progreso (4K + 30 steps = ~5-10 min)
-    result_path = wait_for_comfy_result(job_id, prompt_id, '9', max_wait=600, total_steps=30)
-    
-    print(f"✅ [Job {job_id}] Imagen generada: {result_path}")
-    return result_path
 
-def upload_result_to_supabase(job_id, user_id, result_path):
-    """Subir resultado a Supabase Storage"""
+def upload_result_to_supabase(job_id, user_id, file_data):
+    """Subir resultado (bytes) a Supabase Storage"""
     
     try:
-        with open(result_path, 'rb') as f:
-            file_data = f.read()
-        
         file_name = f"tryon_{user_id}_{job_id}_{int(time.time())}.jpg"
         storage_path = f"{user_id}/tryons/{file_name}"
         
         print(f"📤 [Job {job_id}] Subiendo a Storage ({len(file_data)/1024:.1f} KB)...")
         
         # Upload a Supabase Storage
-        upload_resp = supabase.storage.from_("avatars").upload(
-            storage_path,
-            file_data,
-            file_options={"content-type": "image/jpeg", "upsert": False}
-        )
-        
-        print(f"📤 Upload response: {upload_resp}")
-        
-        # Obtener URL pública
-        public_url = supabase.storage.from_("avatars").get_public_url(storage_path)
-        
-        # Manejar diferentes formatos de respuesta del cliente Python
-        if isinstance(public_url, dict):
-            public_url = public_url.get('publicUrl') or public_url.get('publicURL') or str(public_url)
+        with resource_slot('io'):
+            public_url = upload_storage_object("avatars", storage_path, file_data, "image/jpeg")
         
         print(f"✅ [Job {job_id}] Subido: {public_url[:80]}...")
         
@@ -1975,8 +4281,8 @@ def process_job(job):
         # FACE ENHANCEMENT / AVATAR (sin cambios)
         # ========================================
         if job_type == 'face_enhancement':
-            result_path = execute_face_enhancement(job)
-            public_url = upload_result_to_supabase(job_id, user_id, result_path)
+            result_bytes = execute_face_enhancement(job)
+            public_url = upload_result_to_supabase(job_id, user_id, result_bytes)
             
             supabase.table('profiles').update({
                 'face_hd_url': public_url,
@@ -2008,18 +4314,17 @@ def process_job(job):
             
             # Completar job
             processing_time = time.time() - start_time
+            finish_job_progress(job_id)
             supabase.table('ai_generation_jobs').update({
                 'status': 'completed', 'progress': 100, 'result_url': public_url,
                 'completed_at': datetime.utcnow().isoformat(),
                 'processing_time_seconds': round(processing_time, 2), 'cost_usd': 0.005,
             }).eq('id', job_id).execute()
-            try: os.remove(result_path)
-            except: pass
             return True
         
         elif job_type == 'avatar_generation':
-            result_path = execute_avatar_generation(job)
-            public_url = upload_result_to_supabase(job_id, user_id, result_path)
+            result_bytes = execute_avatar_generation(job)
+            public_url = upload_result_to_supabase(job_id, user_id, result_bytes)
             
             existing = supabase.table('virtual_avatars').select('id').eq('user_id', user_id).execute()
             if existing.data and len(existing.data) > 0:
@@ -2035,6 +4340,7 @@ def process_job(job):
                     'base_avatar_generated_at': datetime.utcnow().isoformat(),
                     'base_avatar_status': 'completed'
                 }).execute()
+            invalidate_avatar_analysis(user_id)
             
             supabase.table('profiles').update({
                 'avatar_url': public_url,
@@ -2043,13 +4349,30 @@ def process_job(job):
             print(f"✅ [Job {job_id}] Avatar guardado")
             
             processing_time = time.time() - start_time
+            finish_job_progress(job_id)
+            supabase.table('ai_generation_jobs').update({
+                'status': 'completed', 'progress': 100, 'result_url': public_url,
+                'completed_at': datetime.utcnow().isoformat(),
+                'processing_time_seconds': round(processing_time, 2), 'cost_usd': 0.005,
+            }).eq('id', job_id).execute()
+            return True
+        
+        elif job_type == 'tryoff':
+            result_bytes = execute_klein_tryoff(job)
+            public_url = upload_result_to_supabase(job_id, user_id, result_bytes)
+            
+            processing_time = time.time() - start_time
+            finish_job_progress(job_id)
             supabase.table('ai_generation_jobs').update({
                 'status': 'completed', 'progress': 100, 'result_url': public_url,
                 'completed_at': datetime.utcnow().isoformat(),
                 'processing_time_seconds': round(processing_time, 2), 'cost_usd': 0.005,
+                'result_metadata': {
+                    'worker_id': WORKER_ID,
+                    'backend': 'vast',
+                    **pop_job_metrics(job_id),
+                },
             }).eq('id', job_id).execute()
-            try: os.remove(result_path)
-            except: pass
             return True
         
         else:
@@ -2059,12 +4382,12 @@ def process_job(job):
             
             # PASO 1: Generar imagen try-on
             if UNET_CONFIG.get('model_type') == 'klein' and UNET_CONFIG.get('has_tryon_lora'):
-                result_path = execute_klein_tryon(job)
+                result_bytes = execute_klein_tryon(job)
             else:
-                result_path = execute_flux_direct(job)  # Fallback a Kontext
+                result_bytes = execute_flux_direct(job)  # Fallback a Kontext
             
             # Subir imagen a Storage
-            tryon_image_url = upload_result_to_supabase(job_id, user_id, result_path)
+            tryon_image_url = upload_result_to_supabase(job_id, user_id, result_bytes)
             
             # ========================================
             # ENVIAR IMAGEN A LA APP INMEDIATAMENTE
@@ -2072,6 +4395,7 @@ def process_job(job):
             # ========================================
             products_metadata = job['input_data'].get('products_metadata', [])
             
+            finish_job_progress(job_id)
             supabase.table('ai_generation_jobs').update({
                 'progress': 55,
                 'result_url': tryon_image_url,
@@ -2080,7 +4404,8 @@ def process_job(job):
                     'backend': 'vast',
                     'tryon_image_url': tryon_image_url,
                     'video_status': 'generating',
-                    'status_message': 'Look generado! Generando video lookbook...'
+                    'status_message': 'Look generado! Generando video lookbook...',
+                    **get_job_metrics(job_id),
                 }
             }).eq('id', job_id).execute()
             
@@ -2097,84 +4422,293 @@ def process_job(job):
             print(f"📸 [Job {job_id}] Imagen enviada a app, generando video...")
             
             # ========================================
-            # PASO 2: Generar video lookbook (LTX-2.3)
-            # Con 96GB + --highvram, LTX ya está cargado
-            # Si falla, la imagen ya se entregó
-            # ========================================
-            video_url = None
-            try:
-                has_ltx = UNET_CONFIG.get('has_ltx', False)
-                if has_ltx:
-                    video_url = generate_lookbook_video(
-                        job_id, result_path, user_id, products_metadata
-                    )
-                    if tryon_result_id:
-                        supabase.table('tryon_results').update({
-                            'video_url': video_url,
-                            'video_status': 'completed',
-                        }).eq('id', tryon_result_id).execute()
-                    print(f"🎬 [Job {job_id}] Video lookbook listo!")
-                else:
-                    print(f"⚠️ [Job {job_id}] LTX-2.3 no disponible, skip video")
-                    if tryon_result_id:
-                        supabase.table('tryon_results').update({
-                            'video_status': 'skipped',
-                        }).eq('id', tryon_result_id).execute()
-            except Exception as video_err:
-                print(f"⚠️ [Job {job_id}] Video falló (imagen ya entregada): {video_err}")
-                if tryon_result_id:
-                    supabase.table('tryon_results').update({
-                        'video_status': 'failed',
-                    }).eq('id', tryon_result_id).execute()
-            
-            # ========================================
-            # COMPLETAR JOB
+            # PASO 2: Video lookbook en su propia etapa (executor de video)
+            # El hilo del job queda libre para el siguiente try-on
             # ========================================
-            processing_time = time.time() - start_time
-            
-            supabase.table('ai_generation_jobs').update({
-                'status': 'completed',
-                'progress': 100,
-                'result_url': tryon_image_url,
-                'completed_at': datetime.utcnow().isoformat(),
-                'processing_time_seconds': round(processing_time, 2),
-                'cost_usd': 0.013 if video_url else 0.005,
-                'result_metadata': {
-                    'worker_id': WORKER_ID,
-                    'backend': 'vast',
-                    'tryon_image_url': tryon_image_url,
-                    'video_url': video_url,
-                    'video_status': 'completed' if video_url else ('failed' if UNET_CONFIG.get('has_ltx') else 'skipped'),
-                    'status_message': 'Look y video listos!' if video_url else 'Look generado',
-                }
-            }).eq('id', job_id).execute()
-            
-            # Notificar a Vast Manager
-            try:
-                supabase.table('vast_instances').update({
-                    'last_job_at': datetime.utcnow().isoformat(),
-                    'status': 'ready',
-                }).eq('worker_id', WORKER_ID).execute()
-            except:
-                pass
-            
-            print(f"✅ [Job {job_id}] Completado en {processing_time:.1f}s (video: {'✅' if video_url else '❌'})")
-            
-            try: os.remove(result_path)
-            except: pass
+            enqueue_lookbook_video(job, result_bytes, tryon_image_url, tryon_result_id, start_time)
             
             return True
         
     except Exception as e:
         print(f"❌ [Job {job_id}] Error: {e}")
+        mark_job_failed(job_id, e)
+        return False
+
+
+def mark_job_failed(job_id, error):
+    """Marcar job como failed en BD"""
+    finish_job_progress(job_id)
+    pop_job_metrics(job_id)
+    supabase.table('ai_generation_jobs').update({
+        'status': 'failed',
+        'error_message': str(error),
+        'completed_at': datetime.utcnow().isoformat(),
+    }).eq('id', job_id).execute()
+
+
+# ============================================
+# ETAPA DE VIDEO LOOKBOOK (asíncrona)
+# Los renders LTX (hasta 5 min) corren en su propio executor:
+# la imagen de los siguientes usuarios no espera a videos anteriores
+# ============================================
+
+VIDEO_EXECUTOR = ThreadPoolExecutor(
+    max_workers=max(1, WORKER_CONFIG['RESOURCE_SLOTS']['comfy_video']), thread_name_prefix="video"
+)
+_video_backlog = 0
+_video_backlog_lock = threading.Lock()
+
+
+def enqueue_lookbook_video(job, result_bytes, tryon_image_url, tryon_result_id, start_time):
+    """Encolar el video del try-on; el job sigue en processing hasta que termine"""
+    global _video_backlog
+    if not UNET_CONFIG.get('has_ltx', False):
+        # Sin LTX no hay render: completar ya, sin pasar por la cola
+        run_lookbook_video_stage(job, result_bytes, tryon_image_url, tryon_result_id, start_time)
+        return
+    
+    with _video_backlog_lock:
+        _video_backlog += 1
+        backlog = _video_backlog
+    print(f"🎬 [Job {job['id']}] Video encolado ({backlog} en cola de video)")
+    VIDEO_EXECUTOR.submit(run_lookbook_video_stage, job, result_bytes, tryon_image_url, tryon_result_id, start_time)
+
+
+def run_lookbook_video_stage(job, result_bytes, tryon_image_url, tryon_result_id, start_time):
+    """
+    Generar video lookbook (LTX-2.3) y completar el job.
+    Mismo ciclo de vida que antes: tryon_results.video_status
+    generating → completed / failed / skipped.
+    """
+    global _video_backlog
+    job_id = job['id']
+    user_id = job['user_id']
+    products_metadata = job['input_data'].get('products_metadata', [])
+    
+    try:
+        # ========================================
+        # Generar video lookbook (LTX-2.3)
+        # Con 96GB + --highvram, LTX ya está cargado
+        # Si falla, la imagen ya se entregó
+        # ========================================
+        video_url = None
+        try:
+            has_ltx = UNET_CONFIG.get('has_ltx', False)
+            if has_ltx:
+                video_url = generate_lookbook_video(
+                    job_id, result_bytes, user_id, products_metadata
+                )
+                if tryon_result_id:
+                    supabase.table('tryon_results').update({
+                        'video_url': video_url,
+                        'video_status': 'completed',
+                    }).eq('id', tryon_result_id).execute()
+                print(f"🎬 [Job {job_id}] Video lookbook listo!")
+            else:
+                print(f"⚠️ [Job {job_id}] LTX-2.3 no disponible, skip video")
+                if tryon_result_id:
+                    supabase.table('tryon_results').update({
+                        'video_status': 'skipped',
+                    }).eq('id', tryon_result_id).execute()
+        except Exception as video_err:
+            print(f"⚠️ [Job {job_id}] Video falló (imagen ya entregada): {video_err}")
+            if tryon_result_id:
+                supabase.table('tryon_results').update({
+                    'video_status': 'failed',
+                }).eq('id', tryon_result_id).execute()
+        
+        # ========================================
+        # COMPLETAR JOB
+        # ========================================
+        processing_time = time.time() - start_time
         
+        finish_job_progress(job_id)
         supabase.table('ai_generation_jobs').update({
-            'status': 'failed',
-            'error_message': str(e),
+            'status': 'completed',
+            'progress': 100,
+            'result_url': tryon_image_url,
             'completed_at': datetime.utcnow().isoformat(),
+            'processing_time_seconds': round(processing_time, 2),
+            'cost_usd': 0.013 if video_url else 0.005,
+            'result_metadata': {
+                'worker_id': WORKER_ID,
+                'backend': 'vast',
+                'tryon_image_url': tryon_image_url,
+                'video_url': video_url,
+                'video_status': 'completed' if video_url else ('failed' if UNET_CONFIG.get('has_ltx') else 'skipped'),
+                'status_message': 'Look y video listos!' if video_url else 'Look generado',
+                **pop_job_metrics(job_id),
+            }
         }).eq('id', job_id).execute()
         
-        return False
+        # Notificar a Vast Manager
+        try:
+            supabase.table('vast_instances').update({
+                'last_job_at': datetime.utcnow().isoformat(),
+                'status': 'ready',
+            }).eq('worker_id', WORKER_ID).execute()
+        except:
+            pass
+        
+        print(f"✅ [Job {job_id}] Completado en {processing_time:.1f}s (video: {'✅' if video_url else '❌'})")
+    
+    except Exception as e:
+        print(f"❌ [Job {job_id}] Error completando job: {e}")
+        try:
+            mark_job_failed(job_id, e)
+        except Exception as mark_err:
+            print(f"⚠️ [Job {job_id}] No se pudo marcar como failed: {mark_err}")
+    
+    finally:
+        if UNET_CONFIG.get('has_ltx', False):
+            with _video_backlog_lock:
+                _video_backlog -= 1
+
+# ============================================
+# WARMUP DE COMFYUI
+# Antes de marcar ready, cada endpoint ejecuta versiones mínimas (baja
+# resolución, 2 steps) de los workflows que va a servir: la carga de
+# UNET/CLIP/VAE/LTX la paga el warmup, no el primer usuario.
+# Cada workflow corre 2 veces: frío (incluye carga) y caliente.
+# ============================================
+
+WARMUP_JOB_PREFIX = "warmup-"
+COMFY_WARMUP_METRICS = {}  # endpoint.url -> {workflow: {'cold_s', 'warm_s'}}
+
+
+def _synthetic_staged_image(filename, color):
+    buffer = io.BytesIO()
+    Image.new('RGB', (256, 256), color).save(buffer, 'JPEG', quality=90)
+    data = buffer.getvalue()
+    return {'filename': filename, 'data': data, 'image': None, 'comfy_names': {}}
+
+
+def _shrink_warmup_workflow(workflow):
+    """Bajar resolución / steps / frames y no guardar latentes en la cache"""
+    for node_id in list(workflow):
+        node = workflow[node_id]
+        inputs = node['inputs']
+        class_type = node['class_type']
+        if class_type == 'SaveLatent':
+            del workflow[node_id]
+        elif class_type == 'Flux2Scheduler':
+            inputs.update(steps=2, width=256, height=256)
+        elif class_type == 'KSampler':
+            inputs['steps'] = 2
+        elif class_type == 'EmptyLTXVLatentVideo':
+            inputs.update(width=256, height=256, length=9)
+        elif class_type == 'ImageScaleToTotalPixels':
+            inputs['megapixels'] = 0.1
+        if 'filename_prefix' in inputs:
+            inputs['filename_prefix'] = f"warmup/{inputs['filename_prefix']}"
+    return workflow
+
+
+def _warmup_jobs():
+    """(nombre, job sintético, inputs staged) de cada workflow de imagen que sirve la instancia"""
+    jobs = [('face', {
+        'id': f"{WARMUP_JOB_PREFIX}face", 'job_type': 'face_enhancement',
+        'user_id': None, 'input_data': {'gender': 'person'},
+    }, {'avatar': None, 'garments': [], 'face': _synthetic_staged_image("warmup_face.jpg", (200, 170, 150))})]
+    if not uses_klein_tryon():
+        jobs.append(('kontext', {
+            'id': f"{WARMUP_JOB_PREFIX}kontext", 'job_type': 'tryon',
+            'user_id': None, 'input_data': {'products_metadata': []},
+        }, {
+            'avatar': _synthetic_staged_image("warmup_avatar.jpg", (210, 210, 210)),
+            'garments': [_synthetic_staged_image("warmup_garment.jpg", (40, 60, 120))],
+            'face': None,
+        }))
+    return jobs
+
+
+def _run_warmup_workflow(endpoint, job_id, workflow, output_node, max_wait, kind='comfy_image'):
+    # Como los jobs reales, por el árbitro: el warmup LTX reserva antes de encolarse (puede
+    # sacar Klein a RAM); el de imagen, cuando ComfyUI empieza a ejecutarlo
+    is_video = kind == 'comfy_video'
+    vram = VRAM_ARBITER.acquire(kind, endpoint=endpoint) if is_video else None
+    try:
+        with VRAM_ARBITER.reserve_while_running(kind, endpoint) as on_start:
+            prompt_id = submit_comfy_prompt(job_id, endpoint, workflow)
+            start = time.time()
+            wait_for_comfy_result(
+                job_id, endpoint, prompt_id, output_node, max_wait=max_wait, total_steps=2,
+                on_start=None if is_video else on_start,
+            )
+        return round(time.time() - start, 1)
+    finally:
+        VRAM_ARBITER.release(vram)
+
+
+def warmup_comfy_endpoint(endpoint):
+    """
+    Ejecutar los warmups en un endpoint. Devuelve True si los workflows de imagen
+    funcionan; si falla el de LTX solo se desactiva el video.
+    """
+    metrics = COMFY_WARMUP_METRICS.setdefault(endpoint.url, {})
+    suffix = COMFY_ENDPOINTS.index(endpoint)
+    
+    for name, job, staged in _warmup_jobs():
+        job = dict(job, id=f"{job['id']}-{suffix}")
+        future = Future()
+        future.set_result(staged)
+        with _prefetch_lock:
+            _prefetch_futures[job['id']] = future
+        try:
+            timings = []
+            for _ in range(2):  # frío + caliente
+                comfy_job = build_comfy_job(job, endpoint)
+                workflow = _shrink_warmup_workflow(comfy_job['workflow'])
+                timings.append(_run_warmup_workflow(endpoint, job['id'], workflow, comfy_job['output_node'], 900))
+            metrics[name] = {'cold_s': timings[0], 'warm_s': timings[1]}
+            print(f"🔥 [{endpoint.url}] Warmup {name}: frío {timings[0]}s → caliente {timings[1]}s")
+        except Exception as e:
+            print(f"❌ [{endpoint.url}] Warmup {name} falló: {e}")
+            return False
+        finally:
+            discard_prefetched_inputs([job['id']])
+    
+    if UNET_CONFIG.get('has_ltx', False):
+        job_id = f"{WARMUP_JOB_PREFIX}ltx-{suffix}"
+        try:
+            require_ltx_nodes(endpoint)
+            staged = _synthetic_staged_image("warmup_video.jpg", (180, 180, 180))
+            timings = []
+            for _ in range(2):
+                workflow = build_lookbook_video_workflow(job_id, "a person standing still", 0)
+                workflow["2"]["inputs"]["image"] = ensure_comfy_input(staged, endpoint)
+                timings.append(_run_warmup_workflow(
+                    endpoint, job_id, _shrink_warmup_workflow(workflow), '8', 900, kind='comfy_video'
+                ))
+            metrics['ltx'] = {'cold_s': timings[0], 'warm_s': timings[1]}
+            print(f"🔥 [{endpoint.url}] Warmup ltx: frío {timings[0]}s → caliente {timings[1]}s")
+        except Exception as e:
+            # Solo este endpoint deja de recibir videos; el resto del pool puede seguir
+            print(f"⚠️ [{endpoint.url}] Warmup LTX falló, sin video lookbook en este endpoint: {e}")
+            endpoint.has_ltx = False
+    
+    return True
+
+
+def warmup_comfy_endpoints():
+    """
+    Warmup en paralelo de todos los endpoints. Los que fallan salen del pool;
+    sin ningún endpoint válido el worker no se marca ready.
+    """
+    global COMFY_ENDPOINTS
+    with ThreadPoolExecutor(max_workers=len(COMFY_ENDPOINTS), thread_name_prefix="comfy-warmup") as pool:
+        results = list(pool.map(warmup_comfy_endpoint, COMFY_ENDPOINTS))
+    
+    failed = [endpoint.url for endpoint, ok in zip(COMFY_ENDPOINTS, results) if not ok]
+    if failed:
+        print(f"⚠️ Endpoints fuera del pool por warmup fallido: {', '.join(failed)}")
+    COMFY_ENDPOINTS = [endpoint for endpoint, ok in zip(COMFY_ENDPOINTS, results) if ok]
+    
+    if UNET_CONFIG.get('has_ltx', False) and COMFY_ENDPOINTS and not any(e.has_ltx for e in COMFY_ENDPOINTS):
+        print("⚠️ Ningún endpoint superó el warmup LTX, video lookbook desactivado")
+        UNET_CONFIG['has_ltx'] = False
+    return bool(COMFY_ENDPOINTS)
+
 
 def send_heartbeat():
     """Enviar heartbeat a Supabase"""
@@ -2185,27 +4719,351 @@ def send_heartbeat():
         }).eq('worker_id', WORKER_ID).execute()
     except Exception as e:
         print(f"⚠️ Error enviando heartbeat: {e}")
+    
+    DOWNLOAD_CACHE.report()
+    LATENT_CACHE.report()
+    KLEIN_ADAPTERS.report()
+    VRAM_ARBITER.report()
+    report_http_pools()
 
-def mark_instance_ready():
-    """Marcar instancia como ready en BD"""
+def mark_instance_ready(startup_metrics=None):
+    """Marcar instancia como ready en BD (con tiempos de carga de modelos si los hay)"""
+    update_data = {
+        'status': 'ready',
+        'ready_at': datetime.utcnow().isoformat(),
+        'health_status': 'healthy',
+    }
     try:
-        supabase.table('vast_instances').update({
-            'status': 'ready',
-            'ready_at': datetime.utcnow().isoformat(),
-            'health_status': 'healthy',
-        }).eq('worker_id', WORKER_ID).execute()
+        try:
+            supabase.table('vast_instances').update(
+                {**update_data, **(startup_metrics or {})}
+            ).eq('worker_id', WORKER_ID).execute()
+        except Exception as e:
+            if not startup_metrics:
+                raise
+            # Columnas de métricas sin migrar: marcar ready igualmente
+            print(f"⚠️ No se pudieron guardar métricas de arranque ({e}), ver Migraciones SQL")
+            supabase.table('vast_instances').update(update_data).eq('worker_id', WORKER_ID).execute()
         
         print(f"✅ Instancia marcada como READY en Supabase")
     except Exception as e:
         print(f"❌ Error marcando ready: {e}")
 
+# ============================================
+# CLAIM ATÓMICO DE JOBS (varios workers Vast)
+# ============================================
+
+# None = sin probar, True/False = la RPC claim_vast_jobs existe o no en la BD
+CLAIM_RPC_AVAILABLE = None
+# False = la RPC desplegada es la de 3 argumentos (sin p_exclude_job_types)
+CLAIM_RPC_EXCLUDE_AVAILABLE = None
+CLAIM_RPC_RETRIES = 3
+# PostgREST: función no encontrada (PGRST202 / 404) o Postgres undefined_function
+RPC_MISSING_CODES = ('PGRST202', '404', '42883')
+
+
+def _rpc_missing(error):
+    """¿El error dice que la RPC no existe? (no un fallo de red / 5xx transitorio)"""
+    return str(getattr(error, 'code', '') or '') in RPC_MISSING_CODES
+
+
+def _job_sort_key(job):
+    """Mismo orden que la cola: prioridad desc, created_at asc"""
+    return (-(job.get('priority') or 0), job.get('created_at') or '')
+
+
+def _call_claim_rpc(params):
+    """RPC claim_vast_jobs con reintentos ante fallos transitorios (red / 5xx)"""
+    for attempt in range(CLAIM_RPC_RETRIES):
+        try:
+            return supabase.rpc('claim_vast_jobs', params).execute().data or []
+        except Exception as e:
+            # Si la función no existe reintentar no sirve de nada
+            if _rpc_missing(e) or attempt == CLAIM_RPC_RETRIES - 1:
+                raise
+            print(f"⚠️ Error en RPC claim_vast_jobs (reintento {attempt + 1}): {e}")
+            time.sleep(attempt + 1)
+
+
+def _release_excluded_claims(jobs, excluded):
+    """Devolver a la cola los jobs que la RPC antigua (sin filtro) reclamó de más"""
+    unwanted = [job['id'] for job in jobs if job.get('job_type') in excluded]
+    if unwanted:
+        release_job_claims(unwanted)
+    return [job for job in jobs if job.get('job_type') not in excluded]
+
+
+def claim_pending_jobs(limit):
+    """
+    Reclamar atómicamente hasta `limit` jobs pendientes para ESTE worker.
+
+    1. RPC `claim_vast_jobs` (FOR UPDATE SKIP LOCKED, ver README)
+    2. Fallback: UPDATE condicional `status='pending'` que devuelve filas
+
+    Solo devuelve los jobs que este worker ha pasado a 'processing' con su
+    lease (claimed_by = WORKER_ID). Dos workers nunca reciben el mismo job.
+    """
+    global CLAIM_RPC_AVAILABLE, CLAIM_RPC_EXCLUDE_AVAILABLE
+
+    excluded = claim_excluded_job_types()
+    if CLAIM_RPC_AVAILABLE is not False:
+        params = {
+            'p_worker_id': WORKER_ID,
+            'p_limit': limit,
+            'p_lease_seconds': WORKER_CONFIG['JOB_LEASE_SECONDS'],
+        }
+        try:
+            if excluded and CLAIM_RPC_EXCLUDE_AVAILABLE is not False:
+                # Solo se manda si hace falta: instancias completas siguen con la RPC antigua
+                try:
+                    jobs = _call_claim_rpc({**params, 'p_exclude_job_types': excluded})
+                    CLAIM_RPC_AVAILABLE = CLAIM_RPC_EXCLUDE_AVAILABLE = True
+                    return sorted(jobs, key=_job_sort_key)
+                except Exception as e:
+                    if not _rpc_missing(e):
+                        raise
+                    # PGRST202 también sale si solo falta la firma nueva (BD sin migrar)
+                    print(f"⚠️ claim_vast_jobs sin p_exclude_job_types, probando la firma antigua: {e}")
+                    CLAIM_RPC_EXCLUDE_AVAILABLE = False
+            jobs = _call_claim_rpc(params)
+            CLAIM_RPC_AVAILABLE = True
+            if excluded:
+                jobs = _release_excluded_claims(jobs, excluded)
+            return sorted(jobs, key=_job_sort_key)
+        except Exception as e:
+            if not _rpc_missing(e):
+                raise
+            print(f"⚠️ RPC claim_vast_jobs no disponible, usando UPDATE condicional: {e}")
+            CLAIM_RPC_AVAILABLE = False
+
+    return claim_pending_jobs_conditional(limit, excluded)
+
+
+def claim_pending_jobs_conditional(limit, excluded_job_types=()):
+    """
+    Claim sin RPC: seleccionar candidatos (solo ids) y pasarlos a processing
+    con un UPDATE condicional. Postgres re-evalúa `status='pending'` sobre la
+    fila bloqueada, así que si otro worker ganó la carrera la fila no vuelve.
+    """
+    query = supabase.table('ai_generation_jobs') \
+        .select('id') \
+        .eq('status', 'pending') \
+        .eq('preferred_backend', 'vast')
+    if excluded_job_types:
+        # job_type NULL = tryon (NOT IN a secas también descartaría los NULL)
+        query = query.or_(f"job_type.is.null,job_type.not.in.({','.join(excluded_job_types)})")
+    candidates = query \
+        .order('priority', desc=True) \
+        .order('created_at') \
+        .limit(limit) \
+        .execute()
+
+    job_ids = [row['id'] for row in (candidates.data or [])]
+    if not job_ids:
+        return []
+
+    now = datetime.utcnow()
+    resp = supabase.table('ai_generation_jobs').update({
+        'status': 'processing',
+        'claimed_by': WORKER_ID,
+        'lease_expires_at': (now + timedelta(seconds=WORKER_CONFIG['JOB_LEASE_SECONDS'])).isoformat(),
+        'started_at': now.isoformat(),
+    }).in_('id', job_ids).eq('status', 'pending').execute()
+
+    claimed = resp.data or []
+    if len(claimed) < len(job_ids):
+        print(f"🔀 {len(job_ids) - len(claimed)} job(s) reclamados por otro worker")
+    return sorted(claimed, key=_job_sort_key)
+
+
+def renew_job_leases():
+    """Extender el lease de todos los jobs que este worker tiene en processing"""
+    try:
+        lease_until = datetime.utcnow() + timedelta(seconds=WORKER_CONFIG['JOB_LEASE_SECONDS'])
+        supabase.table('ai_generation_jobs').update({
+            'lease_expires_at': lease_until.isoformat(),
+        }).eq('claimed_by', WORKER_ID).eq('status', 'processing').execute()
+    except Exception as e:
+        print(f"⚠️ Error renovando leases: {e}")
+
+
+def requeue_expired_leases():
+    """Devolver a pending los jobs de workers muertos (lease caducado)"""
+    try:
+        resp = supabase.table('ai_generation_jobs').update({
+            'status': 'pending',
+            'claimed_by': None,
+            'lease_expires_at': None,
+        }).eq('status', 'processing') \
+          .eq('preferred_backend', 'vast') \
+          .lt('lease_expires_at', datetime.utcnow().isoformat()) \
+          .execute()
+        if resp.data:
+            print(f"♻️ {len(resp.data)} job(s) con lease caducado devueltos a la cola")
+    except Exception as e:
+        print(f"⚠️ Error recuperando leases caducados: {e}")
+
+
+def release_job_claims(job_ids):
+    """Soltar jobs reclamados que este worker no va a procesar (p.ej. al parar)"""
+    if not job_ids:
+        return
+    try:
+        supabase.table('ai_generation_jobs').update({
+            'status': 'pending',
+            'claimed_by': None,
+            'lease_expires_at': None,
+        }).in_('id', list(job_ids)).eq('claimed_by', WORKER_ID).eq('status', 'processing').execute()
+        print(f"↩️ {len(job_ids)} job(s) devueltos a la cola")
+    except Exception as e:
+        print(f"⚠️ Error soltando jobs: {e}")
+
+
+def lease_keeper_loop(stop_event):
+    """Hilo de fondo: renueva leases aunque process_job esté bloqueado en GPU"""
+    while not stop_event.wait(WORKER_CONFIG['HEARTBEAT_INTERVAL_SECONDS']):
+        renew_job_leases()
+        requeue_expired_leases()
+
+
+# ============================================
+# INTAKE PUSH (Supabase Realtime)
+# ============================================
+
+# Se activa cuando llega un INSERT en ai_generation_jobs para 'vast'
+JOB_WAKEUP = threading.Event()
+REALTIME_INTAKE_HEALTHY = False
+
+
+def _on_job_inserted(payload):
+    """Callback Realtime: despertar al main loop (el claim sigue siendo atómico)"""
+    record = (payload or {}).get('data', {}).get('record') or (payload or {}).get('record') or {}
+    if record.get('status', 'pending') == 'pending':
+        print(f"📡 Nuevo job vía Realtime: {record.get('id', '?')}")
+        JOB_WAKEUP.set()
+
+
+def _on_realtime_subscribe(status, err=None):
+    global REALTIME_INTAKE_HEALTHY
+    status_str = str(getattr(status, 'value', status))
+    REALTIME_INTAKE_HEALTHY = status_str == 'SUBSCRIBED'
+    if REALTIME_INTAKE_HEALTHY:
+        print("📡 Realtime: suscrito a INSERTs de ai_generation_jobs (vast)")
+        # Puede haber jobs insertados mientras no estábamos suscritos
+        JOB_WAKEUP.set()
+    else:
+        print(f"⚠️ Realtime: estado {status_str} {err or ''}")
+
+
+def _realtime_intake_thread(acreate_client):
+    """Event loop propio para el cliente Realtime async; reconecta con backoff"""
+    import asyncio
+
+    async def run():
+        global REALTIME_INTAKE_HEALTHY
+        backoff = 2
+        while True:
+            client = None
+            try:
+                client = await acreate_client(SUPABASE_URL, SUPABASE_KEY)
+                channel = client.channel(f"vast-jobs-{WORKER_ID}")
+                channel.on_postgres_changes(
+                    "INSERT",
+                    schema="public",
+                    table="ai_generation_jobs",
+                    filter="preferred_backend=eq.vast",
+                    callback=_on_job_inserted,
+                )
+                await channel.subscribe(_on_realtime_subscribe)
+                backoff = 2
+                while getattr(client.realtime, 'is_connected', True):
+                    await asyncio.sleep(5)
+                print("⚠️ Realtime desconectado, reconectando...")
+            except Exception as e:
+                print(f"⚠️ Error en Realtime intake: {e}")
+            finally:
+                # Cada vuelta crea un cliente nuevo: cerrar canales y socket del anterior
+                if client is not None:
+                    for close in (client.remove_all_channels, client.realtime.close):
+                        try:
+                            await close()
+                        except Exception as e:
+                            print(f"⚠️ Error cerrando cliente Realtime: {e}")
+            REALTIME_INTAKE_HEALTHY = False
+            await asyncio.sleep(backoff)
+            backoff = min(backoff * 2, 60)
+
+    asyncio.run(run())
+
+
+def start_realtime_intake():
+    """
+    Suscribirse a INSERTs de ai_generation_jobs con preferred_backend='vast'.
+    El cliente Realtime de supabase-py es async, así que corre en su propio hilo.
+    Si no está disponible, el worker sigue con polling normal.
+    """
+    if WORKER_CONFIG['JOB_INTAKE_MODE'] != 'realtime':
+        print(f"📋 Intake por polling cada {WORKER_CONFIG['POLL_INTERVAL_SECONDS']}s")
+        return False
+    try:
+        from supabase import acreate_client
+    except ImportError as e:
+        print(f"⚠️ Realtime no disponible en supabase-py ({e}), intake por polling")
+        return False
+    threading.Thread(
+        target=_realtime_intake_thread, args=(acreate_client,),
+        daemon=True, name="realtime-intake",
+    ).start()
+    return True
+
+
+def wait_for_new_jobs():
+    """
+    Dormir hasta que Realtime avise de un job nuevo.
+    Con Realtime sano solo queda el poll de seguridad (30s); si no, polling normal (5s).
+    """
+    if REALTIME_INTAKE_HEALTHY:
+        timeout = min(WORKER_CONFIG['SAFETY_POLL_INTERVAL_SECONDS'], WORKER_CONFIG['HEARTBEAT_INTERVAL_SECONDS'])
+    else:
+        timeout = WORKER_CONFIG['POLL_INTERVAL_SECONDS']
+    woke = JOB_WAKEUP.wait(timeout)
+    JOB_WAKEUP.clear()
+    return woke
+
+
+# ============================================
+# EJECUTOR CONCURRENTE DE JOBS
+# ============================================
+
+JOB_EXECUTOR = ThreadPoolExecutor(
+    max_workers=WORKER_CONFIG['MAX_CONCURRENT_JOBS'], thread_name_prefix="job"
+)
+
+
+def run_claimed_job(job):
+    """Ejecutar un job reclamado en su hilo y despertar al main loop al acabar"""
+    try:
+        if job.get('job_type') in claim_excluded_job_types():
+            # Reclamado por una RPC sin filtro o antes de saber qué LoRAs cargó Klein:
+            # se devuelve a la cola para una instancia que sí lo sirva, sin fallarlo
+            print(f"↩️ [Job {job['id']}] {job['job_type']} no disponible en esta instancia")
+            release_job_claims([job['id']])
+            return False
+        return process_job(job)
+    finally:
+        discard_comfy_submissions([job['id']])
+        discard_prefetched_inputs([job['id']])
+        JOB_WAKEUP.set()
+
+
 def main_loop():
     """Loop principal del worker"""
     
     print("⏳ Esperando a que ComfyUI cargue FLUX.2 en VRAM...")
     print("   Template descarga modelo (~12 min) + carga en VRAM (~5 min)")
     print("   Primera vez puede tardar hasta 20 minutos total")
-    print(f"   Verificando: {COMFY_URL}/system_stats")
+    for endpoint in COMFY_ENDPOINTS:
+        print(f"   Verificando: {endpoint.url}/system_stats")
     
     # Esperar a que ComfyUI esté listo
     max_wait = 600  # 10 minutos (provision-looks.sh ya esperó antes)
@@ -2219,14 +5077,15 @@ def main_loop():
     
     if not check_comfy_ready():
         print(f"❌ ComfyUI no respondió en {max_wait}s")
-        print(f"   URL intentada: {COMFY_URL}")
+        print(f"   URLs intentadas: {', '.join(COMFY_URLS)}")
         print("   Verificar:")
         print("   1. ComfyUI arrancó? → ps aux | grep 'python.*main.py'")
         print("   2. Puerto correcto? → netstat -tulpn | grep 8188")
         print("   3. Logs de ComfyUI → tail /workspace/comfyui.log")
         sys.exit(1)
     
-    print(f"✅ ComfyUI READY en {COMFY_URL}")
+    ready = [endpoint.url for endpoint in COMFY_ENDPOINTS if endpoint.is_ready()]
+    print(f"✅ ComfyUI READY en {', '.join(ready)} ({len(ready)}/{len(COMFY_ENDPOINTS)} del pool)")
     print("   Modelos cargados, listo para procesar jobs")
     
     # Detectar mejor modelo
@@ -2234,12 +5093,59 @@ def main_loop():
     UNET_CONFIG = get_optimal_unet_config()
     print(f"   ⚡ Modelo: {UNET_CONFIG['name']} (dtype: {UNET_CONFIG['dtype']})")
     
-    # Marcar instancia como ready
-    mark_instance_ready()
+    # Árbitro de VRAM: solo si Klein vive en este proceso y comparte GPU con ComfyUI
+    if WORKER_CONFIG['VRAM_ARBITER'] and uses_klein_tryon() and any(e.is_local for e in COMFY_ENDPOINTS):
+        VRAM_ARBITER.configure(True)
+    
+    # Klein: cargar + warmup en segundo plano mientras arranca el resto.
+    # Con el árbitro (Klein y ComfyUI en la misma GPU, p.ej. 48GB) va antes y en serie:
+    # la carga de pesos de Klein no pasa por la admisión y no debe solaparse con LTX
+    klein_warmup = None
+    if uses_klein_tryon():
+        klein_warmup = Future()
+        if VRAM_ARBITER.enabled:
+            print("🔥 Warmup de Klein (antes que ComfyUI: GPU compartida)...")
+            klein_warmup.set_result(warmup_klein_pipeline())
+        else:
+            threading.Thread(
+                target=lambda: klein_warmup.set_result(warmup_klein_pipeline()), daemon=True, name="klein-warmup"
+            ).start()
+    
+    # Eventos de progreso/fin por WebSocket (sin polling de /queue + /history)
+    start_comfy_events()
+    
+    # Progreso de jobs → Supabase en segundo plano (agrupado por job)
+    start_progress_publisher()
+    
+    # Warmup de los workflows ComfyUI (en paralelo con el de Klein si no hay árbitro)
+    print("🔥 Warmup de workflows ComfyUI...")
+    if not warmup_comfy_endpoints():
+        print("❌ Ningún ComfyUI superó el warmup, no se marca ready")
+        sys.exit(1)
+    
+    if klein_warmup is not None:
+        print("⏳ Esperando carga + warmup de Klein...")
+        if not klein_warmup.result():
+            # Como con ComfyUI: sin el modelo de try-on no se anuncia la instancia
+            print("❌ Klein no superó el warmup, no se marca ready")
+            sys.exit(1)
+    
+    # Marcar instancia como ready (el primer usuario ya no paga la carga)
+    mark_instance_ready({**KLEIN_STARTUP_METRICS, 'comfy_warmup': COMFY_WARMUP_METRICS})
     
     # Contadores
     last_heartbeat = time.time()
     jobs_processed_total = 0
+    active_jobs = {}  # job_id -> (job, Future), en orden de claim
+    reported_batch_size = None
+    
+    # Leases de jobs reclamados (se renuevan aunque un job bloquee el loop)
+    lease_stop = threading.Event()
+    threading.Thread(target=lease_keeper_loop, args=(lease_stop,), daemon=True, name="lease-keeper").start()
+    
+    # Intake push: los jobs nuevos despiertan el loop sin esperar al poll
+    start_realtime_intake()
+    is_idle = False
     
     print(f"\n🤖 Worker {WORKER_ID} activo y esperando jobs...\n")
     
@@ -2251,63 +5157,93 @@ def main_loop():
                 send_heartbeat()
                 last_heartbeat = time.time()
             
-            # Buscar jobs pendientes para 'vast'
-            response = supabase.table('ai_generation_jobs') \
-                .select('*') \
-                .eq('status', 'pending') \
-                .eq('preferred_backend', 'vast') \
-                .order('priority', desc=True) \
-                .order('created_at') \
-                .limit(WORKER_CONFIG['MAX_BATCH_SIZE']) \
-                .execute()
+            # Recoger jobs terminados
+            for job_id, (job, future) in list(active_jobs.items()):
+                if future.done():
+                    del active_jobs[job_id]
+                    if not future.exception() and future.result():
+                        jobs_processed_total += 1
             
-            jobs = response.data
+            # Reclamar atómicamente jobs pendientes para 'vast' (hasta llenar el batch).
+            # Los jobs esperando su video siguen en processing: cuentan contra el batch
+            with _video_backlog_lock:
+                video_backlog = _video_backlog
+            capacity = WORKER_CONFIG['MAX_BATCH_SIZE'] - len(active_jobs) - video_backlog
+            jobs = claim_pending_jobs(capacity) if capacity > 0 else []
             
-            if not jobs or len(jobs) == 0:
-                # No hay jobs - marcar como idle
-                supabase.table('vast_instances').update({
-                    'status': 'idle',
-                    'current_batch_size': 0,
-                }).eq('worker_id', WORKER_ID).execute()
-                
-                if jobs_processed_total % 10 == 0 and jobs_processed_total > 0:
-                    print(f"💤 Sin jobs ({jobs_processed_total} procesados total)")
+            if jobs:
+                print(f"\n🚀 {len(jobs)} job(s) nuevos ({len(active_jobs) + len(jobs)} en curso)")
+                jobs = group_jobs_by_adapter(jobs)
+                prefetch_avatar_analysis(jobs)
+            for job in jobs:
+                active_jobs[job['id']] = (job, JOB_EXECUTOR.submit(run_claimed_job, job))
+            
+            if not active_jobs:
+                # No hay jobs - marcar como idle (solo al cambiar de estado)
+                if not is_idle:
+                    supabase.table('vast_instances').update({
+                        'status': 'idle',
+                        'current_batch_size': 0,
+                    }).eq('worker_id', WORKER_ID).execute()
+                    is_idle = True
+                    reported_batch_size = 0
+                    
+                    if jobs_processed_total % 10 == 0 and jobs_processed_total > 0:
+                        print(f"💤 Sin jobs ({jobs_processed_total} procesados total)")
                 
-                time.sleep(WORKER_CONFIG['POLL_INTERVAL_SECONDS'])
+                wait_for_new_jobs()
                 continue
             
-            batch_size = len(jobs)
-            print(f"\n🚀 Procesando batch de {batch_size} job(s)")
+            is_idle = False
             
-            # Marcar como busy
-            supabase.table('vast_instances').update({
-                'status': 'busy',
-                'current_batch_size': batch_size,
-            }).eq('worker_id', WORKER_ID).execute()
+            # Marcar como busy (solo si cambia el tamaño del batch)
+            if reported_batch_size != len(active_jobs):
+                supabase.table('vast_instances').update({
+                    'status': 'busy',
+                    'current_batch_size': len(active_jobs),
+                }).eq('worker_id', WORKER_ID).execute()
+                reported_batch_size = len(active_jobs)
             
-            # Procesar batch (FCFS - uno a la vez por ahora)
-            # TODO: Procesar en paralelo si VRAM lo permite
-            for job in jobs:
-                success = process_job(job)
-                if success:
-                    jobs_processed_total += 1
+            # Jobs en curso en paralelo (MAX_CONCURRENT_JOBS hilos, slots por recurso).
+            # Los que aún esperan hilo: descargar inputs y encolar prompts ComfyUI ya.
+            upcoming = [job for job, future in active_jobs.values() if not future.done()]
+            prefetch_job_inputs(upcoming[:WORKER_CONFIG['MAX_CONCURRENT_JOBS'] + WORKER_CONFIG['PREFETCH_DEPTH']])
+            presubmit_comfy_jobs(upcoming)
             
-            print(f"✅ Batch completado ({jobs_processed_total} total)\n")
+            # Dormir hasta que acabe un job o llegue uno nuevo
+            JOB_WAKEUP.wait(WORKER_CONFIG['POLL_INTERVAL_SECONDS'])
+            JOB_WAKEUP.clear()
             
         except KeyboardInterrupt:
             print("\n\n🛑 Worker detenido por usuario")
+            not_started = [job_id for job_id, (job, future) in active_jobs.items() if future.cancel()]
+            discard_comfy_submissions(not_started)
+            discard_prefetched_inputs(not_started)
+            release_job_claims(not_started)
+            if len(not_started) < len(active_jobs):
+                print(f"   Esperando {len(active_jobs) - len(not_started)} job(s) en curso...")
+            JOB_EXECUTOR.shutdown(wait=True)
+            if _video_backlog:
+                print(f"   Esperando {_video_backlog} video(s) en cola...")
+            VIDEO_EXECUTOR.shutdown(wait=True)
             break
             
         except Exception as e:
             print(f"❌ Error en main loop: {e}")
             time.sleep(10)  # Esperar más en caso de error
     
+    lease_stop.set()
+    
     print(f"\n📊 Estadísticas finales:")
     print(f"   Jobs procesados: {jobs_processed_total}")
     print(f"   Worker ID: {WORKER_ID}")
     print("\n👋 Worker finalizado")
 
 if __name__ == "__main__":
+    if sys.argv[1:2] == ["--benchmark-klein-quant"]:
+        UNET_CONFIG = get_optimal_unet_config()
+        benchmark_klein_quantization(sys.argv[2:] or None)
+        sys.exit(0)
     try:
         main_loop()
     except Exception as e: